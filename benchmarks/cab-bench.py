@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+#
+# Benchmark cab's own orchestration overhead: image lookups, working container
+# handling, rsync, commit and tag.
+#
+# A synthetic, ceph-like, install tree is generated with a configurable number
+# of files and total size, and raw and final images are built from it, for
+# a number of iterations; between iterations a fraction of the install tree is
+# modified, so later iterations exercise incremental images.
+#
+# By default 'podman' and 'buildah' are replaced by fakes (see fake_tools.py)
+# with controllable latencies, so that the numbers reflect cab itself. With
+# '--real', the real tools are used against an existing vendor/release.
+#
+# Results are written as json, to stdout or to '--output'.
+#
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+ourdir = Path(__file__).resolve().parent
+sys.path.insert(0, str(ourdir.parent))
+
+BENCH_BUILD = "cab-bench"
+
+
+class Results:
+
+    _samples: Dict[str, List[float]]
+
+    def __init__(self):
+        self._samples = {}
+
+    def add(self, name: str, secs: float):
+        self._samples.setdefault(name, []).append(secs)
+
+    def time(self, name: str, func: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        ret = func()
+        self.add(name, time.perf_counter() - start)
+        return ret
+
+    def to_dict(self) -> Dict[str, Any]:
+        d: Dict[str, Any] = {}
+        for name, samples in self._samples.items():
+            d[name] = {
+                'samples': samples,
+                'min': min(samples),
+                'median': statistics.median(samples),
+                'mean': statistics.mean(samples),
+                'max': max(samples)
+            }
+        return d
+
+
+def generate_install_tree(path: Path, num_files: int, size_mb: float,
+                          seed: int = 0) -> List[Path]:
+    """ Generate a ceph-like install tree, with 'num_files' files adding up
+        to roughly 'size_mb' MiB. A few large binaries and libraries take
+        most of the space, while python modules make up most of the files.
+    """
+    rnd = random.Random(seed)
+    total = int(size_mb * 1024 * 1024)
+    layout = [
+        # (directory, name pattern, share of files, share of bytes)
+        ("usr/bin", "ceph-tool-{}", 0.01, 0.45),
+        ("usr/lib64/ceph", "libceph-{}.so.2", 0.02, 0.35),
+        ("usr/lib64/rados-classes", "libcls_{}.so", 0.02, 0.05),
+        ("usr/share/ceph/mgr/module{}", "module_{}.py", 0.60, 0.08),
+        ("usr/lib/python3.6/site-packages/ceph", "ceph_{}.py", 0.25, 0.04),
+        ("usr/share/man/man8", "ceph-{}.8.gz", 0.10, 0.03),
+    ]
+    chunk = rnd.randbytes(1024 * 1024) if hasattr(rnd, "randbytes") else \
+        os.urandom(1024 * 1024)
+    files: List[Path] = []
+    for dirname, pattern, file_share, byte_share in layout:
+        n = max(1, int(num_files * file_share))
+        per_file = max(1, int(total * byte_share / n))
+        for i in range(n):
+            d = dirname.format(i % 20) if "{}" in dirname else dirname
+            p = path.joinpath(d, pattern.format(i))
+            p.parent.mkdir(parents=True, exist_ok=True)
+            with p.open('wb') as fd:
+                remaining = per_file
+                while remaining > 0:
+                    n_bytes = min(remaining, len(chunk))
+                    fd.write(chunk[:n_bytes])
+                    remaining -= n_bytes
+            files.append(p)
+
+    post_install = path.joinpath("post-install.sh")
+    post_install.write_text("#!/bin/bash\necho post-install\n")
+    # as ceph's spec does, for its binaries and some directories.
+    attrs = [{'mode': "0755", 'user': "root", 'group': "root",
+              'path': "/usr/bin/ceph-tool-*"},
+             {'mode': "0750", 'user': "root", 'group': "root",
+              'path': "/usr/lib64/ceph"}]
+    path.joinpath("post-install-attrs.json").write_text(json.dumps(attrs))
+    return files
+
+
+def touch_files(install_path: Path, files: List[Path], ratio: float,
+                seed: int):
+    """ Modify a fraction of the install tree, as an incremental build would.
+    """
+    rnd = random.Random(seed)
+    n = int(len(files) * ratio)
+    for p in rnd.sample(files, n):
+        with p.open('ab') as fd:
+            fd.write(b'\0')
+    # the final image removes it, but every build generates it again.
+    install_path.joinpath("post-install.sh").write_text(
+        "#!/bin/bash\necho post-install\n")
+
+
+def setup_fake_tools(workdir: Path, fake_rsync: bool,
+                     vendor: str, release: str) -> Dict[str, str]:
+    bindir = workdir.joinpath("bin")
+    bindir.mkdir()
+    tools = ["podman", "buildah"]
+    if fake_rsync:
+        tools.append("rsync")
+    for tool in tools:
+        bindir.joinpath(tool).symlink_to(ourdir.joinpath("fake_tools.py"))
+
+    env = {
+        'PATH': f"{bindir}:{os.environ.get('PATH', '')}",
+        'CAB_FAKE_STATE': str(workdir.joinpath("fake-state"))
+    }
+    os.environ.update(env)
+
+    # the images cab expects to exist for a vendor/release.
+    for image in ["cab/seed/suse:leap-15.2",
+                  f"cab/builder/{vendor}:{release}",
+                  f"cab/base/{vendor}:{release}"]:
+        wc = subprocess.run(["buildah", "from", "scratch"],
+                            check=True, capture_output=True,
+                            text=True).stdout.strip()
+        subprocess.run(["buildah", "commit", wc, image],
+                       check=True, capture_output=True)
+    return env
+
+
+def setup_config(workdir: Path, sources: Path,
+                 vendor: str, release: str) -> Path:
+    os.environ['XDG_CONFIG_HOME'] = str(workdir.joinpath("config"))
+    os.environ['XDG_DATA_HOME'] = str(workdir.joinpath("data"))
+    confdir = workdir.joinpath("config", "cab")
+    confdir.joinpath("builds").mkdir(parents=True)
+    installs = workdir.joinpath("installs")
+    installs.mkdir()
+    confdir.joinpath("config.yaml").write_text(json.dumps({
+        'global': {'installs': {'path': str(installs)}}
+    }))
+    confdir.joinpath("builds", f"{BENCH_BUILD}.yaml").write_text(json.dumps({
+        'name': BENCH_BUILD,
+        'vendor': vendor,
+        'release': release,
+        'sources': str(sources),
+        'build': {'debug': False, 'tests': False}
+    }))
+    return installs.joinpath(BENCH_BUILD)
+
+
+def run_benchmark(args: argparse.Namespace, workdir: Path) -> Dict[str, Any]:
+    sources = workdir.joinpath("sources")
+    sources.mkdir()
+    install_path = setup_config(workdir, sources, args.vendor, args.release)
+
+    if not args.real:
+        os.environ['CAB_FAKE_LATENCY_MS'] = str(args.latency_ms)
+        if args.commit_mbps:
+            os.environ['CAB_FAKE_COMMIT_MBPS'] = str(args.commit_mbps)
+        setup_fake_tools(workdir, args.fake_rsync, args.vendor, args.release)
+
+    # import only now, so the environment above is what cab sees.
+    from builder.config import Config
+    from builder.build import Build
+    from builder.images import Images
+
+    gen_start = time.perf_counter()
+    files = generate_install_tree(install_path, args.files, args.size_mb)
+    gen_secs = time.perf_counter() - gen_start
+
+    results = Results()
+    phases = Results()
+    config = Config()
+    out = sys.stderr if args.verbose else open(os.devnull, 'w')
+
+    with contextlib.redirect_stdout(out):
+        for i in range(args.iterations):
+            if i > 0:
+                touch_files(install_path, files, args.touch_ratio, seed=i)
+
+            results.time("find_seed_image", Images.find_seed_image)
+            results.time("find_builder_image",
+                         lambda: Images.find_builder_image(args.vendor,
+                                                           args.release))
+            results.time("find_base_image",
+                         lambda: Images.find_base_image(args.vendor,
+                                                        args.release))
+            results.time("find_build_images",
+                         lambda: Images.find_build_images(BENCH_BUILD))
+
+            build = Build(config, BENCH_BUILD)
+            kind = "initial" if i == 0 else "incremental"
+            start = time.perf_counter()
+            image_date, raw_image = \
+                build._build_raw_container_image(install_path)
+            raw_secs = time.perf_counter() - start
+            results.add(f"build_raw_container_image.{kind}", raw_secs)
+
+            start = time.perf_counter()
+            build._build_final_container_image(image_date, raw_image)
+            final_secs = time.perf_counter() - start
+            results.add(f"build_final_container_image.{kind}", final_secs)
+            results.add(f"build_container.{kind}", raw_secs + final_secs)
+
+            for name, secs in build._timer.get_phases().items():
+                phases.add(f"{name}.{kind}", secs)
+
+            # image dates have a one second resolution.
+            time.sleep(1)
+
+        if args.real:
+            for img in Images.find_build_images(BENCH_BUILD):
+                Images.rm_image(img)
+
+    return {
+        'created': dt.now().isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'params': {
+            'files': len(files),
+            'size_mb': args.size_mb,
+            'iterations': args.iterations,
+            'touch_ratio': args.touch_ratio,
+            'real': args.real,
+            'latency_ms': None if args.real else args.latency_ms,
+            'commit_mbps': None if args.real else args.commit_mbps,
+            'fake_rsync': args.fake_rsync,
+            'vendor': args.vendor,
+            'release': args.release
+        },
+        'generate_tree_secs': gen_secs,
+        'results': results.to_dict(),
+        'phases': phases.to_dict()
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="benchmark cab's image pipeline overhead")
+    parser.add_argument("--files", type=int, default=2000,
+                        help="number of files in the install tree")
+    parser.add_argument("--size-mb", type=float, default=100,
+                        help="install tree size, in MiB")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--touch-ratio", type=float, default=0.05,
+                        help="fraction of files changed between iterations")
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="latency of each fake podman/buildah call")
+    parser.add_argument("--commit-mbps", type=float,
+                        help="fake commit throughput, in MiB/s")
+    parser.add_argument("--fake-rsync", action="store_true", default=False,
+                        help="replace rsync with a plain copy")
+    parser.add_argument("--real", action="store_true", default=False,
+                        help="use real podman and buildah")
+    parser.add_argument("--vendor", type=str, default="suse")
+    parser.add_argument("--release", type=str, default="ses7")
+    parser.add_argument("--workdir", type=str,
+                        help="directory to run in (default: temporary)")
+    parser.add_argument("--keep", action="store_true", default=False,
+                        help="don't remove the working directory")
+    parser.add_argument("-o", "--output", type=str,
+                        help="write results to file instead of stdout")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    args = parser.parse_args()
+
+    if args.real and args.fake_rsync:
+        parser.error("--fake-rsync can't be used with --real")
+
+    workdir = Path(tempfile.mkdtemp(prefix="cab-bench-", dir=args.workdir))
+    try:
+        result = run_benchmark(args, workdir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"working directory kept at {workdir}", file=sys.stderr)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+    for name, r in result['results'].items():
+        print("{:<45} median {:8.3f}s  min {:8.3f}s".format(
+              name, r['median'], r['min']), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
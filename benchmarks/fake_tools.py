@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+#
+# Fake podman, buildah and rsync, for benchmarking cab's orchestration overhead
+# without paying for real container storage operations.
+#
+# The benchmark links this script as 'podman', 'buildah' and, optionally,
+# 'rsync', and it acts according to the name it was called with. Images and
+# working containers are kept in a json state file, with their root
+# filesystems as plain directories, under $CAB_FAKE_STATE.
+#
+# Latencies are controlled through the environment:
+#
+#   CAB_FAKE_LATENCY_MS   fixed latency added to every call (default: 0).
+#   CAB_FAKE_COMMIT_MBPS  if set, commits also take as long as writing the
+#                         working container's contents at this rate.
+#
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Dict, List
+
+
+def _state_dir() -> Path:
+    path = os.environ.get("CAB_FAKE_STATE")
+    if not path:
+        print("CAB_FAKE_STATE not set", file=sys.stderr)
+        sys.exit(1)
+    return Path(path)
+
+
+class State:
+
+    def __init__(self):
+        self.path = _state_dir()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lockfd = self.path.joinpath("lock").open('w')
+        fcntl.flock(self._lockfd, fcntl.LOCK_EX)
+        self._file = self.path.joinpath("state.json")
+        self.data: Dict[str, Any] = {"images": [], "containers": {}}
+        if self._file.exists():
+            self.data = json.loads(self._file.read_text())
+
+    def save(self):
+        tmp = self._file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.data))
+        tmp.replace(self._file)
+
+    @property
+    def images(self) -> List[Dict[str, Any]]:
+        return self.data["images"]
+
+    @property
+    def containers(self) -> Dict[str, Any]:
+        return self.data["containers"]
+
+    def rootfs(self, hashid: str) -> Path:
+        return self.path.joinpath("images", hashid)
+
+    def mnt(self, wc: str) -> Path:
+        return self.path.joinpath("containers", wc)
+
+    def find_image(self, ref: str) -> Any:
+        for img in self.images:
+            if img["Id"].startswith(ref):
+                return img
+            for name in img["Names"]:
+                if _ref_matches(name, ref):
+                    return img
+        return None
+
+    def untag(self, name: str):
+        for img in self.images:
+            if name in img["Names"]:
+                img["Names"].remove(name)
+
+
+def _normalize(ref: str) -> str:
+    if ref.count('/') < 2 or '.' not in ref.split('/')[0] and \
+            ref.split('/')[0] != "localhost":
+        ref = f"localhost/{ref}"
+    if ':' not in ref.split('/')[-1]:
+        ref = f"{ref}:latest"
+    return ref
+
+
+def _ref_matches(name: str, ref: str) -> bool:
+    if name == _normalize(ref):
+        return True
+    # 'podman images <repo>' matches any tag.
+    if ':' not in ref.split('/')[-1]:
+        return name.rsplit(':', 1)[0] == _normalize(ref).rsplit(':', 1)[0]
+    return False
+
+
+def _du(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _sleep_latency():
+    ms = float(os.environ.get("CAB_FAKE_LATENCY_MS", "0"))
+    if ms > 0:
+        time.sleep(ms / 1000)
+
+
+def podman(args: List[str]) -> int:
+    state = State()
+    cmd = args[0] if args else ""
+    if cmd == "images":
+        refs = [a for a in args[1:] if not a.startswith("--") and a != "json"]
+        imgs = state.images
+        if refs:
+            imgs = [i for i in imgs
+                    if any(_ref_matches(n, refs[0]) for n in i["Names"])]
+        print(json.dumps(imgs))
+        return 0
+    elif cmd == "rmi":
+        ref = args[-1]
+        img = state.find_image(ref)
+        if img is None:
+            print(f"image not known: {ref}", file=sys.stderr)
+            return 1
+        if len(img["Names"]) > 1 and ref != img["Id"]:
+            state.untag(_normalize(ref))
+        else:
+            state.images.remove(img)
+            shutil.rmtree(state.rootfs(img["Id"]), ignore_errors=True)
+        state.save()
+        return 0
+    elif cmd in ["push", "tag", "run", "cp", "inspect", "ps"]:
+        return 0
+    print(f"fake podman: unsupported command '{cmd}'", file=sys.stderr)
+    return 1
+
+
+def buildah(args: List[str]) -> int:
+    if len(args) > 1 and args[0] == "unshare" and args[1] == "buildah":
+        return buildah(args[2:])
+    elif len(args) > 1 and args[0] == "unshare":
+        return subprocess.run(args[1:]).returncode
+
+    state = State()
+    cmd = args[0] if args else ""
+    if cmd == "from":
+        ref = args[-1]
+        img = state.find_image(ref)
+        wc = f"wc-{os.urandom(6).hex()}"
+        name = args[args.index("--name") + 1] if "--name" in args else wc
+        state.containers[wc] = {
+            "from": img["Id"] if img else None, "mounted": False,
+            "name": name}
+        mnt = state.mnt(wc)
+        if img is not None and state.rootfs(img["Id"]).exists():
+            shutil.copytree(state.rootfs(img["Id"]), mnt, symlinks=True,
+                            copy_function=os.link)
+        else:
+            mnt.mkdir(parents=True, exist_ok=True)
+        state.save()
+        print(wc)
+        return 0
+    elif cmd == "mount":
+        wc = args[-1]
+        state.containers[wc]["mounted"] = True
+        state.save()
+        print(state.mnt(wc))
+        return 0
+    elif cmd == "unmount":
+        state.containers[args[-1]]["mounted"] = False
+        state.save()
+        return 0
+    elif cmd == "commit":
+        wc, name = args[-2], _normalize(args[-1])
+        mnt = state.mnt(wc)
+        size = _du(mnt)
+        mbps = os.environ.get("CAB_FAKE_COMMIT_MBPS")
+        if mbps:
+            time.sleep(size / (float(mbps) * 1024 * 1024))
+        hashid = hashlib.sha256(f"{wc}{time.time()}".encode()).hexdigest()
+        state.untag(name)
+        state.images.append({
+            "Id": hashid,
+            "Names": [name],
+            "Size": size,
+            "CreatedAt": dt.now().isoformat()
+        })
+        state.rootfs(hashid).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copytree(mnt, state.rootfs(hashid), symlinks=True,
+                        copy_function=os.link)
+        state.save()
+        print(hashid)
+        return 0
+    elif cmd == "tag":
+        img = state.find_image(args[-2])
+        name = _normalize(args[-1])
+        state.untag(name)
+        img["Names"].append(name)
+        state.save()
+        return 0
+    elif cmd == "rm":
+        for wc in args[1:]:
+            state.containers.pop(wc, None)
+            shutil.rmtree(state.mnt(wc), ignore_errors=True)
+        state.save()
+        return 0
+    elif cmd == "run":
+        return _run(state, args[1:])
+    elif cmd in ["config", "copy", "add", "label"]:
+        return 0
+    elif cmd == "containers":
+        print(json.dumps([{"id": wc, "containername": c.get("name", wc)}
+                          for wc, c in state.containers.items()]))
+        return 0
+    print(f"fake buildah: unsupported command '{cmd}'", file=sys.stderr)
+    return 1
+
+
+def _run(state: State, args: List[str]) -> int:
+    """ Only cab's python byte-compiler is run, on the host, against the
+        working container's root, so that benchmarks account for it.
+    """
+    sep = args.index("--")
+    opts, wc, cmd = args[:sep - 1], args[sep - 1], args[sep + 1:]
+    volumes: Dict[str, str] = {}
+    for i, opt in enumerate(opts):
+        if opt == "-v":
+            src, dest = opts[i + 1].split(':')[:2]
+            volumes[dest] = src
+    if len(cmd) < 3 or cmd[1] != "/cab-pycompile.py":
+        return 0
+    mnt = state.mnt(wc)
+    sources = Path(volumes[cmd[2]]).read_text().split()
+    with tempfile.NamedTemporaryFile('w', suffix=".list") as fd:
+        fd.write(''.join([f"{mnt}{s}\n" for s in sources]))
+        fd.flush()
+        return subprocess.run(
+            [sys.executable, volumes[cmd[1]], fd.name]).returncode
+
+
+def rsync(args: List[str]) -> int:
+    paths = [a for a in args if not a.startswith("-")]
+    # drop values for options taking an argument.
+    for i, a in enumerate(args):
+        if a in ["--exclude", "--chmod", "--chown"] and i + 1 < len(args):
+            paths.remove(args[i + 1])
+    src, dest = paths[-2], paths[-1]
+    files_from = [a.split('=', 1)[1] for a in args
+                  if a.startswith("--files-from=")]
+    if files_from:
+        for f in Path(files_from[0]).read_text().splitlines():
+            Path(dest, f).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(Path(src, f), Path(dest, f))
+        return 0
+    proc = subprocess.run(["cp", "-a", "--remove-destination",
+                           f"{src.rstrip('/')}/.", dest])
+    return proc.returncode
+
+
+def main(argv: List[str]) -> int:
+    name = os.path.basename(argv[0])
+    args = argv[1:]
+    _sleep_latency()
+    if name == "podman":
+        return podman(args)
+    elif name == "buildah":
+        return buildah(args)
+    elif name == "rsync":
+        return rsync(args)
+    print(f"unknown fake tool '{name}'", file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
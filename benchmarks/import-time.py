@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+#
+# Measure what loading the python shipped in images costs a fresh container,
+# e.g. to compare images built with and without byte-compiled python.
+#
+# For each image, a number of read-only containers are run, as a restarted or
+# failed over daemon would be, and in each we record:
+#
+#   - how long obtaining the code of every module in the python trees takes,
+#     through the same loader imports use; i.e., either reading bytecode, if
+#     current, or compiling the module, as a read-only container can't keep
+#     what it compiled;
+#   - how long importing each of '--module' takes, if any, in an interpreter
+#     of its own.
+#
+# Requires podman. Results are written as json, to stdout or to '--output'.
+#
+import argparse
+import json
+import platform
+import shlex
+import statistics
+import subprocess
+import sys
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Dict, List
+
+DEFAULT_TREES = [
+    "/usr/share/ceph/mgr",
+    "/usr/lib/python3.6/site-packages/ceph"
+]
+
+# run within the container; must run on the image's python.
+LOAD_SCRIPT = """
+import importlib.machinery, os, sys, time
+start = time.perf_counter()
+n = 0
+for root in sys.argv[1:]:
+    for path, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if d not in ('__pycache__', 'node_modules')]
+        for name in files:
+            if not name.endswith('.py'):
+                continue
+            loader = importlib.machinery.SourceFileLoader(
+                'm', os.path.join(path, name))
+            try:
+                loader.get_code('m')
+                n += 1
+            except Exception:
+                pass
+print(n, time.perf_counter() - start)
+"""
+
+IMPORT_SCRIPT = """
+import sys, time
+sys.path.insert(0, '/usr/share/ceph/mgr')
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(time.perf_counter() - start)
+"""
+
+
+def run_python(image: str, script: str, args: List[str]) -> str:
+    cmd = ["podman", "run", "--rm", "--read-only", "--entrypoint",
+           "python3", image, "-c", script] + args
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"'{' '.join([shlex.quote(x) for x in cmd[:7]])} ...' failed: "
+            f"{proc.stderr.decode('utf-8').strip()}")
+    return proc.stdout.decode("utf-8").strip()
+
+
+def summarize(samples: List[float]) -> Dict[str, Any]:
+    return {
+        'samples': samples,
+        'min': min(samples),
+        'median': statistics.median(samples)
+    }
+
+
+def measure(args: argparse.Namespace, image: str) -> Dict[str, Any]:
+    result: Dict[str, Any] = {'image': image}
+    load: List[float] = []
+    modules = 0
+    for _ in range(args.runs):
+        out = run_python(image, LOAD_SCRIPT, args.trees).split()
+        modules = int(out[0])
+        load.append(float(out[1]))
+    result['modules'] = modules
+    result['load_secs'] = summarize(load)
+
+    imports: Dict[str, Any] = {}
+    for module in args.module:
+        samples = [float(run_python(image, IMPORT_SCRIPT, [module]))
+                   for _ in range(args.runs)]
+        imports[module] = summarize(samples)
+    result['import_secs'] = imports
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="measure python load and import times in fresh, "
+                    "read-only, containers")
+    parser.add_argument("images", type=str, nargs='+',
+                        help="images to compare (e.g., "
+                        "cab-builds/<build>:<before> "
+                        "cab-builds/<build>:latest)")
+    parser.add_argument("--trees", type=str, nargs='+',
+                        default=DEFAULT_TREES,
+                        help="python trees to load, within the images")
+    parser.add_argument("--module", type=str, action='append', default=[],
+                        help="module to time importing; may be repeated")
+    parser.add_argument("-n", "--runs", type=int, default=5,
+                        help="containers run per image and measurement")
+    parser.add_argument("-o", "--output", type=str,
+                        help="write results to file instead of stdout")
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = []
+    for image in args.images:
+        print(f"=> measuring {image}", file=sys.stderr)
+        results.append(measure(args, image))
+
+    output = json.dumps({
+        'created': dt.now().isoformat(),
+        'host': platform.node(),
+        'trees': args.trees,
+        'results': results
+    }, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+    for r in results:
+        print("{:<40} {:6d} modules loaded in {:8.3f}s{}".format(
+            r['image'], r['modules'], r['load_secs']['median'],
+            ''.join([f"  import {m} {s['median']:.3f}s"
+                     for m, s in r['import_secs'].items()])),
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
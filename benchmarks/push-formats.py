@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+#
+# Measure how layer compression formats affect pushing and pulling an image.
+#
+# For each format, an existing local image (e.g., a build's latest image) is
+# pushed to a registry, and then pulled back into a scratch container storage,
+# so nothing is shared with the local storage. We record:
+#
+#   - push time;
+#   - compressed layer bytes, as per the pushed manifest, i.e. what a full
+#     pull transfers;
+#   - cold pull time, into an empty storage;
+#   - warm pull time and bytes received, pulling the image again into a
+#     storage already holding an older image ('--base'), which is where
+#     zstd:chunked is able to reuse chunks it already has.
+#
+# Bytes received are measured from the host's network counters, so keep the
+# host otherwise idle, and point '--registry' at a registry on another host.
+#
+# Requires podman and skopeo. Results are written as json, to stdout or to
+# '--output'.
+#
+import argparse
+import json
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ourdir = Path(__file__).resolve().parent
+sys.path.insert(0, str(ourdir.parent))
+
+from builder.compression import ImageCompression  # noqa: E402
+
+DEFAULT_FORMATS = ["gzip", "zstd:chunked"]
+
+
+def run(cmd: str) -> str:
+    proc = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"'{cmd}' failed: {proc.stderr.decode('utf-8').strip()}")
+    return proc.stdout.decode("utf-8")
+
+
+def get_rx_bytes() -> int:
+    total = 0
+    for line in Path("/proc/net/dev").read_text().splitlines()[2:]:
+        iface, fields = line.split(':', 1)
+        if iface.strip() == "lo":
+            continue
+        total += int(fields.split()[0])
+    return total
+
+
+def timed(cmd: str) -> float:
+    start = time.perf_counter()
+    run(cmd)
+    return time.perf_counter() - start
+
+
+class Storage:
+    """ A scratch container storage, so pulls don't share anything with the
+        host's storage.
+    """
+
+    def __init__(self, workdir: Path, name: str):
+        self.path = workdir.joinpath(name)
+        self.path.mkdir()
+
+    def podman(self, args: str) -> str:
+        return f"podman --root {self.path}/root " \
+               f"--runroot {self.path}/runroot {args}"
+
+    def cleanup(self):
+        # files in storage may belong to subordinate ids.
+        subprocess.run(shlex.split(
+            f"podman unshare rm -fr {self.path}"), check=False)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def measure(args: argparse.Namespace, workdir: Path,
+            fmt: str) -> Dict[str, Any]:
+    compression = ImageCompression(fmt, args.level)
+    tls = "" if args.tls_verify else "--tls-verify=false"
+    slug = fmt.replace(':', '-')
+    remote = f"{args.registry}/{args.repo}:{slug}"
+    remote_base = f"{args.registry}/{args.repo}:{slug}-base"
+
+    result: Dict[str, Any] = {'format': fmt, 'level': compression.level}
+
+    if args.base is not None:
+        run(f"podman push {tls} {compression.get_podman_args()} "
+            f"{args.base} {remote_base}")
+
+    result['push_secs'] = timed(
+        f"podman push {tls} {compression.get_podman_args()} "
+        f"{args.image} {remote}")
+
+    skopeo_tls = "" if args.tls_verify else "--tls-verify=false"
+    manifest = json.loads(run(f"skopeo inspect {skopeo_tls} --raw "
+                              f"docker://{remote}"))
+    result['layers'] = len(manifest.get('layers', []))
+    result['layer_bytes'] = sum([x['size'] for x in manifest['layers']])
+
+    cold = Storage(workdir, f"cold-{slug}")
+    try:
+        rx = get_rx_bytes()
+        result['cold_pull_secs'] = timed(cold.podman(f"pull {tls} {remote}"))
+        result['cold_pull_rx_bytes'] = get_rx_bytes() - rx
+    finally:
+        cold.cleanup()
+
+    if args.base is not None:
+        warm = Storage(workdir, f"warm-{slug}")
+        try:
+            run(warm.podman(f"pull {tls} {remote_base}"))
+            rx = get_rx_bytes()
+            result['warm_pull_secs'] = \
+                timed(warm.podman(f"pull {tls} {remote}"))
+            result['warm_pull_rx_bytes'] = get_rx_bytes() - rx
+        finally:
+            warm.cleanup()
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="measure push and pull costs of layer compression formats")
+    parser.add_argument("image", type=str,
+                        help="local image to push (e.g., "
+                        "cab-builds/<build>:latest)")
+    parser.add_argument("--base", type=str,
+                        help="older local image, to measure incremental pulls")
+    parser.add_argument("--registry", type=str, required=True)
+    parser.add_argument("--repo", type=str, default="cab-bench/push-formats",
+                        help="repository to push to, within the registry")
+    parser.add_argument("--tls-verify", action="store_true", default=False)
+    parser.add_argument("--formats", type=str, nargs='+',
+                        default=DEFAULT_FORMATS,
+                        choices=list(ImageCompression.FORMATS.keys()))
+    parser.add_argument("--level", type=int,
+                        help="compression level (default: per format)")
+    parser.add_argument("--workdir", type=str,
+                        help="directory for scratch storages")
+    parser.add_argument("-o", "--output", type=str,
+                        help="write results to file instead of stdout")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="cab-push-", dir=args.workdir))
+    results: List[Dict[str, Any]] = []
+    try:
+        for fmt in args.formats:
+            print(f"=> measuring {fmt}", file=sys.stderr)
+            results.append(measure(args, workdir, fmt))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps({
+        'created': dt.now().isoformat(),
+        'host': platform.node(),
+        'image': args.image,
+        'base': args.base,
+        'registry': args.registry,
+        'results': results
+    }, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+    for r in results:
+        warm: Optional[float] = r.get('warm_pull_secs')
+        print("{:<14} push {:8.1f}s  layers {:10.1f} MiB  "
+              "cold pull {:8.1f}s{}".format(
+                  r['format'], r['push_secs'],
+                  r['layer_bytes'] / (1024 * 1024), r['cold_pull_secs'],
+                  f"  warm pull {warm:8.1f}s "
+                  f"({r['warm_pull_rx_bytes'] / (1024 * 1024):.1f} MiB)"
+                  if warm is not None else ""),
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
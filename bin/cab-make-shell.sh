@@ -0,0 +1,40 @@
+#!/bin/bash
+#
+# shell used by make to run recipes, so we can record how long each target
+# takes to build. Only commands producing an output ('-o <target>') are
+# recorded, in the same format as ninja's log:
+#
+#   <start ms> <end ms> 0 <target> -
+#
+# usage: make SHELL=/build/bin/cab-make-shell.sh
+#
+
+if [[ -z "${CAB_TIMING_LOG}" || "$1" != "-c" ]]; then
+  exec /bin/sh "$@"
+fi
+
+target=""
+if [[ "$2" =~ [[:space:]]-o[[:space:]]+([^[:space:]]+) ]]; then
+  target="${BASH_REMATCH[1]}"
+fi
+
+if [[ -z "${target}" ]]; then
+  exec /bin/sh "$@"
+fi
+
+# make runs recipes from the directory a (sub)makefile lives in, but cmake
+# changes into the target's directory first.
+if [[ "$2" =~ ^cd[[:space:]]+([^[:space:]]+)[[:space:]]*\&\& ]]; then
+  dir="${BASH_REMATCH[1]}"
+else
+  dir="$(pwd)"
+fi
+[[ "${target}" != /* ]] && target="${dir}/${target}"
+
+start=$(date +%s%3N)
+/bin/sh "$@"
+ret=$?
+end=$(date +%s%3N)
+
+echo "${start} ${end} 0 ${target} -" >> ${CAB_TIMING_LOG}
+exit ${ret}
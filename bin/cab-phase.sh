@@ -0,0 +1,13 @@
+#!/bin/bash
+#
+# record the start or end of a build phase, so cab can keep track of where
+# time is being spent within the builder container.
+#
+# usage: cab-phase.sh <start|end> <phase>
+#
+
+[[ -z "${CAB_PHASE_LOG}" ]] && exit 0
+[[ $# -lt 2 ]] && echo "usage: $0 <start|end> <phase>" && exit 1
+
+echo "$1 $2 $(date +%s.%N)" >> ${CAB_PHASE_LOG}
+exit 0
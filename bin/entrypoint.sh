@@ -19,17 +19,62 @@ done
 
 cd /build/src
 
+phase=/build/bin/cab-phase.sh
+
+# the build directory may be mounted on its own, possibly on a tmpfs, instead
+# of living within the sources. It can't be removed then, only emptied.
+# Variants of this build, sharing the sources, keep theirs at 'build.<name>'.
+#
+clean_args=(-e '/build.*')
+[[ -n "${CAB_BUILD_DIR_MOUNTED}" ]] && clean_args+=(-e /build)
 
 if $do_fresh_build ; then
 
   echo "=> cleaning up the git repository"
   git submodule foreach 'git clean -fdx' || exit 1
-  git clean -fdx || exit 1
+  git clean -fdx "${clean_args[@]}" || exit 1
+  if [[ -n "${CAB_BUILD_DIR_MOUNTED}" ]]; then
+    find /build/src/build -mindepth 1 -delete || exit 1
+  fi
+
+elif [[ -n "${CAB_BUILD_DIR_PERSIST}" ]]; then
+
+  echo "=> restoring build directory from ${CAB_BUILD_DIR_PERSIST}"
+  cp -a ${CAB_BUILD_DIR_PERSIST}/. /build/src/build/ || exit 1
 
 fi
 
+# a tmpfs build directory is gone once we exit; keep ninja's log for the
+# build profile and, if asked to, the whole directory, regardless of how the
+# build went.
+#
+persist_build_dir() {
+  [[ -f /build/src/build/.ninja_log && -d /build/run ]] && \
+    cp /build/src/build/.ninja_log /build/run/ninja-log
+  [[ -z "${CAB_BUILD_DIR_PERSIST}" ]] && return
+  echo "=> persisting build directory to ${CAB_BUILD_DIR_PERSIST}"
+  if command -v rsync >/dev/null ; then
+    rsync -a --delete /build/src/build/ ${CAB_BUILD_DIR_PERSIST}/
+  else
+    find ${CAB_BUILD_DIR_PERSIST} -mindepth 1 -delete && \
+      cp -a /build/src/build/. ${CAB_BUILD_DIR_PERSIST}/
+  fi
+}
+
+[[ -n "${CAB_BUILD_DIR_TMPFS}" ]] && trap persist_build_dir EXIT
+
+
+# cab hands us the dashboard's frontend when it has it cached for these
+# sources; don't build it then. It's put in place once installed.
+#
+with_frontend=ON
+if [[ -n "${CAB_FRONTEND_CACHE}" ]]; then
+  echo "=> using cached dashboard frontend"
+  with_frontend=OFF
+fi
 
-extra_args="-DCMAKE_COLOR_MAKEFILE=OFF -DWITH_MGR_DASHBOARD_FRONTEND=ON"
+extra_args="-DCMAKE_COLOR_MAKEFILE=OFF"
+extra_args="$extra_args -DWITH_MGR_DASHBOARD_FRONTEND=${with_frontend}"
 
 if ! $do_with_tests ; then
   extra_args="$extra_args -DWITH_TESTS=OFF"
@@ -43,42 +88,85 @@ if $do_with_ccache ; then
   echo "---> WITH CCACHE <---"
   export CCACHE_DIR=/build/ccache
   export CCACHE_BASEDIR=/build/src
+  if [[ -n "${CCACHE_REMOTE_STORAGE}" ]]; then
+    echo "---> WITH CCACHE REMOTE STORAGE: ${CCACHE_REMOTE_STORAGE} <---"
+  fi
   extra_args="$extra_args -DWITH_CCACHE=ON" 
 fi
 export CEPH_EXTRA_CMAKE_ARGS="$extra_args"
 
 
-# generate a builder spec file, adjusted for our purposes.
-# this spec is slightly modified so we can build with ease, and parse
-# informations out of it at later stages.
+# submodules are fetched from cab's local mirrors, when there are any, falling
+# back to upstream should the mirrors not have what we need.
 #
-/build/bin/generate-builder-spec.sh || exit 1
-
+submodule_args=(--init --recursive --jobs $(nproc))
+mirror_cfg=()
+if [[ -f /build/run/git-mirrors ]]; then
+  mirror_cfg+=(-c protocol.file.allow=always)
+  while read -r cfg ; do
+    mirror_cfg+=(-c "${cfg}")
+  done < /build/run/git-mirrors
+fi
 
+${phase} start submodule-update
 git submodule sync || exit 1
-git submodule update --init --recursive || exit 1
+if ! git "${mirror_cfg[@]}" submodule update "${submodule_args[@]}" ; then
+  [[ ${#mirror_cfg[@]} -eq 0 ]] && exit 1
+  echo "=> unable to update submodules from mirrors; trying upstream"
+  git submodule update "${submodule_args[@]}" || exit 1
+fi
+${phase} end submodule-update
 
 
-# parse build and install sections from our spec file.
-# We will use the resulting scripts instead of running commands ourselves.
-# This way we can ensure some sustainability across versions, as long as the
-# resulting output is still compatible. *fingers crossed*
+# parse the spec file, adjusted for our purposes, for the build and install
+# sections, and for what needs to happen on the final image. We will use the
+# resulting scripts instead of running commands ourselves. This way we can
+# ensure some sustainability across versions, as long as the resulting output
+# is still compatible. *fingers crossed*
+#
+# The parsed spec is cached, keyed on the spec's contents and release, so the
+# spec is only expanded when it changes.
 #
-parse_spec=/build/bin/parse-spec-section.sh
-${parse_spec} ceph.spec.builder build > /build/src/cab-make.sh
-
 # there are a bunch of commands we need to perform after installing the sources,
 # and those live in the specfile's install section. However, we don't want to
 # install using the specfile's 'make' instruction -- we want to do that
-# ourselves. As such, parse what we need, but drop the make instruction.
+# ourselves. As such, the parsed install section drops the make instruction.
 #
-${parse_spec} ceph.spec.builder install |
-  grep -v '.*make.*DESTDIR' > /build/out/post-make-install.sh
+spec_out=$(mktemp -d) || exit 1
+${phase} start spec-generation
+python3 /build/cab/spec.py --cache-dir /build/spec-cache \
+  --output-dir ${spec_out} /build/src || exit 1
+${phase} end spec-generation
+
+# the build script is kept out of the sources, which may be shared with other
+# builds.
+cab_make=${spec_out}/cab-make.sh
+cp ${spec_out}/build.sh ${cab_make} || exit 1
+cp ${spec_out}/install.sh /build/out/post-make-install.sh || exit 1
+
+# the build section both configures and compiles; mark the point where the
+# first make is run, so we can tell both phases apart.
+#
+awk -v phase="${phase}" '
+  !marked && prev !~ /\\$/ && /(^|[ \/])make( |$)/ {
+    print phase " end configure"; print phase " start compile"; marked=1
+  }
+  { print; prev = $0 }' ${cab_make} > ${cab_make}.tmp || exit 1
+mv ${cab_make}.tmp ${cab_make}
 
 # perform the build stage
 #
-bash ./cab-make.sh || exit 1
-rm ./cab-make.sh # we no longer need it
+# for make builds, have make run recipes through a shell recording how long
+# each target takes. ninja keeps its own log.
+#
+make_timing_flags=""
+[[ -n "${CAB_TIMING_LOG}" ]] && \
+  make_timing_flags="SHELL=/build/bin/cab-make-shell.sh"
+
+${phase} start configure
+MAKEFLAGS="${MAKEFLAGS} ${make_timing_flags}" bash ${cab_make} || exit 1
+${phase} end configure
+${phase} end compile
 
 # move on to the install stage.
 # This is customized, and based on the actual install stage described in the
@@ -97,19 +185,38 @@ if ! $do_with_debug ; then
   install_type="install/strip"
 fi
 
+${phase} start install
 make ${build_args} DESTDIR=/build/out $install_type || exit 1
+${phase} end install
 
 popd
 
+# the cached frontend goes straight into the install tree, replacing whatever
+# stale 'dist' the sources had; not into the sources, where it would be taken
+# for a change by 'cab watch'.
+#
+if [[ -n "${CAB_FRONTEND_CACHE}" ]]; then
+  frontend_out=/build/out/usr/share/ceph/mgr/dashboard/frontend
+  ${phase} start frontend-cache
+  mkdir -p ${frontend_out} || exit 1
+  rm -fr ${frontend_out}/dist || exit 1
+  cp -a ${CAB_FRONTEND_CACHE}/dist ${frontend_out}/dist || exit 1
+  ${phase} end frontend-cache
+fi
+
 # run all the post make install instructions. These will create needed files,
 # set given permissions, and install some files onto specific locations.
 #
+${phase} start post-install
 bash /build/out/post-make-install.sh || exit 1
 rm /build/out/post-make-install.sh
 
-# Generate a set of instructions that we need to run after installing the files
-# onto their final destination, in the final image. These would be run during
-# the preinstall phase of package installation.
+# Keep the set of instructions that we need to run after installing the files
+# onto their final destination, in the image. These would be run during the
+# preinstall phase of package installation. Permissions and ownership are kept
+# apart, and applied by cab while transferring the files into the image.
 #
-/build/bin/parse-spec-post-install.sh \
-    /build/src/ceph.spec.builder > /build/out/post-install.sh
+cp ${spec_out}/post-install.sh /build/out/post-install.sh || exit 1
+cp ${spec_out}/attrs.json /build/out/post-install-attrs.json || exit 1
+rm -fr ${spec_out}
+${phase} end post-install
@@ -1,25 +1,22 @@
 #!/bin/bash
 
-bindir=${BINDIR:-/build/bin}
+cabdir=${CABDIR:-/build/cab}
+spec_cache=${SPEC_CACHE:-/build/spec-cache}
 
-[[ ! -e "${bindir}/generate-builder-spec.sh" ]] && \
-  echo "error: can't find specfile generator script" && \
+[[ ! -e "${cabdir}/spec.py" ]] && \
+  echo "error: can't find spec parser" && \
   exit 1
 
-bash ${bindir}/generate-builder-spec.sh || exit 1
+spec_out=$(mktemp -d) || exit 1
+python3 ${cabdir}/spec.py --cache-dir ${spec_cache} \
+  --output-dir ${spec_out} . || exit 1
 
-requirements=($(rpmspec --parse ceph.spec.builder |
-  sed -n 's/^Requires:[ ]\+\([-_a-zA-Z0-9]\+\).*/\1/p' |
-  sort | uniq |
-  grep -v 'ceph\|rados\|rgw\|rbd'))
-
-recommended=($(rpmspec --parse ceph.spec.builder |
-  sed -n 's/^Recommends:[ ]\+\([-_a-zA-Z0-9]\+\).*/\1/p' |
-  sort | uniq |
-  grep -v 'ceph\|rados\|rgw\|rbd'))
+# both 'Requires' and 'Recommends' packages, minus those we build ourselves.
+requirements=($(cat ${spec_out}/requirements.txt))
+rm -fr ${spec_out}
 
 if [[ -n "${DRYRUN}" ]]; then
-  echo ${requirements[*]} ${recommended[*]}
+  echo ${requirements[*]}
 else
-  zypper install -y ${requirements[*]} ${recommended[*]}
-fi
\ No newline at end of file
+  zypper install -y ${requirements[*]}
+fi
@@ -0,0 +1,240 @@
+import errno
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from .utils import CABError, BUILD_DIR_NAMES, run_cmd
+from .config import Config
+from .container_image import ContainerImage
+from .podman import Podman
+from .trace import Trace
+
+
+class ArtifactCacheError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+class SourceIdentity:
+    """ What an install tree, and the images made from it, were built from:
+        the sources' HEAD, what changed on top of it, if anything, and how
+        they were built, i.e. the vendor, release and builder image, and
+        whether with debug and tests.
+
+        Install trees keep theirs in 'MARKER', written once built, and images
+        carry theirs as labels, so builds of the same sources can be found.
+    """
+
+    VERSION: int = 1
+    MARKER: str = ".cab-identity.json"
+    LABEL: str = "cab.identity"
+    CHUNK_SIZE: int = 1024 * 1024
+
+    _sha: str
+    _dirty: Optional[str]
+    _vendor: str
+    _release: str
+    _builder: str
+    _debug: bool
+    _tests: bool
+
+    def __init__(self, sha: str, dirty: Optional[str], vendor: str,
+                 release: str, builder: str, debug: bool, tests: bool):
+        self._sha = sha
+        self._dirty = dirty
+        self._vendor = vendor
+        self._release = release
+        self._builder = builder
+        self._debug = debug
+        self._tests = tests
+
+    @classmethod
+    def _get_dirty_state(cls, sources: str) -> Tuple[bool, Optional[str]]:
+        """ Whether what changed on top of HEAD, submodules included, and
+            untracked files not ignored, other than build directories, could
+            be told; and, if so, a hash of it, or None if nothing changed.
+        """
+        h = hashlib.sha256()
+        changed = False
+        proc = Trace.run(
+            ["git", "-C", sources, "diff", "--binary", "--submodule=diff",
+             "HEAD"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if proc.returncode != 0:
+            return False, None
+        if len(proc.stdout) > 0:
+            h.update(proc.stdout)
+            changed = True
+        proc = Trace.run(
+            ["git", "-C", sources, "ls-files", "-z", "--others",
+             "--exclude-standard"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if proc.returncode != 0:
+            return False, None
+        try:
+            for name in sorted(proc.stdout.split(b'\0')):
+                top = os.fsdecode(name).split('/')[0]
+                if any([fnmatch.fnmatch(top, x) for x in BUILD_DIR_NAMES]):
+                    continue
+                path = os.path.join(sources, os.fsdecode(name))
+                if len(name) == 0 or not os.path.isfile(path):
+                    continue
+                with open(path, 'rb') as fd:
+                    size = os.fstat(fd.fileno()).st_size
+                    h.update(name + b'\0' + str(size).encode() + b'\0')
+                    while True:
+                        data = fd.read(cls.CHUNK_SIZE)
+                        if len(data) == 0:
+                            break
+                        h.update(data)
+                changed = True
+        except OSError:
+            return False, None
+        return True, h.hexdigest() if changed else None
+
+    @classmethod
+    def from_sources(cls, sources: str, vendor: str, release: str,
+                     builder: str, debug: bool,
+                     tests: bool) -> Optional['SourceIdentity']:
+        """ Identity of the sources at 'sources'; None if it can't be told,
+            e.g. not a git tree, or git failing on it.
+        """
+        ret, stdout, _ = run_cmd(f"git -C {sources} rev-parse HEAD")
+        if ret != 0 or len(stdout) == 0:
+            return None
+        sha: str = stdout[0].strip()
+        known, dirty = cls._get_dirty_state(sources)
+        if not known:
+            return None
+        return SourceIdentity(sha, dirty, vendor, release, builder,
+                              debug, tests)
+
+    @property
+    def sha(self) -> str:
+        return self._sha
+
+    @property
+    def is_dirty(self) -> bool:
+        return self._dirty is not None
+
+    @property
+    def key(self) -> str:
+        h = hashlib.sha256()
+        h.update(json.dumps(self.to_dict(), sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, SourceIdentity) and self.key == other.key
+
+    def __str__(self) -> str:
+        dirty = f"+{self._dirty[:12]}" if self._dirty is not None else ""
+        flags = [f for f, on in (("debug", self._debug),
+                                 ("tests", self._tests)) if on]
+        return f"{self._sha[:12]}{dirty}" + \
+            (f" ({', '.join(flags)})" if len(flags) > 0 else "")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'version': self.VERSION,
+            'sha': self._sha,
+            'dirty': self._dirty,
+            'vendor': self._vendor,
+            'release': self._release,
+            'builder': self._builder,
+            'debug': self._debug,
+            'tests': self._tests
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> Optional['SourceIdentity']:
+        if d.get('version') != cls.VERSION:
+            return None
+        return SourceIdentity(d['sha'], d['dirty'], d['vendor'],
+                              d['release'], d['builder'], d['debug'],
+                              d['tests'])
+
+    def get_labels(self) -> List[Tuple[str, str]]:
+        return [
+            (self.LABEL, self.key),
+            ("cab.source.sha", self._sha),
+            ("cab.source.dirty", self._dirty or "no"),
+            ("cab.flags.debug", str(self._debug).lower()),
+            ("cab.flags.tests", str(self._tests).lower())
+        ]
+
+    @classmethod
+    def read(cls, install_path: Path) -> Optional['SourceIdentity']:
+        """ Identity of what the install tree at 'install_path' was last
+            successfully built from, if known.
+        """
+        path = install_path.joinpath(cls.MARKER)
+        try:
+            return cls.from_dict(json.loads(path.read_text()))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write(self, install_path: Path) -> None:
+        path = install_path.joinpath(self.MARKER)
+        path.write_text(json.dumps(self.to_dict()) + '\n')
+
+    @classmethod
+    def invalidate(cls, install_path: Path) -> None:
+        """ The install tree is about to change; its identity is unknown. """
+        install_path.joinpath(cls.MARKER).unlink(missing_ok=True)
+
+
+class ArtifactCache:
+    """ Finds what builds with the same identity already built, install
+        trees or images, so they can be reused instead of built again.
+    """
+
+    _config: Config
+
+    def __init__(self, config: Config):
+        self._config = config
+
+    def find_install(self, identity: SourceIdentity,
+                     exclude: Optional[str] = None
+                     ) -> Optional[Tuple[str, Path]]:
+        """ A build, other than 'exclude', whose install tree was built from
+            'identity', and the tree's path.
+        """
+        installs = self._config.get_installs_dir()
+        for name in sorted(self._config.get_builds()):
+            if name == exclude:
+                continue
+            path = installs.joinpath(name)
+            if SourceIdentity.read(path) == identity:
+                return name, path
+        return None
+
+    def find_image(self,
+                   identity: SourceIdentity) -> Optional[ContainerImage]:
+        """ The most recent image built from 'identity', if any. Raw images
+            carry the same labels, but aren't what builds are run from.
+        """
+        images = [img for img in Podman.get_images(
+            f"--filter label={SourceIdentity.LABEL}={identity.key}")
+            if any([not n.tag.endswith("-raw") for n in img.names])]
+        if len(images) == 0:
+            return None
+        return max(images, key=lambda img: img.created)
+
+    @classmethod
+    def clone_install(cls, src: Path, dst: Path) -> None:
+        """ Replace the install tree at 'dst' with a copy of 'src'; files
+            share their extents, where the filesystem allows.
+        """
+        tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+        ret, _, stderr = run_cmd(f"cp -a --reflink=auto {src} {tmp}")
+        if ret != 0:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise ArtifactCacheError(
+                errno.EIO, f"unable to copy {src}: {' '.join(stderr)}")
+        if dst.exists():
+            shutil.rmtree(dst)
+        tmp.rename(dst)
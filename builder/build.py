@@ -1,17 +1,34 @@
 import click
-import sys
+import errno
+import json
 import shlex
 import subprocess
 import shutil
 import os
+import select
+import tempfile
+import threading
 from pathlib import Path
 from datetime import datetime as dt
-from typing import Tuple, List, Optional
+from typing import Dict, Tuple, List, Optional
 from .config import Config, UnknownBuildError
-from .utils import print_tree, print_table, pwarn, pinfo, pokay, perror
+from .utils import print_tree, print_table, pwarn, pinfo, pokay, perror, \
+    sizeof_fmt
 from .buildah import Buildah
 from .container_image import ContainerImage, ContainerImageName
 from .images import Images
+from .ccache import CCacheRemoteStorage
+from .stats import BuildTimer, BuildHistory
+from .profile import BuildProfile, ProfileStore
+from .ownership import get_managed_files
+from .mirror import MirrorCache
+from .compression import ImageCompression
+from .gc import GCResult, ImageGC, RetentionPolicy
+from .trace import Trace
+from .frontend import FrontendCache, FrontendCacheError
+from .artifacts import ArtifactCache, ArtifactCacheError, SourceIdentity
+from .buildlog import BuildLog, BuildLogStore, BuildLogWriter, BuildOutput, \
+    print_first_error
 
 
 def cprint(prefix: str, suffix: str):
@@ -30,6 +47,10 @@ class ContainerBuildError(Exception):
     pass
 
 
+class BuildCancelledError(Exception):
+    pass
+
+
 def raise_build_error(retcode: int, msg=None):
     err_msg = f"error: {os.strerror(retcode)}"
     if msg:
@@ -48,14 +69,46 @@ class Build:
     _with_debug: bool = False
     _with_tests: bool = False
 
+    # where the build's objects live, if not at the sources' 'build/'.
+    _build_dir: Optional[str] = None
+    _build_dir_tmpfs: Optional[str] = None
+    _build_dir_persist: bool = False
+
+    # overrides the registry's compression, when pushing this build's images.
+    _image_compression: Optional[ImageCompression] = None
+
+    # overrides the global retention policy for this build's images.
+    _retention: Optional[RetentionPolicy] = None
+
+    _timer: BuildTimer
+
+    # once set, the build is stopped as soon as possible.
+    _cancel: Optional[threading.Event] = None
+    CANCEL_POLL_SECS: float = 0.5
+
+    # parts of the install tree that don't make it into images.
+    IMAGE_EXCLUDES: List[str] = [
+        "usr/share/ceph/mgr/dashboard/frontend/node_modules",
+        "usr/share/ceph/mgr/dashboard/frontend/src",
+        "/post-install.sh",
+        "/post-install-attrs.json",
+        f"/{SourceIdentity.MARKER}"
+    ]
+
+    # python trees in the install tree, byte-compiled within images.
+    PYTHON_TREES: List[str] = [
+        "usr/share/ceph/mgr",
+        "usr/lib/python3*/site-packages",
+        "usr/lib64/python3*/site-packages"
+    ]
+
     def __init__(self, config: Config, name: str):
         self._config = config
         self._name = name
+        self._timer = BuildTimer()
         self._read_config()
 
     def _read_config(self):
-        if not self._config.build_exists(self._name):
-            raise UnknownBuildError(self._name)
         build_config = self._config.get_build_config(self._name)
         assert build_config is not None
         assert 'name' in build_config
@@ -72,10 +125,38 @@ class Build:
                 self._with_debug = build_config['build']['debug']
             if 'tests' in build_config['build']:
                 self._with_tests = build_config['build']['tests']
+            if 'build-dir' in build_config['build']:
+                build_dir = build_config['build']['build-dir']
+                self._build_dir = build_dir.get('path')
+                self._build_dir_tmpfs = build_dir.get('tmpfs')
+                self._build_dir_persist = build_dir.get('persist', False)
+        if 'image' in build_config and \
+                'compression' in build_config['image']:
+            self._image_compression = ImageCompression.from_dict(
+                build_config['image']['compression'])
+        if 'gc' in build_config:
+            self._retention = RetentionPolicy.from_dict(build_config['gc'])
+
+    @classmethod
+    def get_variants_of(cls, config: Config, sources: str,
+                        exclude: Optional[str] = None) -> List[str]:
+        """ Builds sharing the sources at 'sources'. """
+        return [name for name in config.get_builds_with_sources(sources)
+                if name != exclude]
+
+    @classmethod
+    def get_variant_build_dir(cls, sources: str, name: str) -> str:
+        """ Variants keep their objects apart, next to the shared 'build/'.
+        """
+        return str(Path(sources).joinpath(f"build.{name}"))
 
     @classmethod
     def create(cls, config, name, vendor, release, sources,
-               with_debug=False, with_tests=False):
+               with_debug=False, with_tests=False,
+               build_dir: Optional[str] = None,
+               build_dir_tmpfs: Optional[str] = None,
+               build_dir_persist: bool = False,
+               image_compression: Optional[ImageCompression] = None):
         conf_dict = {
             'name': name,
             'vendor': vendor,
@@ -86,6 +167,16 @@ class Build:
                 'tests': with_tests
             }
         }
+        if build_dir is not None or build_dir_tmpfs is not None:
+            conf_dict['build']['build-dir'] = {
+                'path': build_dir,
+                'tmpfs': build_dir_tmpfs,
+                'persist': build_dir_persist
+            }
+        if image_compression is not None:
+            conf_dict['image'] = {
+                'compression': image_compression.to_dict()
+            }
         config.write_build_config(name, conf_dict)
         return Build(config, name)
 
@@ -107,17 +198,91 @@ class Build:
     def get_sources_dir(self) -> Optional[str]:
         return self._sources
 
+    def get_build_dir_path(self) -> Optional[Path]:
+        """ Where the build's objects are kept on the host, if anywhere.
+
+            Builds on a tmpfs, not persisted to disk, have none.
+        """
+        if self._build_dir_tmpfs is not None:
+            if self._build_dir is None or not self._build_dir_persist:
+                return None
+            return Path(self._build_dir)
+        elif self._build_dir is not None:
+            return Path(self._build_dir)
+        assert self._sources
+        return Path(self._sources).joinpath("build")
+
+    def _get_build_dir_str(self) -> str:
+        path = self.get_build_dir_path()
+        if self._build_dir_tmpfs is None:
+            return str(path)
+        desc = f"tmpfs ({self._build_dir_tmpfs})"
+        if path is not None and self._build_dir_persist:
+            desc += f", persisted to {path}"
+        return desc
+
+    def _get_build_dir_podman_args(self) -> str:
+        """ Mount the build directory over the sources' 'build/'. """
+        if self._build_dir_tmpfs is not None:
+            args = f"--mount type=tmpfs,destination=/build/src/build," \
+                   f"tmpfs-size={self._build_dir_tmpfs},tmpfs-mode=1777 " \
+                   f"-e CAB_BUILD_DIR_MOUNTED=1 -e CAB_BUILD_DIR_TMPFS=1"
+            if self._build_dir is not None and self._build_dir_persist:
+                args += f" -v {self._build_dir}:/build/build-persist" \
+                        f" -e CAB_BUILD_DIR_PERSIST=/build/build-persist"
+            return args
+        elif self._build_dir is not None:
+            return f"-v {self._build_dir}:/build/src/build " \
+                   f"-e CAB_BUILD_DIR_MOUNTED=1"
+        return ""
+
+    def get_image_compression(self) -> Optional[ImageCompression]:
+        if self._image_compression is not None:
+            return self._image_compression
+        return self._config.get_registry_compression()
+
+    def get_retention_policy(self) -> RetentionPolicy:
+        if self._retention is not None:
+            return self._retention
+        return self._config.get_retention_policy()
+
+    def set_retention_policy(self, policy: Optional[RetentionPolicy]):
+        build_config = self._config.get_build_config(self._name)
+        if policy is None:
+            build_config.pop('gc', None)
+        else:
+            build_config['gc'] = policy.to_dict()
+        self._config.write_build_config(self._name, build_config)
+        self._retention = policy
+
+    def collect_images(self, policy: Optional[RetentionPolicy] = None,
+                       dry_run: bool = False) -> GCResult:
+        if policy is None:
+            policy = self.get_retention_policy()
+        images = Images.find_build_images(self._name)
+        return ImageGC.collect(self._name, images, policy, dry_run=dry_run)
+
+    def get_variants(self) -> List[str]:
+        assert self._sources
+        return Build.get_variants_of(self._config, self._sources,
+                                     exclude=self._name)
+
     def print(self, with_prefix=False, verbose=False):
+        variants = ', '.join(self.get_variants())
         tree = [
             ('buildname', self._name, [
                 ('vendor', self._vendor),
                 ('release', self._release),
                 ('sources', self._sources),
+                ('variants', variants if len(variants) > 0 else None),
                 ('install', self.get_install_dir()),
                 ('build', '', [
                     ('with debug', self.with_debug),
-                    ('with tests', self.with_tests)
-                ])
+                    ('with tests', self.with_tests),
+                    ('build dir', self._get_build_dir_str())
+                ]),
+                ('image compression', self.get_image_compression()),
+                ('image retention', self.get_retention_policy())
             ])
         ]
         print_tree(tree)
@@ -161,6 +326,8 @@ class Build:
             break
         if not success:
             return False
+        # a build re-created with the same name starts with no history.
+        BuildHistory(self._config.get_history_dir()).remove(self._name)
         return self._config.remove_build(self._name)
 
     @classmethod
@@ -172,10 +339,16 @@ class Build:
 
     @classmethod
     def build(cls, config: Config, name: str, nuke_install=False,
-              with_fresh_build=False):
+              with_fresh_build=False, ccache_remote_read_only=False,
+              timer: Optional[BuildTimer] = None, wait_push=False,
+              quiet=False, cancel: Optional[threading.Event] = None,
+              with_image=True):
         if not config.build_exists(name):
             raise UnknownBuildError(name)
         build = Build(config, name)
+        if timer is not None:
+            build._timer = timer
+        build._cancel = cancel
 
         # nuke an existing build install directory; force reinstall.
         if nuke_install:
@@ -187,12 +360,30 @@ class Build:
                 assert install_path.is_dir()
                 shutil.rmtree(install_path)
 
-        build._build(with_fresh_build=with_fresh_build)
+        success = False
+        try:
+            build._build(do_container=with_image,
+                         with_fresh_build=with_fresh_build,
+                         ccache_remote_read_only=ccache_remote_read_only,
+                         wait_push=wait_push, quiet=quiet)
+            success = True
+        finally:
+            flags = {
+                'debug': build.with_debug,
+                'tests': build.with_tests,
+                'fresh_build': with_fresh_build,
+                'nuke_install': nuke_install
+            }
+            history = BuildHistory(config.get_history_dir())
+            history.record_run(name, build._timer, build._sources,
+                               flags, success)
 
     def _build(self, do_build=True, do_container=True,
-               with_fresh_build=False):
+               with_fresh_build=False, ccache_remote_read_only=False,
+               wait_push=False, quiet=False):
 
         ccache_path: Path = None
+        ccache_remote: Optional[CCacheRemoteStorage] = None
         install_path: Path = None
 
         # prepare ccache
@@ -203,28 +394,136 @@ class Build:
                 ccache_path.mkdir(parents=True, exist_ok=True)
                 ccache_size = self._config.get_ccache_size()
                 cmd = f'ccache -M {ccache_size}'
-                subprocess.run(
+                Trace.run(
                     shlex.split(cmd),
                     env={'CCACHE_DIR': str(ccache_path)}
                 )
 
+            # remote storage is only meaningful alongside a local ccache.
+            ccache_remote = self._config.get_ccache_remote()
+            if ccache_remote is not None and ccache_remote_read_only:
+                ccache_remote = ccache_remote.as_role(read_only=True)
+
         # prepare output build directory
         install_path = self.get_install_path()
         install_path.mkdir(exist_ok=True)
 
+        # builds of the same sources, built the same way, are reused rather
+        # than built again; unless asked for a fresh build.
+        reuse = not with_fresh_build
         if do_build:
-            if not self._perform_build(install_path, ccache_path,
-                                       with_fresh_build):
-                raise BuildError()
+            identity: Optional[SourceIdentity] = None
+            reused = False
+            with self._timer.phase("artifact-cache"):
+                identity = self._get_source_identity()
+                if identity is not None and reuse:
+                    reused = self._reuse_install(identity, install_path)
+            if not reused:
+                SourceIdentity.invalidate(install_path)
+                if not self._perform_build(install_path, ccache_path,
+                                           with_fresh_build,
+                                           ccache_remote=ccache_remote,
+                                           quiet=quiet):
+                    raise BuildError()
+                if identity is not None:
+                    self._record_source_identity(identity, install_path)
+
+        if self._is_cancelled():
+            raise BuildCancelledError()
 
         if do_container:
-            if not self._build_container(install_path):
+            with self._timer.phase("artifact-cache"):
+                reused = reuse and self._reuse_image(install_path)
+            if not reused and not self._build_container(install_path):
                 raise ContainerBuildError()
+            if self.get_retention_policy().auto:
+                with self._timer.phase("gc"):
+                    self._auto_collect_images()
             if self._config.has_registry():
-                self._push_to_registry()
+                with self._timer.phase("push"):
+                    self._push_to_registry(wait=wait_push)
+
+    def _get_source_identity(self) -> Optional[SourceIdentity]:
+        assert self._sources
+        assert self._vendor
+        assert self._release
+        img: Optional[ContainerImage] = \
+            Images.find_builder_image(self._vendor, self._release)
+        if img is None:
+            return None
+        return SourceIdentity.from_sources(self._sources, self._vendor,
+                                           self._release, img.hashid,
+                                           self._with_debug,
+                                           self._with_tests)
+
+    def _record_source_identity(self, identity: SourceIdentity,
+                                install_path: Path) -> None:
+        """ Have the install tree tell what it was built from; unless the
+            sources changed while building, in which case it's not known.
+        """
+        with self._timer.phase("artifact-cache"):
+            current = self._get_source_identity()
+        if current != identity:
+            pwarn("=> sources changed while building; not reusable")
+            return
+        identity.write(install_path)
+
+    def _reuse_install(self, identity: SourceIdentity,
+                       install_path: Path) -> bool:
+        """ Reuse an install tree built from 'identity', ours or another
+            build's, instead of building it again.
+        """
+        if SourceIdentity.read(install_path) == identity:
+            pinfo(f"=> install tree already built from {identity}")
+            return True
+        cache = ArtifactCache(self._config)
+        found = cache.find_install(identity, exclude=self._name)
+        if found is None:
+            return False
+        name, path = found
+        pinfo(f"=> reusing install tree of build '{name}', "
+              f"built from {identity}")
+        try:
+            ArtifactCache.clone_install(path, install_path)
+        except ArtifactCacheError as e:
+            pwarn(f"=> {str(e)}")
+            return False
+        return True
+
+    def _reuse_image(self, install_path: Path) -> bool:
+        """ Reuse an image made from what the install tree was built from,
+            ours or another build's, instead of creating it again. Others'
+            are committed as ours, sharing their layers, so they are
+            collected and synced to as ours.
+        """
+        identity = SourceIdentity.read(install_path)
+        if identity is None:
+            return False
+        image = ArtifactCache(self._config).find_image(identity)
+        if image is None:
+            return False
+        build_name = Images.get_build_name(self._name)
+        if any([n.repository == "cab-builds" and n.name == self._name and
+                n.tag == "latest" for n in image.names]):
+            pinfo(f"=> image already built from {identity} "
+                  f"({image.short_hashid})")
+            return True
+
+        pinfo(f"=> reusing image {image.short_hashid}, built from {identity}")
+        image_date = dt.now().strftime("%Y%m%dT%H%M%SZ")
+        with Buildah(image.hashid, owner=self._name) as working_container:
+            working_container.set_label("cab.build", self._name)
+            hashid: str = working_container.commit(build_name, image_date)
+            assert working_container.is_committed()
+            working_container.tag("latest")
+        pokay("=> created container image {}:{} ({})".format(
+            build_name, image_date, hashid[:12]))
+        return True
 
     def _perform_build(self, install_path: Path, ccache_path: Path,
-                       with_fresh_build: bool
+                       with_fresh_build: bool,
+                       ccache_remote: Optional[CCacheRemoteStorage] = None,
+                       quiet: bool = False
                        ) -> bool:
         """ Performs the actual, containerized build from specified sources.
 
@@ -237,6 +536,12 @@ class Build:
 
             ccache_path is the location for the vendor/release ccache.
 
+            ccache_remote is the ccache secondary storage backend, if any,
+            shared with other build hosts.
+
+            The build's output is kept in a compressed log, and only shown
+            as it goes unless quiet.
+
             with_debug will instruct the build script to build with debug
             symbols.
 
@@ -249,8 +554,10 @@ class Build:
             ("vendor", self._vendor),
             ("release", self._release),
             ("sources path", self._sources),
+            ("build dir", self._get_build_dir_str()),
             ("install path", install_path),
             ("ccache path", ccache_path),
+            ("ccache remote", self._get_ccache_remote_str(ccache_remote)),
             ("with debug", self._with_debug),
             ("with tests", self._with_tests)
         ]
@@ -265,6 +572,12 @@ class Build:
         build_image = img.get_real_name(self._vendor, self._release)
 
         bindir = Path.cwd().joinpath("bin")
+        cabdir = Path(__file__).parent
+        spec_cache = self._config.get_spec_cache_dir()
+        spec_cache.mkdir(parents=True, exist_ok=True)
+        build_dir_path = self.get_build_dir_path()
+        if build_dir_path is not None:
+            build_dir_path.mkdir(parents=True, exist_ok=True)
         extra_args = []
 
         if self.with_debug:
@@ -274,14 +587,60 @@ class Build:
         if with_fresh_build:
             extra_args.append("--fresh-build")
 
-        cmd = f"podman run -it --userns=keep-id " \
+        # the entrypoint reports the phases it goes through to a phase log,
+        # living in a directory we share with the container.
+        run_dir = tempfile.TemporaryDirectory(prefix="cab-run-")
+        phase_log = Path(run_dir.name).joinpath("phases")
+        # ninja keeps appending to its log; only this run's entries matter.
+        ninja_offset = BuildProfile.get_ninja_log_offset(build_dir_path)
+
+        cmd = f"podman run --userns=keep-id " \
               f"-v {bindir}:/build/bin " \
+              f"-v {cabdir}:/build/cab:ro " \
+              f"-v {spec_cache}:/build/spec-cache " \
               f"-v {self._sources}:/build/src " \
-              f"-v {str(install_path)}:/build/out"
+              f"-v {str(install_path)}:/build/out " \
+              f"-v {run_dir.name}:/build/run " \
+              f"-e CAB_PHASE_LOG=/build/run/phases " \
+              f"-e CAB_TIMING_LOG=/build/run/make-timings"
+
+        build_dir_args = self._get_build_dir_podman_args()
+        if len(build_dir_args) > 0:
+            cmd += f" {build_dir_args}"
+
+        # have submodules fetched from our mirrors, rather than upstream.
+        mirrors = MirrorCache(self._config.get_mirrors_dir())
+        mirror_config: List[str] = mirrors.get_git_config()
+        if len(mirror_config) > 0:
+            Path(run_dir.name).joinpath("git-mirrors").write_text(
+                '\n'.join(mirror_config) + '\n')
+            cmd += f" -v {mirrors.path}:{MirrorCache.CONTAINER_PATH}:ro"
+        # sources cloned with a mirror's objects find them, through git's
+        # alternates, at the mirror's path on the host.
+        if mirrors.path.exists():
+            cmd += f" -v {mirrors.path}:{mirrors.path}:ro"
+
+        # skip building the dashboard's frontend, if we have it already.
+        assert self._sources
+        frontend_cache = FrontendCache(self._config.get_frontend_cache_dir())
+        with self._timer.phase("frontend-cache"):
+            frontend_key: Optional[str] = \
+                FrontendCache.get_key(Path(self._sources), img.hashid)
+            frontend_path: Optional[Path] = None
+            if frontend_key is not None:
+                frontend_path = frontend_cache.get(frontend_key)
+        if frontend_path is not None:
+            assert frontend_key is not None
+            pinfo(f"=> using cached dashboard frontend "
+                  f"({frontend_key[:12]})")
+            cmd += f" -v {frontend_path}:/build/frontend-cache:ro " \
+                   f"-e CAB_FRONTEND_CACHE=/build/frontend-cache"
 
         if ccache_path is not None:
             cmd += f" -v {str(ccache_path)}:/build/ccache"
             extra_args.append("--with-ccache")
+            if ccache_remote is not None:
+                cmd += f" {ccache_remote.get_podman_args()}"
 
         # currently, the build image's entrypoint requires an argument to
         # perform a build using ccache.
@@ -291,16 +650,96 @@ class Build:
 
         # cprint("build cmd", cmd)
         # sys.exit(1)
-        proc = subprocess.run(
-                    shlex.split(cmd), stdout=sys.stdout, stderr=sys.stderr)
-        if proc.returncode != 0:
-            raise BuildError(os.strerror(proc.returncode))
+        logs = BuildLogStore(self._config.get_logs_dir())
+        try:
+            with logs.create(self._name) as log:
+                pinfo(f"=> build log at {log.path}")
+                ret = self._stream_build(shlex.split(cmd), log, quiet,
+                                         phase_log)
+        finally:
+            self._timer.read_phase_log(phase_log)
+            self._store_profile(Path(run_dir.name), build_dir_path,
+                                ninja_offset)
+            run_dir.cleanup()
+        if ret != 0:
+            if self._is_cancelled():
+                raise BuildCancelledError()
+            print_first_error(BuildLog(log.path))
+            raise BuildError(os.strerror(ret))
+        if frontend_key is not None and frontend_path is None:
+            self._store_frontend(frontend_cache, frontend_key)
         return True
 
+    def _store_frontend(self, cache: FrontendCache, key: str) -> None:
+        assert self._sources
+        try:
+            with self._timer.phase("frontend-cache"):
+                stored = cache.store(key, Path(self._sources))
+            if stored:
+                pinfo(f"=> cached dashboard frontend ({key[:12]})")
+        except FrontendCacheError as e:
+            pwarn(str(e))
+
+    def _is_cancelled(self) -> bool:
+        return self._cancel is not None and self._cancel.is_set()
+
+    def _stream_build(self, argv: List[str], log: BuildLogWriter,
+                      quiet: bool, phase_log: Path) -> int:
+        """ Run the build container, streaming its output through us, and
+            stopping it if the build is cancelled meanwhile.
+        """
+        output = BuildOutput(log, quiet=quiet, phase_log=phase_log)
+        proc = Trace.popen(argv, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        assert proc.stdout is not None
+        stopping = False
+        try:
+            while True:
+                if self._cancel is not None:
+                    ready, _, _ = select.select([proc.stdout], [], [],
+                                                self.CANCEL_POLL_SECS)
+                    if not stopping and self._cancel.is_set():
+                        # podman passes it on to the container.
+                        pwarn("=> build cancelled; stopping")
+                        proc.terminate()
+                        stopping = True
+                    if len(ready) == 0:
+                        continue
+                # unbuffered, so select() above sees all that's pending.
+                data = os.read(proc.stdout.fileno(), BuildLog.CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+                output.feed(data)
+            output.finish()
+        finally:
+            proc.stdout.close()
+            ret = proc.wait()
+        return ret
+
+    def _store_profile(self, run_dir: Path, build_dir: Optional[Path],
+                       ninja_offset: int) -> None:
+        try:
+            profile: Optional[BuildProfile] = \
+                BuildProfile.collect(build_dir, run_dir, ninja_offset)
+            if profile is None or len(profile.entries) == 0:
+                return
+            store = ProfileStore(self._config.get_profiles_dir())
+            store.store(self._name, profile)
+        except (OSError, ValueError) as e:
+            pwarn(f"unable to store build profile: {str(e)}")
+
+    def _get_ccache_remote_str(
+        self,
+        ccache_remote: Optional[CCacheRemoteStorage]
+    ) -> Optional[str]:
+        if ccache_remote is None:
+            return None
+        return f"{ccache_remote.url} ({ccache_remote.role})"
+
     def _run_cmd(self, cmd: str) -> Tuple[int, str, str]:
-        proc = subprocess.run(shlex.split(cmd),
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
+        proc = Trace.run(shlex.split(cmd),
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
         stdout = proc.stdout.decode("utf-8")
         stderr = proc.stderr.decode("utf-8")
         return proc.returncode, stdout, stderr
@@ -329,12 +768,15 @@ class Build:
 
         """Create raw container image, where our binaries will end up at.
 
-            Our binaries need an image without special permissions so that we
-            can incrementally move them. To this image we call a "raw image",
-            because it's still in its raw state, without permissions being set.
-
             These images are always based on previous raw images, or, in their
-            absense, a release image.
+            absense, a release image, so that we can incrementally move our
+            binaries onto them.
+
+            Users and groups from the spec's %pre scriptlets are created in one
+            go, and the spec's permissions and ownership are applied while
+            transferring our binaries, and only where they differ from what the
+            previous raw image already has. This way unchanged files are not
+            copied up into a new layer just to have their metadata adjusted.
         """
 
         assert self._vendor
@@ -356,41 +798,160 @@ class Build:
 
         # create working container (this is where our binaries will end up at).
         #
-        working_container: Buildah = Buildah(base_image)
-
-        # mount our working container, so we can transfer our binaries.
-        mnt_path: Path = working_container.mount()
-        assert mnt_path
-        assert mnt_path.is_dir()
-
-        exclude_dirs = [
-            "usr/share/ceph/mgr/dashboard/frontend/node_modules",
-            "usr/share/ceph/mgr/dashboard/frontend/src"
-        ]
-
-        excludes = ' '.join([f'--exclude {x}' for x in exclude_dirs])
-
-        # transfer binaries.
-        cmd = f"rsync --info=stats --update --recursive --links --perms "\
-              f"--group --owner --times {excludes} "\
-              f"{str(install_path)}/ {str(mnt_path)}"
-        ret, _, stderr = self._run_cmd(cmd)
+        with Buildah(base_image, owner=self._name) as working_container:
+            # mount our working container, so we can transfer our binaries.
+            mnt_path: Path = working_container.mount()
+            assert mnt_path
+            assert mnt_path.is_dir()
+
+            # raw images created by older versions carry the post-install
+            # script along, to be run on the final image.
+            mnt_path.joinpath("post-install.sh").unlink(missing_ok=True)
+
+            post_install_path = install_path.joinpath("post-install.sh")
+            attrs_path = install_path.joinpath("post-install-attrs.json")
+            attrs: List[Dict[str, str]] = []
+            if attrs_path.exists():
+                attrs = json.loads(attrs_path.read_text())
+
+            # create users and groups before the files they will own exist.
+            if post_install_path.exists():
+                with self._timer.phase("image-post-install"):
+                    ret, result = working_container.run(
+                        "bash -x /cab-post-install.sh",
+                        volumes=[(str(post_install_path),
+                                  "/cab-post-install.sh:ro")])
+                if ret != 0:
+                    raise_build_error(ret, result)
+
+            excludes = ' '.join([f'--exclude {x}' for x in
+                                 self.IMAGE_EXCLUDES])
+
+            # files with permissions set by the spec must not have their
+            # metadata reset to the install tree's, so they are transferred on
+            # their own.
+            managed_files = get_managed_files(attrs, install_path)
+
+            with tempfile.TemporaryDirectory(prefix="cab-rsync-") as tmpdir:
+                managed_list = Path(tmpdir).joinpath("managed")
+                managed_list.write_text(
+                    ''.join([f"{f}\n" for f in managed_files]))
+                managed_excludes = Path(tmpdir).joinpath("excludes")
+                managed_excludes.write_text(
+                    ''.join([f"/{f}\n" for f in managed_files]))
+
+                # transfer binaries.
+                cmd = f"buildah unshare rsync --info=stats --update "\
+                      f"--recursive --links --perms --group --owner "\
+                      f"--times {excludes} "\
+                      f"--exclude-from={managed_excludes} "\
+                      f"{str(install_path)}/ {str(mnt_path)}"
+                with self._timer.phase("rsync"):
+                    ret, _, stderr = self._run_cmd(cmd)
+                    if ret == 0 and len(managed_files) > 0:
+                        cmd = f"buildah unshare rsync --update --links "\
+                              f"--times --files-from={managed_list} "\
+                              f"{str(install_path)}/ {str(mnt_path)}"
+                        ret, _, stderr = self._run_cmd(cmd)
+                if ret != 0:
+                    raise_build_error(ret, stderr)
+
+            if len(attrs) > 0:
+                self._apply_ownership(attrs_path, mnt_path)
+
+            with self._timer.phase("pycompile"):
+                self._compile_python(working_container, install_path)
+
+            working_container.unmount()
+            # lets leftovers of this build's images be found once untagged.
+            working_container.set_label("cab.build", self._name)
+            # lets builds of the same sources find, and reuse, the image;
+            # raw images otherwise keep the labels of the one before.
+            identity = SourceIdentity.read(install_path)
+            if identity is not None:
+                for key, value in identity.get_labels():
+                    working_container.set_label(key, value)
+            else:
+                working_container.set_label(SourceIdentity.LABEL, "none")
+
+            image_date = dt.now().strftime("%Y%m%dT%H%M%SZ")
+            container_image_name = Images.get_build_name(self._name)
+            container_raw_image = f"{container_image_name}:{image_date}-raw"
+
+            with self._timer.phase("raw-commit"):
+                hashid: str = working_container.commit(
+                    container_image_name, f"{image_date}-raw")
+                assert working_container.is_committed()
+                working_container.tag("latest-raw")
+            pokay("=> created raw image {} ({})".format(
+                container_raw_image, hashid[:12]))
+            return image_date, container_raw_image
+
+    def _apply_ownership(self, attrs_path: Path, mnt_path: Path) -> None:
+        """ Apply the spec's permissions and ownership onto the mounted image,
+            within buildah's user namespace, against the image's own users.
+        """
+        script = Path(__file__).parent.joinpath("ownership.py")
+        cmd = f"buildah unshare python3 {script} {mnt_path} {attrs_path}"
+        with self._timer.phase("image-post-install"):
+            ret, stdout, stderr = self._run_cmd(cmd)
         if ret != 0:
             raise_build_error(ret, stderr)
-
-        working_container.unmount()
-
-        image_date = dt.now().strftime("%Y%m%dT%H%M%SZ")
-        container_image_name = Images.get_build_name(self._name)
-        container_raw_image = f"{container_image_name}:{image_date}-raw"
-
-        hashid: str = \
-            working_container.commit(container_image_name, f"{image_date}-raw")
-        assert working_container.is_committed()
-        working_container.tag("latest-raw")
-        pokay("=> created raw image {} ({})".format(
-            container_raw_image, hashid[:12]))
-        return image_date, container_raw_image
+        try:
+            result = json.loads(stdout.splitlines()[-1])
+        except (IndexError, json.JSONDecodeError):
+            raise_build_error(errno.EINVAL, f"bad ownership result: {stdout}")
+        for problem in result['problems']:
+            pwarn(f"=> permissions: {problem}")
+        pinfo("=> set permissions on {} of {} paths".format(
+            result['changed'], result['entries']))
+
+    def _get_python_sources(self, install_path: Path) -> List[str]:
+        excludes = [x.lstrip('/') for x in self.IMAGE_EXCLUDES]
+        sources: List[str] = []
+        for pattern in self.PYTHON_TREES:
+            for tree in install_path.glob(pattern):
+                for path in tree.rglob("*.py"):
+                    relpath = str(path.relative_to(install_path))
+                    if any([relpath.startswith(x) for x in excludes]):
+                        continue
+                    sources.append(f"/{relpath}")
+        return sorted(sources)
+
+    def _compile_python(self, working_container: Buildah,
+                        install_path: Path) -> None:
+        """ Byte-compile our python modules within the image, by its own
+            python, so daemons don't compile them on every start of a fresh,
+            or read-only, container.
+
+            Bytecode is hash-based, and only written where not current, so
+            unchanged modules don't end up in new layers. Not being able to
+            is only warned about.
+        """
+        sources = self._get_python_sources(install_path)
+        if len(sources) == 0:
+            return
+        script = Path(__file__).parent.joinpath("pycompile.py")
+        with tempfile.TemporaryDirectory(prefix="cab-pycompile-") as tmpdir:
+            sources_path = Path(tmpdir).joinpath("sources")
+            sources_path.write_text(''.join([f"{x}\n" for x in sources]))
+            ret, result = working_container.run(
+                "python3 /cab-pycompile.py /cab-pycompile-sources",
+                volumes=[(str(script), "/cab-pycompile.py:ro"),
+                         (str(sources_path), "/cab-pycompile-sources:ro")])
+        if ret != 0:
+            pwarn(f"=> unable to byte-compile python: {' '.join(result)}")
+            return
+        try:
+            summary = json.loads(result[-1])
+        except (IndexError, json.JSONDecodeError):
+            pwarn(f"=> bad byte-compile result: {' '.join(result)}")
+            return
+        pinfo("=> byte-compiled {} python modules, {} unchanged".format(
+            summary['compiled'], summary['unchanged']))
+        if summary['failed'] > 0:
+            pwarn(f"=> {summary['failed']} python modules failed to "
+                  f"compile, e.g. {summary['errors'][0]}")
 
     def _build_final_container_image(self,
                                      datestr: str,
@@ -398,51 +959,92 @@ class Build:
                                      ) -> str:
         # working_container = self._buildah_from(raw_image)
         # assert working_container and len(working_container) > 0
-        working_container: Buildah = Buildah(raw_image)
-
-        pinfo(f"=> creating final image from {raw_image}")
-        mnt_path: Path = working_container.mount()
-        assert mnt_path
-        assert mnt_path.is_dir()
-
-        # run post-install script
-        #  if present, will set permissions, create users and directories, etc.
-        post_install_path = mnt_path.joinpath('post-install.sh')
-        if post_install_path.exists():
-            ret, result = working_container.run("bash -x /post-install.sh")
+        with Buildah(raw_image, owner=self._name) as working_container:
+            pinfo(f"=> creating final image from {raw_image}")
+            mnt_path: Path = working_container.mount()
+            assert mnt_path
+            assert mnt_path.is_dir()
+
+            # raw images created by older versions still carry the
+            # post-install script, which sets permissions, creates users and
+            # directories, etc.
+            post_install_path = mnt_path.joinpath('post-install.sh')
+            if post_install_path.exists():
+                with self._timer.phase("image-post-install"):
+                    ret, result = \
+                        working_container.run("bash -x /post-install.sh")
+                if ret != 0:
+                    raise_build_error(ret, result)
+                post_install_path.unlink()
+
+            working_container.unmount()
+
+            container_build_image_name = Images.get_build_name(self._name)
+            container_final_image = f"{container_build_image_name}:{datestr}"
+
+            with self._timer.phase("final-commit"):
+                hashid: str = working_container.commit(
+                    container_build_image_name, datestr)
+                assert hashid and len(hashid) > 0
+                assert working_container.is_committed()
+                working_container.tag("latest")
+            pokay("=> created container image {} ({})".format(
+                container_final_image, hashid[:12]
+            ))
+            return container_final_image
+
+    def _auto_collect_images(self):
+        stale = Buildah.get_stale_containers()
+        if len(stale) > 0:
+            pinfo(f"=> gc: removing {len(stale)} stale working containers")
+            ret, err = Buildah.remove_containers([wc for wc, _ in stale])
             if ret != 0:
-                raise_build_error(ret, result)
-            post_install_path.unlink()
-
-        working_container.unmount()
-
-        container_build_image_name = Images.get_build_name(self._name)
-        container_final_image = f"{container_build_image_name}:{datestr}"
-
-        hashid: str = \
-            working_container.commit(container_build_image_name, datestr)
-        assert hashid and len(hashid) > 0
-        assert working_container.is_committed()
-        working_container.tag("latest")
-        pokay("=> created container image {} ({})".format(
-            container_final_image, hashid[:12]
-        ))
-        return container_final_image
-
-    def _push_to_registry(self):
-
-        latest_img: ContainerImage = \
+                pwarn(f"=> gc: {' '.join(err)}")
+        result = self.collect_images()
+        for err in result.errors:
+            pwarn(f"=> gc: {err}")
+        if len(result.expired) > 0 or result.removed_dangling > 0:
+            pinfo(f"=> gc: removed {len(result.expired)} old runs' images, "
+                  f"{result.removed_dangling} leftovers")
+
+    def _push_to_registry(self, wait: bool = False):
+        # not needed by most commands; keep it off cab's startup.
+        from .push import PushEntry, PushQueue
+
+        latest_img: Optional[ContainerImage] = \
             Images.find_build_image_latest(self._name)
-        latest_name: ContainerImageName = latest_img.get_latest_image_name()
+        if latest_img is None:
+            raise BuildError(f"unable to find latest image for {self._name}")
+        latest_name: Optional[ContainerImageName] = \
+            latest_img.get_latest_image_name()
+        if latest_name is None:
+            raise BuildError(f"unable to find latest image name for "
+                             f"{self._name}")
         img_name = f"{latest_name._repo}/{latest_name.name}:{latest_name.tag}"
+        repo = f"{latest_name._repo}/{latest_name.name}"
         registry_url = self._config.get_registry()
-        extra = ""
-        if not self._config.is_registry_secure():
-            extra = "--tls-verify=false"
-
-        cmd = f"podman push {extra} {img_name} {registry_url}/{img_name}"
-        pinfo(f"=> pushing {img_name} to {registry_url}")
-        proc = subprocess.run(shlex.split(cmd),
-                              stdout=sys.stdout, stderr=sys.stderr)
-        if proc.returncode != 0:
-            perror("error pushing to repository")
+        compression = self.get_image_compression()
+
+        queue = PushQueue(self._config.get_push_dir())
+        entry = PushEntry(self._name, img_name, repo, latest_name.tag,
+                          registry_url, self._config.is_registry_secure(),
+                          compression)
+        if queue.enqueue(entry):
+            pinfo("=> superseding this build's pending push")
+        pinfo(f"=> queued push of {img_name} to {registry_url}")
+        if compression is not None:
+            pinfo(f"=> compressing layers with {compression}")
+        queue.start_worker(self._config.get_registry_push_jobs())
+        if not wait:
+            pinfo("=> pushing in the background; see 'cab push status'")
+            return
+
+        result = queue.wait(self._name,
+                            self._config.get_registry_push_jobs())
+        if result is None or result.generation != entry.generation:
+            pwarn("=> push superseded by a newer one")
+        elif result.state == "failed":
+            perror(f"error pushing to repository: {result.error}")
+        else:
+            pokay(f"=> pushed {img_name} "
+                  f"({sizeof_fmt(result.uploaded_bytes)} uploaded)")
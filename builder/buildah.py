@@ -1,7 +1,10 @@
 import errno
+import json
+import os
+import re
 from pathlib import Path
 from typing import List, Tuple, Any, Optional
-from .utils import run_cmd, pdebug, CABError
+from .utils import run_cmd, pdebug, pwarn, CABError
 
 
 class BuildahError(CABError):
@@ -13,21 +16,53 @@ def raise_buildah_error(rc: int, msg: Any) -> None:
     raise BuildahError(rc, msg)
 
 
+def _is_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
 class Buildah:
+    """ A buildah working container.
+
+        Working containers are named after what they are being used for, and
+        the process using them, as 'cab-<owner>-<pid>-<seq>', so that those
+        left behind by processes gone can be found and removed. Use as a
+        context manager to have the working container removed, and unmounted
+        if need be, once done with it.
+    """
+
+    NAME_RE = re.compile(r'^cab-(?P<owner>.+)-(?P<pid>\d+)-(?P<seq>\d+)$')
+
+    _seq: int = 0
 
     _from: str
+    _owner: str
     _wc: Optional[str]  # working container
     _mount_path: Optional[Path] = None
     _committed: bool = False
     _hashid: Optional[str] = None
     _name: Optional[str] = None
 
-    def __init__(self, _from: str):
+    def __init__(self, _from: str, owner: str = "image"):
         self._from = _from
+        self._owner = re.sub(r'[^\w.-]', '_', owner)
         self._wc = None
         self._create()
         self._committed = False
 
+    def __enter__(self) -> 'Buildah':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.remove()
+
     def is_committed(self):
         return self._committed
 
@@ -49,8 +84,10 @@ class Buildah:
         assert self._from is not None
         assert len(self._from) > 0
 
-        self.debug(f"creating from {self._from}")
-        cmd = f"from {self._from}"
+        Buildah._seq += 1
+        name = f"cab-{self._owner}-{os.getpid()}-{Buildah._seq}"
+        self.debug(f"creating {name} from {self._from}")
+        cmd = f"from --name {name} {self._from}"
         ret, stdout, stderr = self._run(cmd)
         if ret != 0:
             raise_buildah_error(ret, stderr)
@@ -59,7 +96,8 @@ class Buildah:
         self._wc = stdout[0]
         assert self._wc and len(self._wc) > 0
 
-    def _run(self,
+    @classmethod
+    def _run(cls,
              cmd: str,
              capture_output: bool = True
              ) -> Tuple[int, List[str], List[str]]:
@@ -114,6 +152,48 @@ class Buildah:
             raise_buildah_error(ret, stderr)
         self._mount_path = None
 
+    def remove(self) -> None:
+        """ Remove the working container, unmounting it first if needed.
+            Failing to is only warned about, as we may be unwinding from an
+            error already.
+        """
+        if self._wc is None:
+            return
+        if self._mount_path is not None:
+            self._run(f"unmount {self._wc}")
+            self._mount_path = None
+        self.debug(f"removing working container {self._wc}")
+        ret, _, stderr = self._run(f"rm {self._wc}")
+        if ret != 0:
+            pwarn(f"unable to remove working container {self._wc}: "
+                  f"{' '.join(stderr)}")
+        self._wc = None
+
+    @classmethod
+    def get_stale_containers(cls) -> List[Tuple[str, str]]:
+        """ Working containers left behind by cab processes no longer
+            running, as (id, name).
+        """
+        ret, stdout, stderr = cls._run("containers --json")
+        if ret != 0:
+            raise_buildah_error(ret, stderr)
+        containers = json.loads('\n'.join(stdout) or "[]") or []
+        stale: List[Tuple[str, str]] = []
+        for entry in containers:
+            name = entry.get('containername', "")
+            m = cls.NAME_RE.match(name)
+            if m is None:
+                continue
+            if _is_alive(int(m.group('pid'))):
+                continue
+            stale.append((entry['id'], name))
+        return stale
+
+    @classmethod
+    def remove_containers(cls, ids: List[str]) -> Tuple[int, List[str]]:
+        ret, _, stderr = cls._run(f"rm {' '.join(ids)}")
+        return ret, stderr
+
     def commit(self, _name: str, _tag: str = None) -> str:
         name: str = _name if not _tag else f"{_name}:{_tag}"
         self.debug(f"committing working container {self._wc} as {name}")
@@ -0,0 +1,326 @@
+import errno
+import fcntl
+import re
+import sys
+import time
+import zlib
+from datetime import datetime as dt
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+from .utils import CABError, pinfo, pwarn
+
+
+class BuildLogError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+# compiler, linker and cmake errors; what the build failed on, most likely.
+ERROR_PATTERNS: List[re.Pattern] = [
+    re.compile(r'^\S+:\d+(:\d+)?: (fatal )?error: '),
+    re.compile(r'^\S+:(\d+:)? ?undefined reference to '),
+    re.compile(r'undefined reference to [`\']'),
+    re.compile(r'^(\S*/)?ld(\.\w+)?: (error: )?cannot find '),
+    re.compile(r'^collect2: error: '),
+    re.compile(r'^CMake Error'),
+]
+
+# how make and ninja report a failed target; only used if there is nothing
+# more specific to show.
+FAILURE_PATTERNS: List[re.Pattern] = [
+    re.compile(r'^FAILED: '),
+    re.compile(r'^make(\[\d+\])?: \*\*\* '),
+    re.compile(r'^ninja: build stopped'),
+]
+
+
+def find_first_error(lines: List[str], before: int = 3,
+                     after: int = 10) -> Optional[Tuple[int, List[str]]]:
+    """ The first error in 'lines', as its line number and the lines around
+        it, if any is found.
+    """
+    found: Optional[int] = None
+    fallback: Optional[int] = None
+    for idx, line in enumerate(lines):
+        if any([p.search(line) for p in ERROR_PATTERNS]):
+            found = idx
+            break
+        if fallback is None and any([p.search(line) for p in
+                                     FAILURE_PATTERNS]):
+            fallback = idx
+    if found is None:
+        found = fallback
+    if found is None:
+        return None
+    start = max(0, found - before)
+    return found + 1, lines[start:found + after + 1]
+
+
+class BuildLogWriter:
+    """ Writes a build's output to a gzip compressed log.
+
+        The stream is flushed every 'FLUSH_SECS', so that readers see the
+        output while the build runs; the log is locked while being written,
+        which is how readers tell whether the build is still running.
+    """
+
+    FLUSH_SECS: float = 1.0
+
+    _path: Path
+    _fd: Optional[BinaryIO]
+    _compressor: 'zlib._Compress'
+    _last_flush: float
+    _bytes: int
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._fd = None
+        # wbits=31 produces a gzip stream, readable with zcat.
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self._last_flush = time.time()
+        self._bytes = 0
+
+    def __enter__(self) -> 'BuildLogWriter':
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = self._path.open('wb')
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args) -> None:
+        assert self._fd is not None
+        self._fd.write(self._compressor.flush(zlib.Z_FINISH))
+        self._fd.close()
+        self._fd = None
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def bytes_written(self) -> int:
+        return self._bytes
+
+    def write(self, data: bytes) -> None:
+        assert self._fd is not None
+        self._bytes += len(data)
+        self._fd.write(self._compressor.compress(data))
+        now = time.time()
+        if now - self._last_flush >= self.FLUSH_SECS:
+            self._fd.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            self._fd.flush()
+            self._last_flush = now
+
+
+class BuildLog:
+    """ A build run's log, possibly still being written. """
+
+    POLL_SECS: float = 0.5
+    CHUNK_SIZE: int = 64 * 1024
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def run(self) -> str:
+        return self._path.name[:-len(".log.gz")]
+
+    def get_date(self) -> Optional[dt]:
+        try:
+            return dt.strptime(self.run, BuildLogStore.DATE_FORMAT)
+        except ValueError:
+            return None
+
+    def is_live(self) -> bool:
+        try:
+            with self._path.open('rb') as fd:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except OSError:
+                    return True
+        except FileNotFoundError:
+            pass
+        return False
+
+    def read(self, follow: bool = False) -> Iterator[bytes]:
+        """ Decompressed output, as it is available; following the log until
+            it is no longer written to, with 'follow'.
+        """
+        decompressor = zlib.decompressobj(31)
+        try:
+            fd = self._path.open('rb')
+        except FileNotFoundError:
+            raise BuildLogError(errno.ENOENT, str(self._path))
+        with fd:
+            while not decompressor.eof:
+                chunk = fd.read(self.CHUNK_SIZE)
+                if len(chunk) > 0:
+                    yield decompressor.decompress(chunk)
+                    continue
+                if not follow or not self.is_live():
+                    # one last read, for what was written meanwhile.
+                    chunk = fd.read()
+                    if len(chunk) > 0:
+                        yield decompressor.decompress(chunk)
+                    break
+                time.sleep(self.POLL_SECS)
+
+    def get_lines(self) -> List[str]:
+        data = b''.join(self.read())
+        return data.decode("utf-8", errors="replace").splitlines()
+
+    def find_first_error(self) -> Optional[Tuple[int, List[str]]]:
+        return find_first_error(self.get_lines())
+
+
+class BuildLogStore:
+    """ Build logs, kept at '<path>/<build>/<run>.log.gz', with the last
+        'MAX_RUNS' kept for each build.
+    """
+
+    DATE_FORMAT: str = "%Y%m%dT%H%M%SZ"
+    MAX_RUNS: int = 20
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    def get_runs(self, buildname: str) -> List[BuildLog]:
+        path = self._path.joinpath(buildname)
+        if not path.exists():
+            return []
+        return [BuildLog(p) for p in sorted(path.glob("*.log.gz"))]
+
+    def get_run(self, buildname: str,
+                run: Optional[str] = None) -> Optional[BuildLog]:
+        """ Build's run 'run', or its latest. """
+        runs = self.get_runs(buildname)
+        if len(runs) == 0:
+            return None
+        if run is None:
+            return runs[-1]
+        for log in runs:
+            if log.run == run:
+                return log
+        return None
+
+    def create(self, buildname: str) -> BuildLogWriter:
+        self.prune(buildname, self.MAX_RUNS - 1)
+        run = dt.now().strftime(self.DATE_FORMAT)
+        path = self._path.joinpath(buildname, f"{run}.log.gz")
+        return BuildLogWriter(path)
+
+    def prune(self, buildname: str, keep: int) -> None:
+        runs = self.get_runs(buildname)
+        for log in runs[:max(0, len(runs) - keep)]:
+            if log.is_live():
+                continue
+            log.path.unlink()
+
+
+class BuildOutput:
+    """ Streams a build's output to its log and, unless 'quiet', to the
+        terminal. Quietly, only the phases the build goes through, read from
+        its phase log, and its progress, every 'PROGRESS_SECS', are shown.
+    """
+
+    PHASE_SECS: float = 1.0
+    PROGRESS_SECS: float = 10.0
+    NINJA_PROGRESS = re.compile(rb'^\[(\d+)/(\d+)\] ')
+    MAKE_PROGRESS = re.compile(rb'^\[\s*(\d+)%\] ')
+
+    _writer: BuildLogWriter
+    _quiet: bool
+    _phase_log: Optional[Path]
+    _phase_offset: int
+    _partial: bytes
+    _progress: Optional[str]
+    _last_progress: Optional[str]
+    _last_phase_check: float
+    _last_shown: float
+
+    def __init__(self, writer: BuildLogWriter, quiet: bool = False,
+                 phase_log: Optional[Path] = None):
+        self._writer = writer
+        self._quiet = quiet
+        self._phase_log = phase_log
+        self._phase_offset = 0
+        self._partial = b''
+        self._progress = None
+        self._last_progress = None
+        self._last_phase_check = 0.0
+        self._last_shown = time.time()
+
+    def feed(self, data: bytes) -> None:
+        self._writer.write(data)
+        if not self._quiet:
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+            return
+
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._parse_progress(line)
+        now = time.time()
+        if now - self._last_phase_check >= self.PHASE_SECS:
+            self._last_phase_check = now
+            self._show_phases()
+        if now - self._last_shown >= self.PROGRESS_SECS:
+            self._last_shown = now
+            if self._progress is not None and \
+               self._progress != self._last_progress:
+                pinfo(f"   {self._progress}")
+                self._last_progress = self._progress
+
+    def _parse_progress(self, line: bytes) -> None:
+        m = self.NINJA_PROGRESS.match(line)
+        if m is not None:
+            done, total = int(m.group(1)), int(m.group(2))
+            pct = 100 * done // max(1, total)
+            self._progress = f"[{done}/{total}] {pct}%"
+            return
+        m = self.MAKE_PROGRESS.match(line)
+        if m is not None:
+            self._progress = f"{int(m.group(1))}%"
+
+    def _show_phases(self) -> None:
+        if self._phase_log is None or not self._phase_log.exists():
+            return
+        with self._phase_log.open('rb') as fd:
+            fd.seek(self._phase_offset)
+            data = fd.read()
+        # only whole lines; the rest is read next time.
+        end = data.rfind(b'\n') + 1
+        self._phase_offset += end
+        for line in data[:end].decode("utf-8").splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == "start":
+                pinfo(f"=> {fields[1]}")
+                self._progress = None
+
+    def finish(self) -> None:
+        if self._quiet:
+            self._show_phases()
+
+
+def print_first_error(log: BuildLog) -> bool:
+    """ Print the first error found in 'log', returning whether one was. """
+    try:
+        found = log.find_first_error()
+    except (BuildLogError, OSError, zlib.error) as e:
+        pwarn(f"unable to read build log: {str(e)}")
+        return False
+    if found is None:
+        return False
+    lineno, lines = found
+    pwarn(f"=> first error, at line {lineno} of {log.path}:")
+    for line in lines:
+        print(f"   {line}")
+    return True
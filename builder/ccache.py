@@ -0,0 +1,435 @@
+import errno
+import io
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import time
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from .utils import CABError
+from .trace import Trace
+
+
+class CCacheError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+class CCacheRemoteStorage:
+    """ ccache secondary (remote) storage backend.
+
+        ccache (>= 4.4) is able to share its results with other hosts by
+        means of a secondary storage backend, in addition to the local,
+        primary, cache directory. We support the backends ccache supports:
+
+            - 'file', a directory, usually on a shared mount;
+            - 'http', a plain http server accepting GET/PUT/HEAD requests;
+            - 'redis', a redis server.
+
+        Hosts will either be allowed to read and write to the remote storage,
+        or simply read from it; the latter being useful for development hosts
+        that should not pollute a cache populated by the build pool.
+
+        For 'file' backends we will mount the host's directory into the
+        builder container, and point ccache at its in-container location.
+    """
+
+    SCHEMES: List[str] = ["file", "http", "redis"]
+    CONTAINER_PATH: str = "/build/ccache-remote"
+
+    _url: str
+    _read_only: bool
+
+    def __init__(self, url: str, read_only: bool = False):
+        self._url = url
+        self._read_only = read_only
+        self._validate()
+
+    def _validate(self):
+        if not self._url or len(self._url) == 0:
+            raise CCacheError(errno.EINVAL, "empty remote storage url")
+        parsed = urlparse(self._url)
+        if parsed.scheme not in self.SCHEMES:
+            raise CCacheError(
+                errno.EINVAL,
+                f"unsupported remote storage scheme '{parsed.scheme}'")
+        if self.is_file():
+            if not parsed.path or not Path(parsed.path).is_absolute():
+                raise CCacheError(
+                    errno.EINVAL,
+                    "file remote storage requires an absolute path")
+        elif not parsed.netloc:
+            raise CCacheError(
+                errno.EINVAL, f"remote storage url missing host: {self._url}")
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    @property
+    def scheme(self) -> str:
+        return urlparse(self._url).scheme
+
+    @property
+    def read_only(self) -> bool:
+        return self._read_only
+
+    @property
+    def role(self) -> str:
+        return "read-only" if self._read_only else "read-write"
+
+    def is_file(self) -> bool:
+        return self.scheme == "file"
+
+    def get_host_path(self) -> Optional[Path]:
+        if not self.is_file():
+            return None
+        return Path(urlparse(self._url).path)
+
+    def get_container_url(self) -> str:
+        """ URL as seen from within the builder container. """
+        url: str = self._url
+        if self.is_file():
+            url = f"file://{self.CONTAINER_PATH}"
+        if self._read_only:
+            url += "|read-only"
+        return url
+
+    def get_volume(self) -> Optional[Tuple[str, str]]:
+        path: Optional[Path] = self.get_host_path()
+        if path is None:
+            return None
+        mode: str = "ro" if self._read_only else "rw"
+        return str(path), f"{self.CONTAINER_PATH}:{mode}"
+
+    def get_env(self) -> Dict[str, str]:
+        url: str = self.get_container_url()
+        # ccache 4.8 renamed 'secondary storage' to 'remote storage'; set
+        # both so we work with whatever ccache the builder image ships.
+        return {
+            "CCACHE_REMOTE_STORAGE": url,
+            "CCACHE_SECONDARY_STORAGE": url
+        }
+
+    def get_podman_args(self) -> str:
+        args: List[str] = []
+        volume: Optional[Tuple[str, str]] = self.get_volume()
+        if volume is not None:
+            src, dest = volume
+            args.append(f"-v {src}:{dest}")
+        for k, v in self.get_env().items():
+            args.append(f"-e {shlex.quote(f'{k}={v}')}")
+        return ' '.join(args)
+
+    def as_role(self, read_only: bool) -> 'CCacheRemoteStorage':
+        return CCacheRemoteStorage(self._url, read_only=read_only)
+
+
+class CCacheBundleError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+class CCacheBundle:
+    """ Portable, compressed, snapshot of a vendor/release ccache.
+
+        Bundles are zstd compressed tarballs, whose first member is a json
+        manifest describing the bundle: which vendor/release it belongs to,
+        the fingerprint of the builder image used to populate the cache, and
+        the entries it contains.
+
+        Cache entries with the same contents are stored only once; duplicates
+        are kept as hard links to the first occurrence.
+
+        Because ccache results are only valid for the toolchain that produced
+        them, we refuse to import bundles into a vendor/release whose builder
+        image does not match the bundle's fingerprint.
+    """
+
+    MANIFEST: str = "cab-manifest.json"
+    VERSION: int = 1
+    # ccache bookkeeping we don't want to carry across hosts.
+    EXCLUDE_NAMES: List[str] = ["ccache.conf", "stats", "stats.lock"]
+    EXCLUDE_DIRS: List[str] = ["tmp", "lock"]
+
+    @classmethod
+    def _check_zstd(cls) -> None:
+        if shutil.which("zstd") is None:
+            raise CCacheBundleError(errno.ENOENT, "zstd not found")
+
+    @classmethod
+    def _list_entries(cls, ccache_path: Path) -> List[Path]:
+        entries: List[Path] = []
+        for root, dirs, files in os.walk(ccache_path):
+            if Path(root) == ccache_path:
+                dirs[:] = [d for d in dirs if d not in cls.EXCLUDE_DIRS]
+            for name in files:
+                if name in cls.EXCLUDE_NAMES or name.endswith(".tmp"):
+                    continue
+                entries.append(Path(root).joinpath(name))
+        return entries
+
+    @classmethod
+    def _hash_file(cls, path: Path) -> str:
+        import hashlib
+
+        h = hashlib.sha256()
+        with path.open('rb') as fd:
+            for chunk in iter(lambda: fd.read(1024*1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @classmethod
+    def export(cls,
+               ccache_path: Path,
+               bundle_path: Path,
+               vendor: str,
+               release: str,
+               fingerprint: str,
+               recent: Optional[int] = None,
+               max_age_days: Optional[int] = None,
+               level: int = 3
+               ) -> Dict[str, Any]:
+        """ Export ccache at 'ccache_path' into a bundle at 'bundle_path'.
+
+            If 'recent' is specified, only the 'recent' most recently used
+            entries are exported; if 'max_age_days' is specified, only entries
+            used within that many days are exported.
+
+            Returns the bundle's manifest.
+        """
+        # bundles are seldom used; keep their imports off cab's startup.
+        import tarfile
+        from concurrent.futures import ThreadPoolExecutor
+
+        cls._check_zstd()
+        if not ccache_path.is_dir():
+            raise CCacheBundleError(errno.ENOENT, str(ccache_path))
+
+        entries: List[Tuple[Path, os.stat_result]] = \
+            [(p, p.stat()) for p in cls._list_entries(ccache_path)]
+        # ccache bumps an entry's mtime when it is used.
+        entries = sorted(entries, key=lambda e: e[1].st_mtime, reverse=True)
+        if max_age_days is not None:
+            oldest = time.time() - max_age_days * 86400
+            entries = [e for e in entries if e[1].st_mtime >= oldest]
+        if recent is not None:
+            entries = entries[:recent]
+
+        with ThreadPoolExecutor() as executor:
+            digests: List[str] = list(
+                executor.map(lambda e: cls._hash_file(e[0]), entries))
+
+        manifest_entries: List[Dict[str, Any]] = []
+        first_seen: Dict[str, str] = {}
+        unique_bytes: int = 0
+        total_bytes: int = 0
+        for (path, st), digest in zip(entries, digests):
+            name = str(path.relative_to(ccache_path))
+            manifest_entries.append({
+                'path': name,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'sha256': digest
+            })
+            total_bytes += st.st_size
+            if digest not in first_seen:
+                first_seen[digest] = name
+                unique_bytes += st.st_size
+
+        manifest: Dict[str, Any] = {
+            'version': cls.VERSION,
+            'vendor': vendor,
+            'release': release,
+            'fingerprint': fingerprint,
+            'created': dt.now().isoformat(),
+            'num_entries': len(manifest_entries),
+            'total_bytes': total_bytes,
+            'unique_bytes': unique_bytes,
+            'entries': manifest_entries
+        }
+
+        bundle_path.parent.mkdir(parents=True, exist_ok=True)
+        cmd = f"zstd -q -T0 -{level} -f -o {shlex.quote(str(bundle_path))}"
+        proc = Trace.popen(shlex.split(cmd), stdin=subprocess.PIPE)
+        assert proc.stdin is not None
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                data = json.dumps(manifest, indent=2).encode("utf-8")
+                info = tarfile.TarInfo(cls.MANIFEST)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+
+                stored: Dict[str, str] = {}
+                for entry in manifest_entries:
+                    name = entry['path']
+                    digest = entry['sha256']
+                    path = ccache_path.joinpath(name)
+                    if digest in stored:
+                        info = tarfile.TarInfo(name)
+                        info.type = tarfile.LNKTYPE
+                        info.linkname = stored[digest]
+                        info.mtime = int(entry['mtime'])
+                        tar.addfile(info)
+                        continue
+                    stored[digest] = name
+                    info = tar.gettarinfo(str(path), arcname=name)
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ""
+                    with path.open('rb') as fd:
+                        tar.addfile(info, fd)
+        finally:
+            proc.stdin.close()
+            ret = proc.wait()
+        if ret != 0:
+            raise CCacheBundleError(ret, f"error compressing {bundle_path}")
+        return manifest
+
+    @classmethod
+    def _open(cls, bundle_path: Path) -> Tuple[subprocess.Popen, Any]:
+        import tarfile
+
+        cls._check_zstd()
+        if not bundle_path.is_file():
+            raise CCacheBundleError(errno.ENOENT, str(bundle_path))
+        cmd = f"zstd -q -d -c {shlex.quote(str(bundle_path))}"
+        proc = Trace.popen(shlex.split(cmd), stdout=subprocess.PIPE)
+        tar = tarfile.open(fileobj=proc.stdout, mode="r|")
+        return proc, tar
+
+    @classmethod
+    def _read_manifest(cls, tar: Any) -> Tuple[Dict[str, Any], Any]:
+        member = tar.next()
+        if member is None or member.name != cls.MANIFEST:
+            raise CCacheBundleError(errno.EINVAL, "bundle missing manifest")
+        fd = tar.extractfile(member)
+        assert fd is not None
+        manifest: Dict[str, Any] = json.loads(fd.read().decode("utf-8"))
+        if manifest.get('version') != cls.VERSION:
+            raise CCacheBundleError(
+                errno.EINVAL,
+                f"unsupported bundle version {manifest.get('version')}")
+        return manifest, member
+
+    @classmethod
+    def read_manifest(cls, bundle_path: Path) -> Dict[str, Any]:
+        proc, tar = cls._open(bundle_path)
+        try:
+            manifest, _ = cls._read_manifest(tar)
+        finally:
+            tar.close()
+            proc.kill()
+            proc.wait()
+        return manifest
+
+    @classmethod
+    def _write_entry(cls, dest: Path, data: bytes, mtime: float) -> None:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.cab-import")
+        tmp.write_bytes(data)
+        os.utime(tmp, (mtime, mtime))
+        tmp.replace(dest)
+
+    @classmethod
+    def _copy_entry(cls, src: Path, dest: Path, mtime: float) -> None:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(src, dest)
+        os.utime(dest, (mtime, mtime))
+
+    @classmethod
+    def import_bundle(cls,
+                      bundle_path: Path,
+                      ccache_path: Path,
+                      fingerprint: str,
+                      overwrite: bool = False,
+                      jobs: Optional[int] = None
+                      ) -> Tuple[int, int]:
+        """ Import bundle at 'bundle_path' into ccache at 'ccache_path'.
+
+            Decompression is sequential, but writing entries out is done in
+            parallel by 'jobs' workers; only so many entries are read ahead
+            of them, so memory use doesn't grow with the bundle. Existing
+            entries are kept, unless 'overwrite' is specified.
+
+            Returns a tuple with the number of imported and skipped entries.
+        """
+        from concurrent.futures import Future, ThreadPoolExecutor
+        import threading
+
+        proc, tar = cls._open(bundle_path)
+        imported: int = 0
+        skipped: int = 0
+        try:
+            manifest, _ = cls._read_manifest(tar)
+            if manifest['fingerprint'] != fingerprint:
+                raise CCacheBundleError(
+                    errno.EINVAL,
+                    "bundle built with a different builder image "
+                    f"({manifest['fingerprint'][:12]} != {fingerprint[:12]})")
+
+            ccache_path.mkdir(parents=True, exist_ok=True)
+            root = ccache_path.resolve()
+            workers = jobs or min(32, (os.cpu_count() or 1) + 4)
+            in_flight = threading.BoundedSemaphore(workers * 2)
+            # entries being written, for hardlinks to them to wait on.
+            futures: Dict[str, Future] = {}
+
+            def _submit(name: str, fn, *args) -> None:
+                """ Submit 'fn', holding one of the 'in_flight' slots. """
+                # finished ones are dropped, their errors raised.
+                for done in [n for n, f in futures.items() if f.done()]:
+                    futures.pop(done).result()
+                future = executor.submit(fn, *args)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures[name] = future
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for member in tar:
+                    if member.name == cls.MANIFEST:
+                        continue
+                    dest = root.joinpath(member.name).resolve()
+                    if root not in dest.parents:
+                        raise CCacheBundleError(
+                            errno.EINVAL, f"invalid entry '{member.name}'")
+                    if dest.exists() and not overwrite:
+                        skipped += 1
+                        continue
+
+                    if member.islnk():
+                        src = root.joinpath(member.linkname)
+                        target = futures.get(member.linkname)
+
+                        def _copy(target=target, src=src, dest=dest,
+                                  mtime=member.mtime):
+                            if target is not None:
+                                target.result()
+                            cls._copy_entry(src, dest, mtime)
+
+                        in_flight.acquire()
+                        _submit(member.name, _copy)
+                    elif member.isfile():
+                        fd = tar.extractfile(member)
+                        assert fd is not None
+                        # read only once there's room for it.
+                        in_flight.acquire()
+                        _submit(member.name, cls._write_entry, dest,
+                                fd.read(), member.mtime)
+                    else:
+                        continue
+                    imported += 1
+
+                for future in futures.values():
+                    future.result()
+        finally:
+            tar.close()
+            assert proc.stdout is not None
+            proc.stdout.close()
+            ret = proc.wait()
+        if ret != 0:
+            raise CCacheBundleError(ret, f"error decompressing {bundle_path}")
+        return imported, skipped
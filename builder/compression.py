@@ -0,0 +1,76 @@
+import errno
+from typing import Any, Dict, Optional, Tuple
+from .utils import CABError
+
+
+class ImageCompressionError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+class ImageCompression:
+    """ How image layers are compressed when pushed to a registry.
+
+        'zstd:chunked' layers carry a table of contents, allowing consumers to
+        fetch only the files they need, and to reuse chunks they already have
+        locally; they remain readable, as plain zstd, by older clients.
+        'gzip' is podman's default, and what every client understands.
+
+        Local storage keeps layers uncompressed, so the format only applies
+        when pushing; layers already pushed in some other format are
+        compressed again.
+    """
+
+    # format -> (min level, max level, default level)
+    FORMATS: Dict[str, Tuple[int, int, int]] = {
+        "gzip": (1, 9, 6),
+        "zstd": (1, 20, 3),
+        "zstd:chunked": (1, 20, 3)
+    }
+
+    _format: str
+    _level: int
+
+    def __init__(self, fmt: str, level: Optional[int] = None):
+        if fmt == "estargz":
+            raise ImageCompressionError(
+                errno.ENOTSUP,
+                "estargz layers can't be produced by podman; "
+                "use 'zstd:chunked' for partial pulls")
+        if fmt not in self.FORMATS:
+            raise ImageCompressionError(
+                errno.EINVAL,
+                f"unknown compression format '{fmt}'; expected one of "
+                f"{', '.join(self.FORMATS.keys())}")
+        lmin, lmax, ldefault = self.FORMATS[fmt]
+        if level is None:
+            level = ldefault
+        if level < lmin or level > lmax:
+            raise ImageCompressionError(
+                errno.ERANGE,
+                f"compression level for '{fmt}' must be within "
+                f"[{lmin}, {lmax}]")
+        self._format = fmt
+        self._level = level
+
+    @property
+    def format(self) -> str:
+        return self._format
+
+    @property
+    def level(self) -> int:
+        return self._level
+
+    def get_podman_args(self) -> str:
+        return f"--compression-format {self._format} " \
+               f"--compression-level {self._level} --force-compression"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'format': self._format, 'level': self._level}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> 'ImageCompression':
+        return ImageCompression(d['format'], d.get('level'))
+
+    def __str__(self) -> str:
+        return f"{self._format} (level {self._level})"
@@ -1,8 +1,12 @@
-import yaml
+import functools
 from pathlib import Path
-from appdirs import user_config_dir  # type: ignore
-from typing import Dict, Any, List, Optional
+from appdirs import user_config_dir, user_data_dir  # type: ignore
+from typing import Callable, Dict, Any, List, Optional
 from .utils import print_tree
+from .ccache import CCacheRemoteStorage
+from .compression import ImageCompression
+from .gc import RetentionPolicy
+from .state import StateStore
 
 
 class UnknownBuildError(Exception):
@@ -10,48 +14,70 @@ class UnknownBuildError(Exception):
         super().__init__(f"unknown build name '{name}'")
 
 
+def _lazy(func: Callable) -> Callable:
+    """ Load the global configuration on first use, rather than on startup.
+    """
+    @functools.wraps(func)
+    def wrapper(self: 'Config', *args: Any, **kwargs: Any) -> Any:
+        if not self._loaded:
+            self._load()
+        return func(self, *args, **kwargs)
+    return wrapper
+
+
 class Config:
+    """ Global configuration, and access to the builds' configurations, all
+        kept in the state store. Nothing is read until first needed, so that
+        e.g. '--help' does not touch the store at all.
+    """
 
     _config_dir: Path
-    _build_config_dir: Path
+    _data_dir: Path
+    _store: StateStore
+    _loaded: bool = False
     _has_config: bool = False
 
     _ccache_dir: Optional[Path] = None
     _installs_dir: Optional[Path] = None
     _ccache_default_size: str
+    _ccache_remote: Optional[CCacheRemoteStorage] = None
     _registry_url: Optional[str] = None
     _registry_is_secure: bool = False
+    _registry_compression: Optional[ImageCompression] = None
+    _registry_push_jobs: int = 2
+    _mirror_repos: List[str]
+    _retention: Optional[RetentionPolicy] = None
 
     def __init__(self):
         config_dir = user_config_dir('cab')
         self._config_dir = Path(config_dir)
-        self._config_dir.mkdir(0o755, exist_ok=True)
-        self._build_config_dir = self._config_dir.joinpath('builds')
-        self._build_config_dir.mkdir(0o755, exist_ok=True)
+        self._data_dir = Path(user_data_dir('cab'))
+        self._store = StateStore(self._config_dir.joinpath('state.db'),
+                                 yaml_dir=self._config_dir)
         self._ccache_default_size = '10G'
-        self._has_config = self._read_config()
+        self._mirror_repos = []
 
-    def _read_config_file(self, config_path: Path) -> Dict[str, Any]:
-        assert config_path.exists()
-        with config_path.open('r') as fd:
-            config_dict: Dict[str, str] = yaml.safe_load(fd)
-            return config_dict
+    def _load(self):
+        self._loaded = True
+        self._has_config = self._read_config()
 
     def _read_config(self):
-        config_path = self._config_dir.joinpath('config.yaml')
-        if not config_path.exists():
-            return False
-
-        config_dict = self._read_config_file(config_path)
-        if 'global' not in config_dict:
+        global_config = self._store.get_settings('global')
+        if global_config is None:
             return False
-        global_config = config_dict['global']
         if 'ccache' in global_config:
             ccache_config = global_config['ccache']
             if 'path' in ccache_config:
                 self._ccache_dir = Path(ccache_config['path'])
             if 'size' in global_config:
                 self._ccache_default_size = ccache_config['size']
+            if 'remote' in ccache_config:
+                remote_config = ccache_config['remote']
+                read_only = False
+                if 'read-only' in remote_config:
+                    read_only = remote_config['read-only']
+                self._ccache_remote = \
+                    CCacheRemoteStorage(remote_config['url'], read_only)
         if 'installs' in global_config:
             installs_config = global_config['installs']
             if 'path' in installs_config:
@@ -62,6 +88,17 @@ class Config:
                 self._registry_url = global_config['registry']['url']
             if 'secure' in registry_config:
                 self._registry_is_secure = registry_config['secure']
+            if 'compression' in registry_config:
+                self._registry_compression = ImageCompression.from_dict(
+                    registry_config['compression'])
+            if 'push-jobs' in registry_config:
+                self._registry_push_jobs = registry_config['push-jobs']
+        if 'gc' in global_config:
+            self._retention = RetentionPolicy.from_dict(global_config['gc'])
+        if 'mirrors' in global_config:
+            mirrors_config = global_config['mirrors']
+            if 'repos' in mirrors_config:
+                self._mirror_repos = mirrors_config['repos']
 
         if not self._installs_dir:
             return False
@@ -69,54 +106,144 @@ class Config:
         # self.print()
         return True
 
+    @_lazy
     def has_config(self):
         return self._has_config
 
     def has_ccache(self):
         return self.get_ccache_dir() is not None
 
+    def has_ccache_remote(self):
+        return self.get_ccache_remote() is not None
+
     def has_registry(self):
         return self.get_registry() is not None
 
+    @_lazy
     def is_registry_secure(self):
         return self._registry_is_secure
 
     def get_config_path(self) -> str:
-        return str(self._config_dir.joinpath('config.yaml'))
+        return str(self._store.path)
+
+    def get_data_dir(self) -> Path:
+        return self._data_dir
+
+    def get_history_dir(self) -> Path:
+        return self._data_dir.joinpath('history')
+
+    def get_profiles_dir(self) -> Path:
+        return self._data_dir.joinpath('profiles')
 
+    def get_spec_cache_dir(self) -> Path:
+        return self._data_dir.joinpath('spec-cache')
+
+    def get_mirrors_dir(self) -> Path:
+        return self._data_dir.joinpath('mirrors')
+
+    def get_push_dir(self) -> Path:
+        return self._data_dir.joinpath('push')
+
+    def get_logs_dir(self) -> Path:
+        return self._data_dir.joinpath('logs')
+
+    def get_frontend_cache_dir(self) -> Path:
+        return self._data_dir.joinpath('frontend-cache')
+
+    def get_image_bench_dir(self) -> Path:
+        return self._data_dir.joinpath('image-bench')
+
+    @_lazy
+    def get_mirror_repos(self) -> List[str]:
+        return self._mirror_repos
+
+    @_lazy
     def get_ccache_dir(self) -> Optional[Path]:
         return self._ccache_dir
 
+    @_lazy
     def get_installs_dir(self) -> Path:
         assert self._installs_dir is not None
         return self._installs_dir
 
+    @_lazy
     def get_ccache_size(self) -> str:
         return self._ccache_default_size
 
+    @_lazy
+    def get_ccache_remote(self) -> Optional[CCacheRemoteStorage]:
+        return self._ccache_remote
+
+    @_lazy
     def get_registry(self) -> Optional[str]:
         return self._registry_url
 
+    @_lazy
+    def get_registry_compression(self) -> Optional[ImageCompression]:
+        return self._registry_compression
+
+    @_lazy
+    def get_registry_push_jobs(self) -> int:
+        return self._registry_push_jobs
+
+    @_lazy
+    def get_retention_policy(self) -> RetentionPolicy:
+        if self._retention is None:
+            return RetentionPolicy()
+        return self._retention
+
+    @_lazy
     def set_ccache_dir(self, ccache_str: str):
         if not ccache_str:
             self._ccache_dir = None
         else:
             self._ccache_dir = Path(ccache_str).expanduser()
 
+    @_lazy
     def set_installs_dir(self, installs_dir: str):
         self._installs_dir = Path(installs_dir).expanduser()
 
+    @_lazy
     def set_ccache_size(self, sz: str):
         self._ccache_default_size = sz
 
+    @_lazy
+    def set_ccache_remote(self, url: Optional[str], read_only: bool = False):
+        if not url:
+            self._ccache_remote = None
+        else:
+            self._ccache_remote = CCacheRemoteStorage(url, read_only)
+
+    @_lazy
     def set_registry(self, registry: str, secure_registry: bool):
         self._registry_url = registry
         self._registry_is_secure = secure_registry
 
+    @_lazy
+    def set_registry_compression(self,
+                                 compression: Optional[ImageCompression]):
+        self._registry_compression = compression
+
+    @_lazy
+    def set_registry_push_jobs(self, jobs: int):
+        self._registry_push_jobs = jobs
+
+    @_lazy
+    def set_retention_policy(self, policy: Optional[RetentionPolicy]):
+        self._retention = policy
+
+    @_lazy
+    def add_mirror_repo(self, url: str):
+        if url not in self._mirror_repos:
+            self._mirror_repos.append(url)
+
+    @_lazy
+    def remove_mirror_repo(self, url: str):
+        if url in self._mirror_repos:
+            self._mirror_repos.remove(url)
+
     def _write_config(self):
-        assert self._config_dir.exists()
-        config_file = 'config.yaml'
-        d = {
+        d: Dict[str, Any] = {
             'global': {
                 'installs': {
                     'path': str(self._installs_dir)
@@ -128,68 +255,91 @@ class Config:
                 'path': str(self._ccache_dir),
                 'size': self._ccache_default_size
             }
+            if self._ccache_remote:
+                d['global']['ccache']['remote'] = {
+                    'url': self._ccache_remote.url,
+                    'read-only': self._ccache_remote.read_only
+                }
         if self._registry_url:
             d['global']['registry'] = {
                 'url': self._registry_url,
-                'secure': self._registry_is_secure
+                'secure': self._registry_is_secure,
+                'push-jobs': self._registry_push_jobs
             }
-        path = self._config_dir.joinpath(config_file)
-        self._write_config_file(d, path)
-
-    def _write_config_file(self, d: Dict[str, Any], path: Path):
-        with path.open('w') as fd:
-            yaml.dump(d, stream=fd)
-            # json.dump(d, fd)
+            if self._registry_compression:
+                d['global']['registry']['compression'] = \
+                    self._registry_compression.to_dict()
+        if self._retention is not None:
+            d['global']['gc'] = self._retention.to_dict()
+        if len(self._mirror_repos) > 0:
+            d['global']['mirrors'] = {
+                'repos': self._mirror_repos
+            }
+        self._store.set_settings('global', d['global'])
 
+    @_lazy
     def commit(self):
         self._write_config()
 
-    def _get_build_config_path(self, name: str) -> Path:
-        return self._build_config_dir.joinpath(f'{name}.yaml')
-
     def build_exists(self, name: str) -> bool:
-        return self._get_build_config_path(name).exists()
+        return self._store.has_build(name)
 
     def get_build_config(self, name: str) -> Dict[str, Any]:
-        if not self.build_exists(name):
+        build_config = self._store.get_build(name)
+        if build_config is None:
             raise UnknownBuildError(name)
-
-        path = self._get_build_config_path(name)
-        build_config = self._read_config_file(path)
         return build_config
 
     def write_build_config(self, name: str, conf_dict: Dict[str, Any]):
         assert name
         assert conf_dict
-        path = self._get_build_config_path(name)
-        self._write_config_file(conf_dict, path)
+        self._store.put_build(name, conf_dict)
 
     def get_builds(self) -> List[str]:
-        lst = []
-        for build in self._build_config_dir.iterdir():
-            if build.suffix != '.yaml':
-                continue
-            lst.append(build.with_suffix('').name)
-        return lst
+        return self._store.get_build_names()
+
+    def get_builds_with_sources(self, sources: str) -> List[str]:
+        return self._store.get_builds_with_sources(sources)
 
     def remove_build(self, buildname: str) -> bool:
-        if not self.build_exists(buildname):
-            return True
-        buildpath = self._get_build_config_path(buildname)
-        assert buildpath.exists()
-        buildpath.unlink()
+        self._store.remove_build(buildname)
         return True
 
+    def import_yaml(self) -> int:
+        """ Import the yaml configuration again; returns how many builds. """
+        n = self._store.import_yaml()
+        self._loaded = False
+        return n
+
+    def _get_ccache_remote_url(self) -> Optional[str]:
+        if not self._ccache_remote:
+            return None
+        return self._ccache_remote.url
+
+    def _get_ccache_remote_role(self) -> Optional[str]:
+        if not self._ccache_remote:
+            return None
+        return self._ccache_remote.role
+
+    @_lazy
     def print(self):
         tree = [
             ('config', '', [
                 ('installs directory', self.get_installs_dir()),
                 ('ccache directory', self.get_ccache_dir(), [
-                    ('size', self.get_ccache_size())
+                    ('size', self.get_ccache_size()),
+                    ('remote', self._get_ccache_remote_url(), [
+                        ('role', self._get_ccache_remote_role())
+                    ])
                 ]),
                 ('registry', self._registry_url, [
-                    ('secure', self._registry_is_secure)
-                ])
+                    ('secure', self._registry_is_secure),
+                    ('compression', self._registry_compression),
+                    ('concurrent pushes', self._registry_push_jobs)
+                ]),
+                ('image retention', self.get_retention_policy()),
+                ('mirrored repositories', len(self._mirror_repos),
+                 [('repo', url) for url in self._mirror_repos])
             ])
         ]
         print_tree(tree)
@@ -0,0 +1,185 @@
+import errno
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from .utils import CABError
+from .podman import Podman
+from .container_image import ContainerImageName
+
+
+class DiskUsageError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+class SizeIndex:
+    """ Disk usage of directory trees, with each directory's own files' usage
+        cached and keyed on the directory's mtime.
+
+        Creating, removing or renaming entries changes a directory's mtime,
+        so unchanged directories need not have their files looked at again;
+        only the directories themselves are. Files rewritten in place, rather
+        than replaced, go unnoticed; neither installs nor ccache do that.
+
+        Trees are scanned a level at a time, with each level's directories
+        spread across 'jobs' threads.
+    """
+
+    _path: Optional[Path]
+    _entries: Dict[str, List[Any]]  # path -> [mtime_ns, bytes, files, dirs]
+    _lock: threading.Lock
+    hits: int
+    misses: int
+
+    def __init__(self, path: Optional[Path] = None):
+        self._path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and path.exists():
+            try:
+                self._entries = json.loads(path.read_text())
+            except json.JSONDecodeError:
+                pass
+
+    def _scan_dir(self, path: str) -> Tuple[int, int, List[str]]:
+        """ Usage and number of the directory's own files, and its
+            subdirectories.
+        """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return 0, 0, []
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None and cached[0] == st.st_mtime_ns:
+                self.hits += 1
+                return cached[1], cached[2], cached[3]
+            self.misses += 1
+
+        nbytes = st.st_blocks * 512
+        nfiles = 0
+        subdirs: List[str] = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                            continue
+                        nbytes += \
+                            entry.stat(follow_symlinks=False).st_blocks * 512
+                        nfiles += 1
+                    except FileNotFoundError:
+                        continue
+        except OSError:
+            return nbytes, 0, []
+        with self._lock:
+            self._entries[path] = [st.st_mtime_ns, nbytes, nfiles, subdirs]
+        return nbytes, nfiles, subdirs
+
+    def get_usage(self, root: Path, jobs: int = 8) -> Tuple[int, int]:
+        """ Bytes used by, and number of files in, the tree at 'root'. """
+        if not root.is_dir():
+            return 0, 0
+        rootstr = str(root.resolve())
+        total_bytes = 0
+        total_files = 0
+        seen: Set[str] = set()
+        level: List[str] = [rootstr]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while len(level) > 0:
+                nextlevel: List[str] = []
+                results = executor.map(self._scan_dir, level)
+                for path, (nbytes, nfiles, subdirs) in zip(level, results):
+                    seen.add(path)
+                    total_bytes += nbytes
+                    total_files += nfiles
+                    nextlevel.extend([os.path.join(path, d) for d in subdirs])
+                level = nextlevel
+
+        # forget directories no longer there.
+        prefix = rootstr.rstrip(os.sep) + os.sep
+        with self._lock:
+            for path in list(self._entries.keys()):
+                if (path == rootstr or path.startswith(prefix)) and \
+                        path not in seen:
+                    del self._entries[path]
+        return total_bytes, total_files
+
+    def commit(self) -> None:
+        if self._path is None:
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(self._entries))
+        tmp.replace(self._path)
+
+
+class ImageStorage:
+    """ Local container storage's images and layers, as read from the
+        storage's own metadata; podman does not tell how much of an image's
+        size is shared with other images.
+    """
+
+    _images: List[Dict[str, Any]]
+    _layers: Dict[str, Tuple[Optional[str], int]]  # id -> (parent, size)
+
+    def __init__(self, images: List[Dict[str, Any]],
+                 layers: List[Dict[str, Any]]):
+        self._images = images
+        self._layers = {}
+        for layer in layers:
+            self._layers[layer['id']] = \
+                (layer.get('parent'), layer.get('diff-size', 0))
+
+    @classmethod
+    def load(cls) -> 'ImageStorage':
+        ret, result = Podman._run("info --format json")
+        if ret != 0:
+            raise DiskUsageError(ret, ' '.join(result))
+        store = json.loads('\n'.join(result))['store']
+        root = Path(store['graphRoot'])
+        driver = store['graphDriverName']
+        try:
+            images = json.loads(root.joinpath(
+                f"{driver}-images", "images.json").read_text())
+            layers = json.loads(root.joinpath(
+                f"{driver}-layers", "layers.json").read_text())
+        except (OSError, json.JSONDecodeError) as e:
+            raise DiskUsageError(errno.EIO,
+                                 f"unable to read storage metadata: {e}")
+        return ImageStorage(images, layers)
+
+    def _get_chain(self, image: Dict[str, Any]) -> List[str]:
+        chain: List[str] = []
+        layer: Optional[str] = image.get('layer')
+        while layer is not None and layer in self._layers:
+            chain.append(layer)
+            layer = self._layers[layer][0]
+        return chain
+
+    def get_usage(self, match: Callable[[ContainerImageName], bool]
+                  ) -> Tuple[int, int, int]:
+        """ Number of images with a name matching, and the bytes of their
+            layers only they use, and of those other images use too.
+        """
+        ours: Set[str] = set()
+        others: Set[str] = set()
+        nimages = 0
+        for image in self._images:
+            names = [ContainerImageName.parse(n)
+                     for n in image.get('names') or []]
+            chain = self._get_chain(image)
+            if any([n is not None and match(n) for n in names]):
+                nimages += 1
+                ours.update(chain)
+            else:
+                others.update(chain)
+        unique = sum([self._layers[x][1] for x in ours - others])
+        shared = sum([self._layers[x][1] for x in ours & others])
+        return nimages, unique, shared
@@ -0,0 +1,113 @@
+import errno
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional
+from .utils import CABError
+
+
+class FrontendCacheError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+class FrontendCache:
+    """ Built dashboard frontends, i.e. their 'dist' directory, keyed on
+        the frontend's 'package-lock.json' and sources, and on the builder
+        image, which provides node.
+
+        On a hit, the build is told to skip building the frontend, and the
+        cached 'dist' is put in place of what it would have built; on a miss,
+        what the build produced is kept. Only the 'MAX_ENTRIES' most recently
+        used are kept.
+    """
+
+    CACHE_VERSION: int = 1
+    MAX_ENTRIES: int = 8
+    FRONTEND_PATH: str = "src/pybind/mgr/dashboard/frontend"
+    # written by the frontend's build, or by npm; not its sources.
+    IGNORE_NAMES: List[str] = [
+        "node_modules", "dist", ".angular", ".cache", "coverage"
+    ]
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    @classmethod
+    def get_frontend_path(cls, sources: Path) -> Optional[Path]:
+        path = sources.joinpath(cls.FRONTEND_PATH)
+        if not path.joinpath("package-lock.json").exists():
+            return None
+        return path
+
+    @classmethod
+    def get_key(cls, sources: Path, builder: str) -> Optional[str]:
+        """ Key for the frontend at 'sources', as built by the builder image
+            'builder'; None if there's no frontend.
+        """
+        frontend = cls.get_frontend_path(sources)
+        if frontend is None:
+            return None
+        h = hashlib.sha256()
+        h.update(f"v{cls.CACHE_VERSION}\n{builder}\n".encode("utf-8"))
+        h.update(frontend.joinpath("package-lock.json").read_bytes())
+        top = str(frontend)
+        for path, dirs, files in os.walk(top):
+            if path == top:
+                dirs[:] = [d for d in dirs if d not in cls.IGNORE_NAMES]
+            dirs.sort()
+            for name in sorted(files):
+                filepath = os.path.join(path, name)
+                if os.path.islink(filepath):
+                    data = os.readlink(filepath).encode("utf-8")
+                else:
+                    with open(filepath, 'rb') as fd:
+                        data = fd.read()
+                relpath = os.path.relpath(filepath, top)
+                h.update(f"{relpath}\0{len(data)}\0".encode("utf-8"))
+                h.update(data)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Path]:
+        """ The cache entry for 'key', holding 'dist', if any. """
+        path = self._path.joinpath(key)
+        if not path.joinpath("dist").is_dir():
+            return None
+        # keeps it from being pruned.
+        os.utime(path)
+        return path
+
+    def store(self, key: str, sources: Path) -> bool:
+        """ Keep the frontend built at 'sources'; False if there's none. """
+        frontend = self.get_frontend_path(sources)
+        if frontend is None or not frontend.joinpath("dist").is_dir():
+            return False
+        path = self._path.joinpath(key)
+        if path.joinpath("dist").is_dir():
+            return True
+        tmp = self._path.joinpath(f".{key}.{os.getpid()}.tmp")
+        try:
+            shutil.copytree(frontend.joinpath("dist"), tmp.joinpath("dist"),
+                            symlinks=True)
+            tmp.rename(path)
+        except OSError as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if path.joinpath("dist").is_dir():
+                # someone else stored it meanwhile.
+                return True
+            raise FrontendCacheError(e.errno or errno.EIO,
+                                     f"unable to cache frontend: {e}")
+        self.prune(self.MAX_ENTRIES)
+        return True
+
+    def prune(self, keep: int) -> None:
+        if not self._path.exists():
+            return
+        entries = [p for p in self._path.iterdir()
+                   if p.is_dir() and not p.name.startswith('.')]
+        entries.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+        for path in entries[keep:]:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,188 @@
+import errno
+import re
+from datetime import datetime as dt, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+from .utils import CABError
+from .podman import Podman
+from .container_image import ContainerImage
+
+
+class GCError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+def parse_age(agestr: str) -> timedelta:
+    """ Parse ages such as '30m', '12h', '7d' or '2w'. """
+    m = re.match(r'^(\d+)([mhdw])$', agestr.strip())
+    if m is None:
+        raise GCError(errno.EINVAL,
+                      f"invalid age '{agestr}'; e.g., '12h', '7d', '2w'")
+    value = int(m.group(1))
+    unit = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+    return timedelta(**{unit[m.group(2)]: value})
+
+
+class RetentionPolicy:
+    """ Which of a build's images to keep: the last 'keep_last' runs, those
+        younger than 'keep_younger_than', and, always, the latest ones.
+        With 'auto', images are collected after each build.
+    """
+
+    DEFAULT_KEEP_LAST: int = 5
+
+    keep_last: int
+    keep_younger_than: Optional[str]
+    auto: bool
+
+    def __init__(self, keep_last: Optional[int] = None,
+                 keep_younger_than: Optional[str] = None,
+                 auto: bool = False):
+        if keep_last is None:
+            keep_last = self.DEFAULT_KEEP_LAST
+        if keep_last < 0:
+            raise GCError(errno.EINVAL, "must keep a positive number of runs")
+        if keep_younger_than is not None:
+            parse_age(keep_younger_than)
+        self.keep_last = keep_last
+        self.keep_younger_than = keep_younger_than
+        self.auto = auto
+
+    def get_max_age(self) -> Optional[timedelta]:
+        if self.keep_younger_than is None:
+            return None
+        return parse_age(self.keep_younger_than)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'keep-last': self.keep_last,
+            'keep-younger-than': self.keep_younger_than,
+            'auto': self.auto
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> 'RetentionPolicy':
+        return RetentionPolicy(d.get('keep-last'),
+                               d.get('keep-younger-than'),
+                               d.get('auto', False))
+
+    def __str__(self) -> str:
+        s = f"keep last {self.keep_last}"
+        if self.keep_younger_than is not None:
+            s += f", and younger than {self.keep_younger_than}"
+        if self.auto:
+            s += " (after each build)"
+        return s
+
+
+class GCResult:
+
+    kept: List[str]
+    expired: List[str]
+    removed_names: List[str]
+    removed_dangling: int
+    errors: List[str]
+
+    def __init__(self):
+        self.kept = []
+        self.expired = []
+        self.removed_names = []
+        self.removed_dangling = 0
+        self.errors = []
+
+
+class ImageGC:
+    """ Removes a build's images according to a retention policy.
+
+        Each build run commits a '<date>-raw' and a '<date>' image; both are
+        kept, or expired, together. Images tagged 'latest' or 'latest-raw'
+        are always kept. Removals are batched, so that podman is run once
+        per batch rather than once per image.
+    """
+
+    DATE_FORMAT: str = "%Y%m%dT%H%M%SZ"
+    PINNED_TAGS: List[str] = ["latest", "latest-raw"]
+    BATCH_SIZE: int = 32
+
+    @classmethod
+    def _get_run(cls, tag: str) -> Optional[Tuple[str, dt]]:
+        stem = tag[:-len("-raw")] if tag.endswith("-raw") else tag
+        try:
+            return stem, dt.strptime(stem, cls.DATE_FORMAT)
+        except ValueError:
+            # not one of ours; leave it alone.
+            return None
+
+    @classmethod
+    def plan(cls, buildname: str, images: List[ContainerImage],
+             policy: RetentionPolicy,
+             now: Optional[dt] = None) -> Tuple[List[str], List[str],
+                                                List[str]]:
+        """ Returns the runs to keep, those expired, and the image names to
+            remove for the latter.
+        """
+        if now is None:
+            now = dt.now()
+        max_age = policy.get_max_age()
+
+        runs: Dict[str, dt] = {}
+        run_names: Dict[str, List[str]] = {}
+        pinned: Set[str] = set()
+        for image in images:
+            build_names = [n for n in image.names if n.name == buildname]
+            is_pinned = any([n.tag in cls.PINNED_TAGS for n in build_names])
+            for name in build_names:
+                run = cls._get_run(name.tag)
+                if run is None:
+                    continue
+                stem, date = run
+                runs[stem] = date
+                run_names.setdefault(stem, []).append(str(name))
+                if is_pinned:
+                    pinned.add(stem)
+
+        keep: List[str] = []
+        expired: List[str] = []
+        ordered = sorted(runs.keys(), key=lambda s: runs[s], reverse=True)
+        for idx, stem in enumerate(ordered):
+            if idx < policy.keep_last or stem in pinned or \
+               (max_age is not None and now - runs[stem] < max_age):
+                keep.append(stem)
+            else:
+                expired.append(stem)
+
+        names: List[str] = []
+        for stem in expired:
+            names.extend(sorted(run_names[stem]))
+        return keep, expired, names
+
+    @classmethod
+    def _remove(cls, what: List[str], result: GCResult) -> List[str]:
+        removed: List[str] = []
+        for i in range(0, len(what), cls.BATCH_SIZE):
+            batch = what[i:i + cls.BATCH_SIZE]
+            ret, out = Podman.remove_images(batch)
+            if ret != 0:
+                result.errors.extend(out)
+                # some may have been removed nonetheless.
+                continue
+            removed.extend(batch)
+        return removed
+
+    @classmethod
+    def collect(cls, buildname: str, images: List[ContainerImage],
+                policy: RetentionPolicy, dry_run: bool = False) -> GCResult:
+        result = GCResult()
+        result.kept, result.expired, names = \
+            cls.plan(buildname, images, policy)
+        if dry_run:
+            result.removed_names = names
+            return result
+        result.removed_names = cls._remove(names, result)
+
+        # leftovers with no names, e.g. parents of since removed images.
+        dangling = Podman.get_images(
+            f"--filter dangling=true --filter label=cab.build={buildname}")
+        result.removed_dangling = len(
+            cls._remove([img.hashid for img in dangling], result))
+        return result
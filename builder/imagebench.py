@@ -0,0 +1,143 @@
+import errno
+import json
+import shlex
+import statistics
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from .utils import CABError, run_cmd
+from .container_image import ContainerImage
+from .probe import PROBES
+
+
+class ImageBenchError(CABError):
+    def __init__(self, rc: int, msg: Any):
+        super().__init__(rc, msg)
+
+
+def get_image_tag(image: ContainerImage) -> Optional[str]:
+    """ The image's dated tag, which stays with it, unlike 'latest'. """
+    for name in image.names:
+        if name.tag != "latest" and not name.tag.endswith("-raw"):
+            return name.tag
+    return None
+
+
+class ImageBench:
+    """ Start-up cost of daemons and tools in a build's image.
+
+        Each probe runs in a fresh container: its first run is kept apart, as
+        it pays for what the new container does on first use; the following,
+        warm, ones are what images are compared on. The first run isn't a
+        cold one: the page cache is the host's, and the image's files are
+        likely in it already, e.g. after the build or an earlier probe, so
+        it varies with what ran before. Measurements are taken within the
+        container, by 'builder/probe.py', so they don't include podman's own
+        overhead.
+    """
+
+    _image: ContainerImage
+    _runs: int
+
+    def __init__(self, image: ContainerImage, runs: int = 3):
+        self._image = image
+        self._runs = runs
+
+    def _run_probe(self, probe: str) -> Dict[str, Any]:
+        script = Path(__file__).parent.joinpath("probe.py")
+        cmd = f"podman run --rm --network none " \
+              f"-v {script}:/cab-probe.py:ro " \
+              f"--entrypoint python3 {self._image.hashid} " \
+              f"/cab-probe.py --runs {self._runs}"
+        ret, stdout, stderr = run_cmd(f"{cmd} {shlex.quote(probe)}")
+        if ret != 0:
+            raise ImageBenchError(ret, stderr)
+        try:
+            result = json.loads(stdout[-1])
+        except (IndexError, json.JSONDecodeError):
+            raise ImageBenchError(errno.EINVAL,
+                                  f"bad probe result: {' '.join(stdout)}")
+        return {
+            'first': result['first'],
+            'warm': self._summarize(result['warm'])
+        }
+
+    @classmethod
+    def _summarize(cls, runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        ok = [r for r in runs if 'error' not in r]
+        if len(ok) == 0:
+            return runs[0] if len(runs) > 0 else {}
+        summary: Dict[str, Any] = {}
+        for key in ('wall_secs', 'maxrss_kb', 'major_faults',
+                    'read_blocks'):
+            summary[key] = statistics.median([r[key] for r in ok])
+        summary['returncode'] = ok[-1]['returncode']
+        return summary
+
+    @classmethod
+    def get_regression(cls, current: Dict[str, Any],
+                       previous: Dict[str, Any],
+                       threshold: float = 0.2,
+                       min_delta: float = 0.05) -> Optional[float]:
+        """ How much slower a probe's warm runs got, if significantly. """
+        if 'wall_secs' not in current or 'wall_secs' not in previous:
+            return None
+        delta = current['wall_secs'] - previous['wall_secs']
+        if delta < min_delta or previous['wall_secs'] <= 0:
+            return None
+        ratio = delta / previous['wall_secs']
+        return ratio if ratio >= threshold else None
+
+    def run(self) -> Dict[str, Any]:
+        probes: Dict[str, Any] = {}
+        for probe in PROBES.keys():
+            probes[probe] = self._run_probe(probe)
+        return {
+            'image': self._image.hashid,
+            'tag': get_image_tag(self._image),
+            'size': self._image.size,
+            'date': dt.now().isoformat(),
+            'runs': self._runs,
+            'probes': probes
+        }
+
+
+class ImageBenchStore:
+    """ Image benchmark results, per build, one json file per image tag;
+        benchmarking an image again replaces its results.
+    """
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    def _get_build_path(self, buildname: str) -> Path:
+        return self._path.joinpath(buildname)
+
+    def store(self, buildname: str, result: Dict[str, Any]) -> Path:
+        path = self._get_build_path(buildname)
+        path.mkdir(parents=True, exist_ok=True)
+        tag = result['tag'] or result['image'][:12]
+        result_path = path.joinpath(f"{tag}.json")
+        with result_path.open('w') as fd:
+            json.dump(result, fd)
+        return result_path
+
+    def get_results(self, buildname: str) -> List[Dict[str, Any]]:
+        """ Results, oldest image first. """
+        path = self._get_build_path(buildname)
+        if not path.exists():
+            return []
+        results: List[Dict[str, Any]] = []
+        for result_path in sorted(path.glob("*.json")):
+            with result_path.open('r') as fd:
+                results.append(json.load(fd))
+        return results
+
+    def get_previous(self, buildname: str,
+                     tag: str) -> Optional[Dict[str, Any]]:
+        """ Results for the latest image benchmarked before 'tag'. """
+        previous = [r for r in self.get_results(buildname)
+                    if r['tag'] is not None and r['tag'] < tag]
+        return previous[-1] if len(previous) > 0 else None
@@ -170,18 +170,19 @@ class ImageBuilder:
         if Images.has_seed_image() and not force:
             return 'cab/seed/suse:leap-15.2'
 
-        working_container = Buildah('opensuse/leap:15.2')
-        working_container.set_author("Joao Eduardo Luis", "joao@suse.com")
-        working_container.run("zypper --gpg-auto-import-keys refresh")
-        working_container.run("zypper -n install git sudo wget ccache")
-        hashid = working_container.commit("cab/seed/suse", "leap-15.2")
-        return hashid
+        with Buildah('opensuse/leap:15.2', owner="seed") as working_container:
+            working_container.set_author("Joao Eduardo Luis", "joao@suse.com")
+            working_container.run("zypper --gpg-auto-import-keys refresh")
+            working_container.run("zypper -n install git sudo wget ccache")
+            hashid = working_container.commit("cab/seed/suse", "leap-15.2")
+            return hashid
 
     @classmethod
     def build_base_image(cls,
                          vendor: str, release: str,
                          sourcepath: Path,
-                         binpath: Path) -> str:
+                         binpath: Path,
+                         spec_cache: Path) -> str:
         pinfo(f"=> building base image for vendor {vendor} release {release}")
 
         assert binpath.exists()
@@ -191,59 +192,66 @@ class ImageBuilder:
         print(f"sourcepaht: {sourcepath}")
 
         # assume base suse image exists for now
-        working_container = Buildah('cab/seed/suse:leap-15.2')
-        # Assume that's me for now.
-        # We should make this configurable, or infer from something?
-        working_container.set_author("Joao Eduardo Luis", "joao@suse.com")
-        working_container.set_label("cab.ceph-vendor", vendor)
-        working_container.set_label("cab.cab-release", release)
-
-        working_container.run("mkdir -p /build/sources")
-        working_container.run("mkdir -p /build/bin")
-        working_container.config("--workingdir /build/sources")
-        working_container.run("/bin/bash ./install-deps.sh",
-                              volumes=[(str(sourcepath), "/build/sources")],
-                              capture_output=False)
-        working_container.run(
-                "/bin/bash /build/bin/install-requirements.sh",
-                volumes=[
-                    (str(binpath), "/build/bin"),
-                    (str(sourcepath), "/build/sources")
-                ], capture_output=False)
-        working_container.config("--workingdir /")
-        working_container.run("rm -fr /build")
-
-        image_name = f"cab/base/{vendor}"
-        image_name_tagged = f"{image_name}:{release}"
-        hashid = working_container.commit(image_name, release)
-        pinfo(f"=> container image {image_name_tagged} ({hashid[:12]})")
-        return hashid
+        with Buildah('cab/seed/suse:leap-15.2',
+                     owner=f"base-{vendor}-{release}") as working_container:
+            # Assume that's me for now.
+            # We should make this configurable, or infer from something?
+            working_container.set_author("Joao Eduardo Luis", "joao@suse.com")
+            working_container.set_label("cab.ceph-vendor", vendor)
+            working_container.set_label("cab.cab-release", release)
+
+            working_container.run("mkdir -p /build/sources")
+            working_container.run("mkdir -p /build/bin")
+            working_container.config("--workingdir /build/sources")
+            working_container.run(
+                    "/bin/bash ./install-deps.sh",
+                    volumes=[(str(sourcepath), "/build/sources")],
+                    capture_output=False)
+            spec_cache.mkdir(parents=True, exist_ok=True)
+            working_container.run(
+                    "/bin/bash /build/bin/install-requirements.sh",
+                    volumes=[
+                        (str(binpath), "/build/bin"),
+                        (str(Path(__file__).parent), "/build/cab"),
+                        (str(spec_cache), "/build/spec-cache"),
+                        (str(sourcepath), "/build/sources")
+                    ], capture_output=False)
+            working_container.config("--workingdir /")
+            working_container.run("rm -fr /build")
+
+            image_name = f"cab/base/{vendor}"
+            image_name_tagged = f"{image_name}:{release}"
+            hashid = working_container.commit(image_name, release)
+            pinfo(f"=> container image {image_name_tagged} ({hashid[:12]})")
+            return hashid
 
     @classmethod
     def build_builder_image(cls, vendor: str, release: str) -> str:
         pinfo(
             f"=> building builder image for vendor {vendor} release {release}")
 
-        working_container = Buildah(f'cab/base/{vendor}:{release}')
-        working_container.set_author("Joao Eduardo Luis", "joao@suse.com")
-
-        working_container.run("mkdir -p /build")
-        working_container.run("useradd -d /build builder")
-        working_container.run("chown builder:users /build")
-        working_container.config("--user builder:users")
-        working_container.run("mkdir -p /build/src")
-        working_container.run("mkdir -p /build/ccache")
-        working_container.run("mkdir -p /build/bin")
-        working_container.run("mkdir -p /build/out")
-        working_container.config("--workingdir /build")
-        volume_str = \
-            '"/build/src","/build/ccache","/build/bin","/build/out"'
-        working_container.config(f"--volume {volume_str}")
-        entrypoint = '"/build/bin/entrypoint.sh"'
-        working_container.config(f"--entrypoint {entrypoint}")
-
-        hashid = working_container.commit(f"cab/builder/{vendor}", release)
-        return hashid
+        with Buildah(f'cab/base/{vendor}:{release}',
+                     owner=f"builder-{vendor}-{release}") \
+                as working_container:
+            working_container.set_author("Joao Eduardo Luis", "joao@suse.com")
+
+            working_container.run("mkdir -p /build")
+            working_container.run("useradd -d /build builder")
+            working_container.run("chown builder:users /build")
+            working_container.config("--user builder:users")
+            working_container.run("mkdir -p /build/src")
+            working_container.run("mkdir -p /build/ccache")
+            working_container.run("mkdir -p /build/bin")
+            working_container.run("mkdir -p /build/out")
+            working_container.config("--workingdir /build")
+            volume_str = \
+                '"/build/src","/build/ccache","/build/bin","/build/out"'
+            working_container.config(f"--volume {volume_str}")
+            entrypoint = '"/build/bin/entrypoint.sh"'
+            working_container.config(f"--entrypoint {entrypoint}")
+
+            hashid = working_container.commit(f"cab/builder/{vendor}", release)
+            return hashid
 
 
 class ImageChecker:
@@ -269,7 +277,8 @@ class ImageChecker:
             vendor: str,
             release: str,
             sourcepath: Path,
-            binpath: Path
+            binpath: Path,
+            spec_cache: Path
     ) -> bool:
 
         image: Optional[ContainerImage] = \
@@ -282,7 +291,8 @@ class ImageChecker:
         assert binpath.exists()
         assert binpath.is_dir()
 
-        if ImageBuilder.build_base_image(vendor, release, sourcepath, binpath):
+        if ImageBuilder.build_base_image(vendor, release, sourcepath,
+                                         binpath, spec_cache):
             pinfo("=> created base image for "
                   f"vendor {vendor} release {release}")
             return True
@@ -317,7 +327,8 @@ class ImageChecker:
             vendor: str,
             release: str,
             sourcepath: Path,
-            binpath: Path
+            binpath: Path,
+            spec_cache: Path
     ) -> bool:
 
         pinfo("=> checking images availability...")
@@ -325,7 +336,8 @@ class ImageChecker:
             perror("=> seed image does not exist!")
             return False
 
-        cls.check_create_base_image(vendor, release, sourcepath, binpath)
+        cls.check_create_base_image(vendor, release, sourcepath, binpath,
+                                    spec_cache)
         cls.check_create_builder_image(vendor, release)
         return True
 
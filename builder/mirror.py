@@ -0,0 +1,214 @@
+import errno
+import json
+import os
+import re
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+from .utils import CABError
+from .trace import Trace
+
+
+class MirrorError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+def _git(args: List[str], cwd: Optional[Path] = None) -> str:
+    proc = Trace.run(["git"] + args, cwd=cwd,
+                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise MirrorError(errno.EIO, proc.stderr.decode("utf-8").strip())
+    return proc.stdout.decode("utf-8")
+
+
+def get_mirror_name(url: str) -> str:
+    """ Where, relative to the mirrors directory, a repository is mirrored.
+
+        https://github.com/ceph/ceph.git -> github.com/ceph/ceph.git
+        git@github.com:ceph/ceph -> github.com/ceph/ceph.git
+    """
+    parsed = urlparse(url)
+    if parsed.scheme and parsed.netloc:
+        name = f"{parsed.hostname}{parsed.path}"
+    elif re.match(r'^[^/]+@[^/:]+:', url):
+        name = url.split('@', 1)[1].replace(':', '/', 1)
+    else:
+        name = url.lstrip('/')
+    name = name.rstrip('/')
+    if not name.endswith(".git"):
+        name += ".git"
+    parts = [p for p in name.split('/') if p not in ['', '.', '..']]
+    return '/'.join(parts)
+
+
+def resolve_submodule_url(parent_url: str, url: str) -> str:
+    """ Submodule urls may be relative to their superproject's. """
+    if not url.startswith("./") and not url.startswith("../"):
+        return url
+    base = parent_url.rstrip('/')
+    if base.endswith(".git"):
+        base = base[:-len(".git")]
+    for part in url.split('/'):
+        if part == "..":
+            base = base.rsplit('/', 1)[0]
+        elif part not in ['', '.']:
+            base = f"{base}/{part}"
+    return base
+
+
+class GitMirror:
+    """ A bare mirror of a remote repository.
+
+        Clones reference the mirror's objects through git's alternates, by
+        the mirror's path on the host, where builds mount it too; so the
+        mirror never prunes unreachable objects, otherwise clones still
+        relying on them would break.
+    """
+
+    _url: str
+    _path: Path
+
+    def __init__(self, url: str, path: Path):
+        self._url = url
+        self._path = path
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def exists(self) -> bool:
+        return self._path.joinpath("HEAD").exists()
+
+    def create(self) -> None:
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        _git(["clone", "--mirror", "--quiet", self._url, str(self._path)])
+        _git(["config", "gc.pruneExpire", "never"], cwd=self._path)
+        _git(["config", "gc.reflogExpireUnreachable", "never"],
+             cwd=self._path)
+
+    def sync(self) -> None:
+        if not self.exists():
+            self.create()
+            return
+        _git(["remote", "update"], cwd=self._path)
+
+    def get_submodule_urls(self) -> List[str]:
+        """ Submodules at the mirror's HEAD, with absolute urls. """
+        try:
+            out = _git(["config", "--blob", "HEAD:.gitmodules",
+                        "--get-regexp", r"^submodule\..*\.url$"],
+                       cwd=self._path)
+        except MirrorError:
+            # no submodules.
+            return []
+        urls: List[str] = []
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            urls.append(resolve_submodule_url(self._url, fields[1]))
+        return urls
+
+
+class MirrorCache:
+    """ Bare mirrors of repositories, and of their submodules, recursively,
+        kept under cab's data directory.
+
+        An index maps each mirrored url to its mirror, so that builds can
+        have their submodules fetched from the mirrors instead of upstream.
+    """
+
+    CONTAINER_PATH: str = "/build/mirrors"
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def _get_index_path(self) -> Path:
+        return self._path.joinpath("index.json")
+
+    def get_index(self) -> Dict[str, str]:
+        path = self._get_index_path()
+        if not path.exists():
+            return {}
+        with path.open('r') as fd:
+            return json.load(fd)
+
+    def _write_index(self, index: Dict[str, str]) -> None:
+        self._path.mkdir(parents=True, exist_ok=True)
+        path = self._get_index_path()
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open('w') as fd:
+            json.dump(index, fd, indent=2, sort_keys=True)
+        tmp.replace(path)
+
+    def get_mirror(self, url: str) -> GitMirror:
+        return GitMirror(url, self._path.joinpath(get_mirror_name(url)))
+
+    def find_mirror(self, url: str) -> Optional[GitMirror]:
+        mirror = self.get_mirror(url)
+        if not mirror.exists():
+            return None
+        return mirror
+
+    def sync(self,
+             urls: List[str],
+             jobs: int = 4
+             ) -> Tuple[List[str], Dict[str, str]]:
+        """ Create or update mirrors for 'urls', and for their submodules,
+            'jobs' at a time. Returns the mirrors synced, and those failing,
+            with the reason why.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        synced: List[str] = []
+        failed: Dict[str, str] = {}
+        seen: Set[str] = set()
+        pending = list(dict.fromkeys(urls))
+
+        def _sync_one(url: str) -> List[str]:
+            mirror = self.get_mirror(url)
+            mirror.sync()
+            return mirror.get_submodule_urls()
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            while len(pending) > 0:
+                batch = [u for u in dict.fromkeys(pending) if u not in seen]
+                seen.update(batch)
+                pending = []
+                futures = {u: executor.submit(_sync_one, u) for u in batch}
+                for url, future in futures.items():
+                    try:
+                        pending.extend(future.result())
+                        synced.append(url)
+                    except MirrorError as e:
+                        failed[url] = str(e)
+
+        index = self.get_index()
+        for url in synced:
+            index[url] = get_mirror_name(url)
+        self._write_index(index)
+        return synced, failed
+
+    def get_git_config(self) -> List[str]:
+        """ git config rewriting mirrored urls to their mirrors, as seen
+            within the builder container.
+        """
+        config: List[str] = []
+        for url, name in sorted(self.get_index().items()):
+            if not self._path.joinpath(name, "HEAD").exists():
+                continue
+            config.append(
+                f"url.{self.CONTAINER_PATH}/{name}.insteadOf={url}")
+        return config
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+#
+# NOTE: this module is run under 'buildah unshare', so we are able to set
+# ownership to users within the container's user namespace; it must only rely
+# on the standard library.
+#
+import argparse
+import glob
+import json
+import os
+import stat
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class OwnershipEntry:
+    """ Final mode and ownership for a path in the image's root. """
+
+    path: Path
+    mode: Optional[int]
+    uid: Optional[int]
+    gid: Optional[int]
+
+    def __init__(self, path: Path, mode: Optional[int],
+                 uid: Optional[int], gid: Optional[int]):
+        self.path = path
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+
+    def apply(self) -> bool:
+        """ Apply mode and ownership, if they differ from the current ones.
+
+            On overlay filesystems changing a file's metadata copies it up to
+            the upper layer; by only touching what differs, files already
+            with the right metadata in a lower layer are left alone.
+        """
+        st = os.lstat(self.path)
+        changed = False
+        uid = self.uid if self.uid is not None else st.st_uid
+        gid = self.gid if self.gid is not None else st.st_gid
+        if (uid, gid) != (st.st_uid, st.st_gid):
+            os.lchown(self.path, uid, gid)
+            changed = True
+        if self.mode is not None and not stat.S_ISLNK(st.st_mode) and \
+                stat.S_IMODE(st.st_mode) != self.mode:
+            # chown may clear setuid/setgid bits; chmod after.
+            os.chmod(self.path, self.mode)
+            changed = True
+        return changed
+
+
+def _read_ids(path: Path) -> Dict[str, int]:
+    ids: Dict[str, int] = {}
+    if not path.exists():
+        return ids
+    for line in path.read_text().splitlines():
+        fields = line.split(':')
+        if len(fields) < 3:
+            continue
+        try:
+            ids[fields[0]] = int(fields[2])
+        except ValueError:
+            continue
+    return ids
+
+
+def _is_glob(path: str) -> bool:
+    return any(c in path for c in "*?[")
+
+
+def resolve(attrs: List[Dict[str, str]],
+            root: Path
+            ) -> Tuple[List[OwnershipEntry], List[str]]:
+    """ Resolve the spec's %attr entries against the image mounted at 'root',
+        using its users and groups. Returns the resolved entries, and a list
+        of problems found (unknown users, missing paths).
+    """
+    users = _read_ids(root.joinpath("etc", "passwd"))
+    groups = _read_ids(root.joinpath("etc", "group"))
+    users.setdefault("root", 0)
+    groups.setdefault("root", 0)
+    entries: List[OwnershipEntry] = []
+    problems: List[str] = []
+
+    for attr in attrs:
+        mode: Optional[int] = None
+        if attr['mode'] != '-':
+            mode = int(attr['mode'], 8)
+        uid: Optional[int] = None
+        if attr['user'] != '-':
+            uid = users.get(attr['user'])
+            if uid is None:
+                problems.append(f"unknown user '{attr['user']}'")
+        gid: Optional[int] = None
+        if attr['group'] != '-':
+            gid = groups.get(attr['group'])
+            if gid is None:
+                problems.append(f"unknown group '{attr['group']}'")
+
+        relpath = attr['path'].lstrip('/')
+        paths: List[Path] = []
+        if _is_glob(relpath):
+            paths = [Path(p) for p in
+                     glob.glob(str(root.joinpath(relpath)))]
+        elif root.joinpath(relpath).exists() or \
+                root.joinpath(relpath).is_symlink():
+            paths = [root.joinpath(relpath)]
+        if len(paths) == 0:
+            problems.append(f"missing path '{attr['path']}'")
+            continue
+        for path in paths:
+            entries.append(OwnershipEntry(path, mode, uid, gid))
+    return entries, sorted(set(problems))
+
+
+def get_managed_files(attrs: List[Dict[str, str]], root: Path) -> List[str]:
+    """ Regular files, relative to 'root', whose mode and ownership are set
+        by the spec; directories are not included.
+    """
+    files: List[str] = []
+    for attr in attrs:
+        relpath = attr['path'].lstrip('/')
+        if _is_glob(relpath):
+            paths = [Path(p) for p in glob.glob(str(root.joinpath(relpath)))]
+        else:
+            paths = [root.joinpath(relpath)]
+        for path in paths:
+            if path.is_file() and not path.is_symlink():
+                files.append(str(path.relative_to(root)))
+    return sorted(set(files))
+
+
+def apply(attrs: List[Dict[str, str]], root: Path) -> Dict[str, Any]:
+    entries, problems = resolve(attrs, root)
+    changed = 0
+    for entry in entries:
+        if entry.apply():
+            changed += 1
+    return {
+        'entries': len(entries),
+        'changed': changed,
+        'problems': problems
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="apply the spec's modes and ownership to an image root")
+    parser.add_argument("root", type=str, help="image's mounted root")
+    parser.add_argument("attrs", type=str, help="json list of %%attr entries")
+    args = parser.parse_args()
+
+    attrs = json.loads(Path(args.attrs).read_text())
+    result = apply(attrs, Path(args.root))
+    print(json.dumps(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
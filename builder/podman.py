@@ -1,4 +1,6 @@
+import errno
 import json
+from pathlib import Path
 from datetime import datetime as dt
 from typing import List, Tuple, Dict, Any, Optional
 from .utils import run_cmd, CABError, parse_datetime
@@ -80,3 +82,47 @@ class Podman:
     @classmethod
     def remove_image(cls, image: str) -> Tuple[int, List[str]]:
         return cls._run(f"rmi {image}", capture_output=True)
+
+    @classmethod
+    def remove_images(cls, images: List[str]) -> Tuple[int, List[str]]:
+        return cls._run(f"rmi {' '.join(images)}", capture_output=True)
+
+    @classmethod
+    def find_containers(cls, spec: str) -> List[Dict[str, Any]]:
+        """ Containers, as inspected, by id or name, or running with the
+            label 'key=value', as given by 'spec'.
+        """
+        if '=' in spec:
+            ret, result = cls._run(
+                f"ps --quiet --no-trunc --filter label={spec}")
+            if ret != 0:
+                raise_podman_error(ret, result)
+            ids = [x for x in result if len(x) > 0]
+            if len(ids) == 0:
+                return []
+        else:
+            ids = [spec]
+        ret, result = cls._run(f"container inspect {' '.join(ids)}")
+        if ret != 0:
+            raise_podman_error(ret, result)
+        return json.loads('\n'.join(result))
+
+    @classmethod
+    def mount_container(cls, container: str) -> Path:
+        """ Mount a container's root; rootless, it is only reachable from
+            within 'podman unshare'.
+        """
+        ret, result = cls._run(f"unshare podman mount {container}")
+        if ret != 0:
+            raise_podman_error(ret, result)
+        if len(result) == 0:
+            raise_podman_error(errno.EIO, f"unable to mount {container}")
+        return Path(result[0])
+
+    @classmethod
+    def unmount_container(cls, container: str) -> Tuple[int, List[str]]:
+        return cls._run(f"unshare podman unmount {container}")
+
+    @classmethod
+    def restart_container(cls, container: str) -> Tuple[int, List[str]]:
+        return cls._run(f"restart {container}")
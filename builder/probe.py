@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+#
+# NOTE: this module is run within the image being benchmarked, by its own
+# python; it must only rely on the standard library, and run on python 3.6.
+#
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+# imports every mgr module, as ceph-mgr would, with its C module stubbed.
+MGR_IMPORT_SCRIPT = """
+import os, sys, types
+class _Stub(types.ModuleType):
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return type(name, (object,), {})
+sys.modules['ceph_module'] = _Stub('ceph_module')
+root = '/usr/share/ceph/mgr'
+sys.path.insert(0, root)
+for name in sorted(os.listdir(root)):
+    if not os.path.exists(os.path.join(root, name, '__init__.py')):
+        continue
+    try:
+        __import__(name)
+    except Exception:
+        pass
+"""
+
+PROBES: Dict[str, List[str]] = {
+    "ceph --version": ["ceph", "--version"],
+    "ceph-osd --version": ["ceph-osd", "--version"],
+    "mgr modules": ["python3", "-c", MGR_IMPORT_SCRIPT],
+    "cephadm --help": ["cephadm", "--help"]
+}
+
+
+def run_once(argv: List[str]) -> Dict[str, Any]:
+    """ Wall time, peak RSS and what was read from disk, by 'argv'. """
+    start = time.perf_counter()
+    try:
+        proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+    except OSError as e:
+        return {'error': str(e)}
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+        else -os.WTERMSIG(status)
+    return {
+        'wall_secs': wall,
+        'maxrss_kb': usage.ru_maxrss,
+        'major_faults': usage.ru_majflt,
+        'read_blocks': usage.ru_inblock,
+        'returncode': proc.returncode
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="measure how long commands take to start")
+    parser.add_argument("probe", type=str, choices=list(PROBES.keys()))
+    parser.add_argument("-n", "--runs", type=int, default=3,
+                        help="runs after the first one")
+    args = parser.parse_args()
+
+    argv = PROBES[args.probe]
+    first = run_once(argv)
+    warm = [run_once(argv) for _ in range(args.runs)]
+    print(json.dumps({'first': first, 'warm': warm}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+import bisect
+import json
+import os
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class ProfileEntry:
+    """ A single target built, and when, in milliseconds. """
+
+    target: str
+    start: int
+    end: int
+
+    def __init__(self, target: str, start: int, end: int):
+        self.target = target
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self) -> int:
+        return max(0, self.end - self.start)
+
+    @property
+    def kind(self) -> str:
+        suffix = Path(self.target).suffix
+        if suffix in [".o", ".obj"]:
+            return "compile"
+        elif suffix in [".so", ".a"] or suffix == "" or \
+                ".so." in Path(self.target).name:
+            return "link"
+        return "other"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'target': self.target, 'start': self.start, 'end': self.end}
+
+
+class BuildProfile:
+    """ Per-target build timings for one build run.
+
+        Timings come either from ninja's log, in the build directory, or, for
+        make builds, from the log written by 'bin/cab-make-shell.sh', which
+        follows the same format:
+
+            <start ms> <end ms> <mtime> <target> <hash>
+
+        ninja's times are relative to each ninja invocation, so a single log
+        may contain several timelines; we tell them apart by end times going
+        backwards, given ninja appends entries as they finish. Each timeline
+        is a 'segment', and wall-clock figures are summed over segments.
+
+        We don't know the dependency graph, so the critical path is estimated
+        as the longest chain of targets that were built back-to-back, each
+        starting only after the previous finished, summed over segments. It
+        is an upper bound for the real critical path.
+    """
+
+    _entries: List[ProfileEntry]
+    _segments: List[List[ProfileEntry]]
+    _jobs: int
+    _tool: str
+    _created: str
+
+    # cmake's compiler checks are not part of the build proper.
+    IGNORE: List[str] = ["CMakeFiles/CMakeTmp", "CMakeFiles/CMakeScratch"]
+
+    def __init__(self, tool: str, segments: List[List[ProfileEntry]],
+                 jobs: Optional[int] = None, created: Optional[str] = None):
+        self._tool = tool
+        self._segments = [s for s in segments if len(s) > 0]
+        self._entries = [e for s in self._segments for e in s]
+        self._jobs = jobs or os.cpu_count() or 1
+        self._created = created or dt.now().isoformat()
+
+    @classmethod
+    def _parse_log(cls,
+                   lines: List[str],
+                   prefix: str = ""
+                   ) -> List[List[ProfileEntry]]:
+        segments: List[List[ProfileEntry]] = [[]]
+        last_end: int = -1
+        for line in lines:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5:
+                fields = line.split()
+            if len(fields) != 5:
+                continue
+            try:
+                start, end = int(fields[0]), int(fields[1])
+            except ValueError:
+                continue
+            target = fields[3]
+            if any(x in target for x in cls.IGNORE):
+                continue
+            if prefix and target.startswith(prefix):
+                target = target[len(prefix):]
+            if end < last_end:
+                segments.append([])
+            last_end = end
+            segments[-1].append(ProfileEntry(target, start, end))
+        return segments
+
+    @classmethod
+    def from_ninja_log(cls, path: Path, offset: int = 0) -> 'BuildProfile':
+        """ Read entries appended to ninja's log past 'offset'. """
+        with path.open('r') as fd:
+            if 0 < offset <= path.stat().st_size:
+                fd.seek(offset)
+            lines = fd.readlines()
+        return BuildProfile("ninja", cls._parse_log(lines))
+
+    @classmethod
+    def from_make_log(cls, path: Path, builddir: str) -> 'BuildProfile':
+        with path.open('r') as fd:
+            lines = fd.readlines()
+        prefix = builddir.rstrip('/') + '/'
+        return BuildProfile("make", cls._parse_log(lines, prefix))
+
+    @classmethod
+    def get_ninja_log_offset(cls, build_dir: Optional[Path]) -> int:
+        if build_dir is None:
+            return 0
+        path = build_dir.joinpath(".ninja_log")
+        if not path.exists():
+            return 0
+        return path.stat().st_size
+
+    @classmethod
+    def collect(cls,
+                build_dir: Optional[Path],
+                run_dir: Path,
+                ninja_offset: int
+                ) -> Optional['BuildProfile']:
+        """ Collect the profile of the build that just ran.
+
+            Build directories on a tmpfs are gone by now; the entrypoint
+            leaves us a copy of ninja's log in the run directory.
+        """
+        make_log = run_dir.joinpath("make-timings")
+        ninja_log = run_dir.joinpath("ninja-log")
+        if not ninja_log.exists() and build_dir is not None:
+            ninja_log = build_dir.joinpath(".ninja_log")
+        if ninja_log.exists() and ninja_log.stat().st_size != ninja_offset:
+            return cls.from_ninja_log(ninja_log, ninja_offset)
+        elif make_log.exists():
+            return cls.from_make_log(make_log, "/build/src/build")
+        return None
+
+    @property
+    def entries(self) -> List[ProfileEntry]:
+        return self._entries
+
+    @property
+    def tool(self) -> str:
+        return self._tool
+
+    @property
+    def created(self) -> str:
+        return self._created
+
+    @property
+    def jobs(self) -> int:
+        return self._jobs
+
+    def get_wall_time(self) -> int:
+        return sum([max(e.end for e in s) - min(e.start for e in s)
+                    for s in self._segments])
+
+    def get_total_time(self) -> int:
+        return sum([e.duration for e in self._entries])
+
+    def get_parallelism(self) -> float:
+        wall = self.get_wall_time()
+        if wall == 0:
+            return 0.0
+        return self.get_total_time() / wall
+
+    def get_utilization(self) -> float:
+        return self.get_parallelism() / self._jobs
+
+    def get_critical_path(self) -> Tuple[int, List[ProfileEntry]]:
+        crit_len: int = 0
+        crit_path: List[ProfileEntry] = []
+        for segment in self._segments:
+            entries = sorted(segment, key=lambda e: e.end)
+            ends = [e.end for e in entries]
+            # longest chain ending at each entry, and the best chain among
+            # the first i entries (by end time).
+            chain: List[Tuple[int, Optional[int]]] = []
+            prefix_best: List[int] = []
+            for i, entry in enumerate(entries):
+                n = bisect.bisect_right(ends, entry.start, 0, i)
+                prev_idx = prefix_best[n - 1] if n > 0 else None
+                prev_len = chain[prev_idx][0] if prev_idx is not None else 0
+                chain.append((prev_len + entry.duration, prev_idx))
+                if i == 0 or chain[i][0] > chain[prefix_best[i - 1]][0]:
+                    prefix_best.append(i)
+                else:
+                    prefix_best.append(prefix_best[i - 1])
+            if len(entries) == 0:
+                continue
+            last: Optional[int] = prefix_best[-1]
+            assert last is not None
+            crit_len += chain[last][0]
+            path: List[ProfileEntry] = []
+            while last is not None:
+                path.append(entries[last])
+                last = chain[last][1]
+            crit_path.extend(reversed(path))
+        return crit_len, crit_path
+
+    def get_slowest(self, kind: str, top: int = 10) -> List[ProfileEntry]:
+        entries = [e for e in self._entries if e.kind == kind]
+        return sorted(entries, key=lambda e: e.duration, reverse=True)[:top]
+
+    def get_by_directory(self, top: int = 10) -> List[Tuple[str, int, int]]:
+        """ Compile time per source directory, as (dir, ms, num targets). """
+        dirs: Dict[str, Tuple[int, int]] = {}
+        for e in self._entries:
+            if e.kind != "compile":
+                continue
+            # src/osd/CMakeFiles/osd.dir/OSD.cc.o -> src/osd
+            parts = Path(e.target).parts
+            if "CMakeFiles" in parts:
+                parts = parts[:parts.index("CMakeFiles")]
+            else:
+                parts = parts[:-1]
+            d = str(Path(*parts)) if len(parts) > 0 else "."
+            ms, n = dirs.get(d, (0, 0))
+            dirs[d] = (ms + e.duration, n + 1)
+        lst = [(d, ms, n) for d, (ms, n) in dirs.items()]
+        return sorted(lst, key=lambda x: x[1], reverse=True)[:top]
+
+    def get_durations(self) -> Dict[str, int]:
+        durations: Dict[str, int] = {}
+        for e in self._entries:
+            durations[e.target] = durations.get(e.target, 0) + e.duration
+        return durations
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'tool': self._tool,
+            'created': self._created,
+            'jobs': self._jobs,
+            'segments': [[e.to_dict() for e in s] for s in self._segments]
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> 'BuildProfile':
+        segments = [[ProfileEntry(e['target'], e['start'], e['end'])
+                     for e in s] for s in d['segments']]
+        return BuildProfile(d['tool'], segments,
+                            jobs=d['jobs'], created=d['created'])
+
+
+class ProfileDiff:
+    """ Per-target differences between two profiles. """
+
+    old: BuildProfile
+    new: BuildProfile
+
+    def __init__(self, old: BuildProfile, new: BuildProfile):
+        self.old = old
+        self.new = new
+
+    def get_changes(self) -> List[Tuple[str, int, int]]:
+        """ List of (target, old ms, new ms), by decreasing difference.
+
+            Targets not built in one of the profiles have 0 ms in it; for
+            incremental builds, these tell which targets got rebuilt.
+        """
+        old = self.old.get_durations()
+        new = self.new.get_durations()
+        changes = [(t, old.get(t, 0), new.get(t, 0))
+                   for t in set(old.keys()) | set(new.keys())]
+        return sorted(changes, key=lambda c: c[2] - c[1], reverse=True)
+
+
+class ProfileStore:
+    """ Stores build profiles, per build, one json file per run. """
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    def _get_build_path(self, buildname: str) -> Path:
+        return self._path.joinpath(buildname)
+
+    def store(self, buildname: str, profile: BuildProfile) -> Path:
+        path = self._get_build_path(buildname)
+        path.mkdir(parents=True, exist_ok=True)
+        stamp = dt.fromisoformat(profile.created).strftime("%Y%m%dT%H%M%S")
+        profile_path = path.joinpath(f"{stamp}.json")
+        with profile_path.open('w') as fd:
+            json.dump(profile.to_dict(), fd)
+        return profile_path
+
+    def get_profiles(self, buildname: str) -> List[Path]:
+        path = self._get_build_path(buildname)
+        if not path.exists():
+            return []
+        return sorted(path.glob("*.json"))
+
+    def load(self, path: Path) -> BuildProfile:
+        with path.open('r') as fd:
+            return BuildProfile.from_dict(json.load(fd))
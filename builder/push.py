@@ -0,0 +1,424 @@
+import argparse
+import click
+import errno
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, \
+    wait
+from contextlib import contextmanager
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from .compression import ImageCompression
+from .registry import OCILayout, RegistryClient
+from .utils import pwarn
+
+
+class PushEntry:
+    """ A build's queued push. There is at most one per build: queueing a
+        newer image supersedes the one pending, given only the build's
+        latest image matters.
+    """
+
+    build: str
+    image: str
+    repo: str
+    tag: str
+    registry: str
+    secure: bool
+    compression: Optional[Dict[str, Any]]
+    generation: int
+    state: str
+    attempts: int
+    queued: float
+    next_attempt: float
+    finished: Optional[float]
+    error: Optional[str]
+    uploaded_bytes: int
+
+    def __init__(self, build: str, image: str, repo: str, tag: str,
+                 registry: str, secure: bool,
+                 compression: Optional[ImageCompression] = None):
+        self.build = build
+        self.image = image
+        self.repo = repo
+        self.tag = tag
+        self.registry = registry
+        self.secure = secure
+        self.compression = \
+            compression.to_dict() if compression is not None else None
+        self.generation = 0
+        self.state = "pending"
+        self.attempts = 0
+        self.queued = time.time()
+        self.next_attempt = self.queued
+        self.finished = None
+        self.error = None
+        self.uploaded_bytes = 0
+
+    def get_compression(self) -> Optional[ImageCompression]:
+        if self.compression is None:
+            return None
+        return ImageCompression.from_dict(self.compression)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> 'PushEntry':
+        entry = PushEntry(d['build'], d['image'], d['repo'], d['tag'],
+                          d['registry'], d['secure'])
+        for k, v in d.items():
+            setattr(entry, k, v)
+        return entry
+
+
+class PushQueue:
+    """ Persistent queue of image pushes, processed by a background worker.
+
+        The queue is a json file, only ever accessed while holding a lock on
+        its side file, so builds may queue pushes while the worker runs.
+    """
+
+    MAX_ATTEMPTS: int = 8
+    BACKOFF_SECS: float = 30.0
+    MAX_BACKOFF_SECS: float = 30 * 60.0
+    # how long the worker may be missing before it's taken for gone, e.g.
+    # while just started, and how many times it is started again then.
+    WORKER_GRACE_SECS: float = 5.0
+    WORKER_RESTARTS: int = 3
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def get_log_path(self) -> Path:
+        return self._path.joinpath("worker.log")
+
+    @classmethod
+    def _dump(cls, entries: Dict[str, PushEntry]) -> str:
+        return json.dumps({k: v.to_dict() for k, v in entries.items()},
+                          indent=2)
+
+    @contextmanager
+    def _locked(self) -> Iterator[Dict[str, PushEntry]]:
+        """ The queue's entries, written back if changed. A queue that can't
+            be read is moved aside, rather than overwritten.
+        """
+        self._path.mkdir(parents=True, exist_ok=True)
+        queue_path = self._path.joinpath("queue.json")
+        with self._path.joinpath("queue.lock").open('w') as lockfd:
+            fcntl.flock(lockfd, fcntl.LOCK_EX)
+            entries: Dict[str, PushEntry] = {}
+            if queue_path.exists():
+                try:
+                    raw = json.loads(queue_path.read_text())
+                    entries = {k: PushEntry.from_dict(v)
+                               for k, v in raw.items()}
+                except (json.JSONDecodeError, KeyError, AttributeError):
+                    corrupt = queue_path.with_suffix(
+                        f".corrupt.{int(time.time())}")
+                    queue_path.replace(corrupt)
+                    pwarn(f"=> push queue unreadable; moved to {corrupt}")
+            before = self._dump(entries)
+            yield entries
+            after = self._dump(entries)
+            if after == before and queue_path.exists():
+                return
+            tmp = queue_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(after)
+            tmp.replace(queue_path)
+
+    def enqueue(self, entry: PushEntry) -> bool:
+        """ Queue a push, superseding the build's previous one, if any.
+            Returns whether a push not yet done was superseded.
+        """
+        with self._locked() as entries:
+            superseded = False
+            previous = entries.get(entry.build)
+            if previous is not None:
+                entry.generation = previous.generation + 1
+                superseded = previous.state in ["pending", "pushing"]
+            entries[entry.build] = entry
+        return superseded
+
+    def get_entries(self) -> List[PushEntry]:
+        with self._locked() as entries:
+            return sorted(entries.values(), key=lambda e: e.queued)
+
+    def get_entry(self, build: str) -> Optional[PushEntry]:
+        with self._locked() as entries:
+            return entries.get(build)
+
+    def remove(self, build: str) -> None:
+        with self._locked() as entries:
+            entries.pop(build, None)
+
+    def retry(self, build: Optional[str] = None) -> int:
+        """ Put failed pushes back in the queue; returns how many. """
+        n = 0
+        with self._locked() as entries:
+            for entry in entries.values():
+                if entry.state != "failed":
+                    continue
+                if build is not None and entry.build != build:
+                    continue
+                entry.state = "pending"
+                entry.attempts = 0
+                entry.next_attempt = time.time()
+                n += 1
+        return n
+
+    def _recover(self) -> None:
+        # pushes left behind by a worker that went away.
+        with self._locked() as entries:
+            for entry in entries.values():
+                if entry.state == "pushing":
+                    entry.state = "pending"
+
+    def _claim(self, slots: int, busy: List[str]
+               ) -> Tuple[List[PushEntry], Optional[float]]:
+        """ Mark up to 'slots' due pushes as in progress, other than those of
+            'busy' builds, still pushing a superseded image. Returns them, and
+            when the next pending push not yet due is, if any.
+        """
+        now = time.time()
+        claimed: List[PushEntry] = []
+        next_due: Optional[float] = None
+        with self._locked() as entries:
+            pending = sorted([e for e in entries.values()
+                              if e.state == "pending"],
+                             key=lambda e: e.next_attempt)
+            for entry in pending:
+                if entry.next_attempt > now:
+                    if next_due is None or entry.next_attempt < next_due:
+                        next_due = entry.next_attempt
+                elif len(claimed) < slots and entry.build not in busy:
+                    entry.state = "pushing"
+                    claimed.append(PushEntry.from_dict(entry.to_dict()))
+        return claimed, next_due
+
+    def _has_pending(self) -> bool:
+        with self._locked() as entries:
+            return any([e.state == "pending" for e in entries.values()])
+
+    def _complete(self, pushed: PushEntry,
+                  error: Optional[str] = None,
+                  uploaded_bytes: int = 0) -> None:
+        with self._locked() as entries:
+            entry = entries.get(pushed.build)
+            if entry is None or entry.generation != pushed.generation:
+                # superseded, or removed, while being pushed.
+                return
+            entry.finished = time.time()
+            if error is None:
+                entry.state = "done"
+                entry.error = None
+                entry.uploaded_bytes = uploaded_bytes
+                return
+            entry.attempts += 1
+            entry.error = error
+            if entry.attempts >= self.MAX_ATTEMPTS:
+                entry.state = "failed"
+                return
+            backoff = min(self.BACKOFF_SECS * 2 ** (entry.attempts - 1),
+                          self.MAX_BACKOFF_SECS)
+            entry.state = "pending"
+            entry.next_attempt = time.time() + backoff
+
+    def get_worker_pid(self) -> Optional[int]:
+        """ The running worker's pid, if any. """
+        path = self._path.joinpath("worker.lock")
+        if not path.exists():
+            return None
+        with path.open('r') as fd:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                pid = fd.read().strip()
+                return int(pid) if pid.isdigit() else -1
+        return None
+
+    def start_worker(self, jobs: int) -> None:
+        """ Spawn a background worker, unless one is running already. """
+        if self.get_worker_pid() is not None:
+            return
+        self._path.mkdir(parents=True, exist_ok=True)
+        rootdir = Path(__file__).resolve().parent.parent
+        with self.get_log_path().open('a') as log:
+            subprocess.Popen(
+                [sys.executable, "-m", "builder.push", str(self._path),
+                 "--jobs", str(jobs)],
+                cwd=rootdir, stdin=subprocess.DEVNULL, stdout=log,
+                stderr=log, start_new_session=True)
+
+    def wait(self, build: str, jobs: int, timeout: Optional[float] = None
+             ) -> Optional[PushEntry]:
+        """ Wait for a build's push to be done, or to fail for good.
+
+            Should the worker go away with the push still to be done, it is
+            started again, with 'jobs', up to 'WORKER_RESTARTS' times; then,
+            the push is reported as failed, but left queued.
+        """
+        start = time.time()
+        restarts = 0
+        gone_since: Optional[float] = None
+        while True:
+            entry = self.get_entry(build)
+            if entry is None or entry.state in ["done", "failed"]:
+                return entry
+            if timeout is not None and time.time() - start > timeout:
+                return entry
+            now = time.time()
+            if self.get_worker_pid() is not None:
+                gone_since = None
+            elif gone_since is None:
+                gone_since = now
+            elif now - gone_since > self.WORKER_GRACE_SECS:
+                if restarts >= self.WORKER_RESTARTS:
+                    entry.state = "failed"
+                    entry.error = f"push worker went away; see " \
+                                  f"{self.get_log_path()}"
+                    return entry
+                restarts += 1
+                self.start_worker(jobs)
+                gone_since = None
+            time.sleep(1.0)
+
+
+class PushWorker:
+    """ Processes a push queue until it is empty, pushing up to 'jobs' images
+        at a time. Only one worker runs per queue.
+    """
+
+    POLL_SECS: float = 5.0
+
+    _queue: PushQueue
+    _jobs: int
+    _clients: Dict[Tuple[str, bool], RegistryClient]
+
+    def __init__(self, queue: PushQueue, jobs: int = 2):
+        self._queue = queue
+        self._jobs = max(1, jobs)
+        self._clients = {}
+
+    def _log(self, what: str) -> None:
+        print(f"{dt.now().isoformat(timespec='seconds')} {what}", flush=True)
+
+    def _get_client(self, entry: PushEntry) -> RegistryClient:
+        # shared by concurrent pushes, so they share upload state.
+        key = (entry.registry, entry.secure)
+        if key not in self._clients:
+            self._clients[key] = RegistryClient(
+                entry.registry, secure=entry.secure,
+                state_path=self._queue.path.joinpath("state.json"))
+        return self._clients[key]
+
+    def _push(self, entry: PushEntry) -> int:
+        layout = OCILayout(self._queue.path.joinpath(entry.build))
+        layout.export(entry.image, entry.tag, entry.get_compression())
+        result = self._get_client(entry).push_image(
+            layout, entry.tag, entry.repo, [entry.tag])
+        # keep what was just pushed, so the next export can reuse it.
+        layout.prune([entry.tag])
+        self._log(f"{entry.build}: pushed {entry.image} to {entry.registry}: "
+                  f"{result.uploaded} uploaded ({result.uploaded_bytes} "
+                  f"bytes), {result.resumed} resumed, {result.mounted} "
+                  f"mounted, {result.existing} present")
+        return result.uploaded_bytes
+
+    def _run_one(self, entry: PushEntry) -> None:
+        try:
+            uploaded = self._push(entry)
+        except Exception as e:
+            # whatever goes wrong, the worker must carry on.
+            error = click.unstyle(str(e))
+            self._log(f"{entry.build}: push failed: {error}")
+            self._queue._complete(entry, error=error)
+            return
+        self._queue._complete(entry, uploaded_bytes=uploaded)
+
+    def _run_locked(self) -> bool:
+        lockpath = self._queue.path.joinpath("worker.lock")
+        self._queue.path.mkdir(parents=True, exist_ok=True)
+        with lockpath.open('a+') as lockfd:
+            try:
+                fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            lockfd.truncate(0)
+            lockfd.write(str(os.getpid()))
+            lockfd.flush()
+            self._queue._recover()
+            try:
+                self._loop()
+            finally:
+                lockfd.truncate(0)
+        return True
+
+    def run(self) -> bool:
+        """ Returns False if another worker is running. """
+        try:
+            if not self._run_locked():
+                return False
+            # a push queued just as we were done would have seen us still
+            # running, and not started a worker; don't leave it behind.
+            while self._queue._has_pending():
+                if not self._run_locked():
+                    break
+        finally:
+            for client in self._clients.values():
+                client.close()
+        return True
+
+    def _loop(self) -> None:
+        running: Dict[Future, PushEntry] = {}
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            while True:
+                claimed, next_due = self._queue._claim(
+                    self._jobs - len(running),
+                    [e.build for e in running.values()])
+                for entry in claimed:
+                    self._log(f"{entry.build}: pushing {entry.image} "
+                              f"(attempt {entry.attempts + 1})")
+                    running[executor.submit(self._run_one, entry)] = entry
+                if len(running) == 0 and next_due is None:
+                    break
+                # wake up periodically to pick up newly queued pushes.
+                timeout = self.POLL_SECS
+                if next_due is not None:
+                    timeout = min(timeout, max(0.0, next_due - time.time()))
+                if len(running) == 0:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(list(running.keys()), timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    future.result()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="cab push queue worker")
+    parser.add_argument("path", type=str)
+    parser.add_argument("--jobs", type=int, default=2)
+    args = parser.parse_args()
+
+    worker = PushWorker(PushQueue(Path(args.path)), args.jobs)
+    if not worker.run():
+        print("worker already running", file=sys.stderr)
+        return errno.EBUSY
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+#
+# NOTE: this module is run within the image being built, by its own python,
+# so the bytecode matches the interpreter the daemons will run with; it must
+# only rely on the standard library, and run on python 3.6.
+#
+import argparse
+import importlib.util
+import json
+import os
+import py_compile
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+# hash-based pycs (PEP 552) only depend on the source's contents, so
+# unchanged modules get identical pycs regardless of their mtime.
+HASH_BASED = sys.version_info >= (3, 7)
+
+COMPILED = "compiled"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+def is_current(source: str, cfile: str, data: bytes) -> bool:
+    """ Whether 'cfile' is already the bytecode for 'source'. """
+    try:
+        with open(cfile, 'rb') as fd:
+            header = fd.read(16)
+    except OSError:
+        return False
+    if header[:4] != importlib.util.MAGIC_NUMBER:
+        return False
+    if HASH_BASED:
+        flags = struct.unpack('<I', header[4:8])[0]
+        return (flags & 0x3) == 0x3 and \
+            header[8:16] == importlib.util.source_hash(data)
+    st = os.stat(source)
+    mtime, size = struct.unpack('<II', header[4:12])
+    return mtime == int(st.st_mtime) & 0xFFFFFFFF and \
+        size == st.st_size & 0xFFFFFFFF
+
+
+def compile_one(source: str) -> Tuple[str, str, str]:
+    """ Compile 'source', unless its bytecode is current. Returns the
+        source, what was done, and why it failed if it did.
+    """
+    cfile = importlib.util.cache_from_source(source)
+    try:
+        with open(source, 'rb') as fd:
+            data = fd.read()
+        if is_current(source, cfile, data):
+            return source, UNCHANGED, ""
+        if HASH_BASED:
+            py_compile.compile(
+                source, cfile=cfile, doraise=True,
+                invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+        else:
+            py_compile.compile(source, cfile=cfile, doraise=True)
+    except (py_compile.PyCompileError, OSError) as e:
+        return source, FAILED, str(e).strip().splitlines()[-1]
+    return source, COMPILED, ""
+
+
+def compile_all(sources: List[str], jobs: int) -> Dict[str, Any]:
+    counts: Dict[str, int] = {COMPILED: 0, UNCHANGED: 0, FAILED: 0}
+    errors: List[str] = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for source, what, err in executor.map(compile_one, sources,
+                                              chunksize=64):
+            counts[what] += 1
+            if what == FAILED:
+                errors.append(f"{source}: {err}")
+    result: Dict[str, Any] = dict(counts)
+    result['errors'] = errors
+    result['hash_based'] = HASH_BASED
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="byte-compile python modules, where not current")
+    parser.add_argument("sources", type=str,
+                        help="file listing the modules to compile")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of parallel compilers")
+    args = parser.parse_args()
+
+    with open(args.sources) as fd:
+        sources = [line.strip() for line in fd if len(line.strip()) > 0]
+    result = compile_all(sources, max(1, args.jobs or 1))
+    print(json.dumps(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
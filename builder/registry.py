@@ -0,0 +1,650 @@
+import base64
+import errno
+import json
+import os
+import queue
+import re
+import shlex
+import ssl
+import subprocess
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlencode, urlparse
+from .utils import CABError
+from .trace import Trace
+from .compression import ImageCompression
+
+
+class RegistryError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+MEDIA_TYPE_OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+
+
+class OCILayout:
+    """ An OCI image layout on disk, holding a build's images as they are to
+        be pushed, i.e. with compressed layers.
+
+        Images are exported from local storage by podman, which only
+        compresses layers the layout does not have yet; hence, exporting an
+        incremental image only costs its new layers.
+    """
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def export(self, image: str, ref: str,
+               compression: Optional[ImageCompression] = None) -> None:
+        self._path.mkdir(parents=True, exist_ok=True)
+        extra = ""
+        if compression is not None:
+            extra = compression.get_podman_args()
+        cmd = f"podman push --quiet {extra} {image} oci:{self._path}:{ref}"
+        proc = Trace.run(shlex.split(cmd), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RegistryError(errno.EIO,
+                                proc.stderr.decode("utf-8").strip())
+
+    def _read_index(self) -> Dict[str, Any]:
+        path = self._path.joinpath("index.json")
+        if not path.exists():
+            return {'schemaVersion': 2, 'manifests': []}
+        return json.loads(path.read_text())
+
+    def _write_index(self, index: Dict[str, Any]) -> None:
+        path = self._path.joinpath("index.json")
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(index))
+        tmp.replace(path)
+
+    def get_blob_path(self, digest: str) -> Path:
+        algo, value = digest.split(':', 1)
+        return self._path.joinpath("blobs", algo, value)
+
+    def get_manifest(self, ref: str) -> Tuple[bytes, str, str]:
+        """ The manifest for 'ref', its media type and its digest. """
+        for desc in self._read_index()['manifests']:
+            annotations = desc.get('annotations', {})
+            if annotations.get("org.opencontainers.image.ref.name") != ref:
+                continue
+            data = self.get_blob_path(desc['digest']).read_bytes()
+            media_type = desc.get('mediaType', MEDIA_TYPE_OCI_MANIFEST)
+            return data, media_type, desc['digest']
+        raise RegistryError(errno.ENOENT, f"no image '{ref}' in {self._path}")
+
+    def prune(self, keep: List[str]) -> int:
+        """ Drop all refs but 'keep', and the blobs only they referenced.
+            Returns the number of bytes freed.
+        """
+        index = self._read_index()
+        kept = [d for d in index['manifests']
+                if d.get('annotations', {}).get(
+                    "org.opencontainers.image.ref.name") in keep]
+        index['manifests'] = kept
+        self._write_index(index)
+
+        referenced = set()
+        for desc in kept:
+            referenced.add(desc['digest'])
+            manifest = json.loads(
+                self.get_blob_path(desc['digest']).read_bytes())
+            referenced.add(manifest['config']['digest'])
+            for layer in manifest['layers']:
+                referenced.add(layer['digest'])
+
+        freed = 0
+        blobs_dir = self._path.joinpath("blobs")
+        if not blobs_dir.exists():
+            return 0
+        for algo_dir in blobs_dir.iterdir():
+            for blob in algo_dir.iterdir():
+                if f"{algo_dir.name}:{blob.name}" in referenced:
+                    continue
+                freed += blob.stat().st_size
+                blob.unlink()
+        return freed
+
+
+def get_ssl_context(verify: bool) -> ssl.SSLContext:
+    ctx = ssl.create_default_context()
+    if not verify:
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+class ConnectionPool:
+    """ Keeps connections to the registry alive, and reuses them, one per
+        thread at a time; http.client connections are not thread safe.
+    """
+
+    _host: str
+    _https: bool
+    _verify: bool
+    _timeout: float
+    _idle: 'queue.LifoQueue[HTTPConnection]'
+
+    def __init__(self, host: str, https: bool, verify: bool = True,
+                 timeout: float = 10.0, size: int = 8):
+        self._host = host
+        self._https = https
+        self._verify = verify
+        self._timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    @property
+    def scheme(self) -> str:
+        return "https" if self._https else "http"
+
+    @property
+    def https(self) -> bool:
+        return self._https
+
+    def _new(self) -> HTTPConnection:
+        if not self._https:
+            return HTTPConnection(self._host, timeout=self._timeout)
+        return HTTPSConnection(self._host, timeout=self._timeout,
+                               context=get_ssl_context(self._verify))
+
+    def use_http(self) -> None:
+        """ Speak plain http from now on, e.g. to an insecure registry
+            without tls.
+        """
+        self._https = False
+        self.close()
+
+    @contextmanager
+    def get(self) -> Iterator[HTTPConnection]:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._new()
+        done = False
+        try:
+            yield conn
+            done = True
+        finally:
+            # connections left mid-request can't be reused.
+            if not done:
+                conn.close()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def get_registry_credentials(host: str) -> Optional[Tuple[str, str]]:
+    """ Credentials for 'host', as stored by 'podman login', or docker's. """
+    paths: List[Path] = []
+    if 'REGISTRY_AUTH_FILE' in os.environ:
+        paths.append(Path(os.environ['REGISTRY_AUTH_FILE']))
+    if 'XDG_RUNTIME_DIR' in os.environ:
+        paths.append(Path(os.environ['XDG_RUNTIME_DIR']).joinpath(
+            "containers", "auth.json"))
+    paths.append(Path.home().joinpath(".config", "containers", "auth.json"))
+    paths.append(Path.home().joinpath(".docker", "config.json"))
+    for path in paths:
+        try:
+            auths = json.loads(path.read_text()).get('auths', {})
+        except (OSError, ValueError):
+            continue
+        for key, entry in auths.items():
+            # keys may carry a scheme, or a namespace, after the host.
+            netloc = urlparse(key if "://" in key else f"//{key}").netloc
+            if netloc != host or 'auth' not in entry:
+                continue
+            try:
+                decoded = base64.b64decode(entry['auth']).decode("utf-8")
+            except (ValueError, UnicodeDecodeError):
+                continue
+            user, _, password = decoded.partition(':')
+            return user, password
+    return None
+
+
+class RegistryAuth:
+    """ Answers the registry's authentication challenges: with basic auth,
+        or with a bearer token obtained from the registry's token service
+        for every scope asked for so far, anonymously if we have no
+        credentials.
+    """
+
+    _host: str
+    _verify: bool
+    _timeout: float
+    _lock: threading.Lock
+    _scopes: Set[str]
+    _authorization: Optional[str]
+
+    def __init__(self, host: str, verify: bool = True,
+                 timeout: float = 10.0):
+        self._host = host
+        self._verify = verify
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._scopes = set()
+        self._authorization = None
+
+    @property
+    def authorization(self) -> Optional[str]:
+        return self._authorization
+
+    def _get_basic(self) -> Optional[str]:
+        creds = get_registry_credentials(self._host)
+        if creds is None:
+            return None
+        value = base64.b64encode(f"{creds[0]}:{creds[1]}".encode("utf-8"))
+        return f"Basic {value.decode('ascii')}"
+
+    def _get_token(self, params: Dict[str, str]) -> Optional[str]:
+        query: List[Tuple[str, str]] = []
+        if 'service' in params:
+            query.append(('service', params['service']))
+        query.extend([('scope', s) for s in sorted(self._scopes)])
+        url = params['realm']
+        if len(query) > 0:
+            url += ('&' if '?' in url else '?') + urlencode(query)
+        req = urllib.request.Request(url)
+        basic = self._get_basic()
+        if basic is not None:
+            req.add_header('Authorization', basic)
+        try:
+            with urllib.request.urlopen(
+                    req, timeout=self._timeout,
+                    context=get_ssl_context(self._verify)) as resp:
+                token = json.loads(resp.read())
+        except (OSError, ValueError) as e:
+            raise RegistryError(errno.EACCES,
+                                f"unable to obtain registry token: {e}")
+        return token.get('token') or token.get('access_token')
+
+    def authenticate(self, challenge: Optional[str]) -> bool:
+        """ Answer 'challenge', a 401's 'WWW-Authenticate'; False if we
+            can't.
+        """
+        if challenge is None:
+            return False
+        scheme, _, rest = challenge.strip().partition(' ')
+        params = dict(re.findall(r'(\w+)="([^"]*)"', rest))
+        with self._lock:
+            if scheme.lower() == "basic":
+                self._authorization = self._get_basic()
+            elif scheme.lower() == "bearer" and 'realm' in params:
+                if 'scope' in params:
+                    self._scopes.update(params['scope'].split(' '))
+                token = self._get_token(params)
+                self._authorization = \
+                    f"Bearer {token}" if token is not None else None
+            else:
+                return False
+            return self._authorization is not None
+
+
+class UploadState:
+    """ Upload sessions in progress, persisted so that interrupted uploads
+        resume where they were left, and where blobs were last pushed to, so
+        they can be mounted from there instead of uploaded again.
+    """
+
+    _path: Optional[Path]
+    _lock: threading.Lock
+    _state: Dict[str, Any]
+
+    def __init__(self, path: Optional[Path]):
+        self._path = path
+        self._lock = threading.Lock()
+        self._state = {'uploads': {}, 'blobs': {}}
+        if path is not None and path.exists():
+            try:
+                self._state = json.loads(path.read_text())
+            except json.JSONDecodeError:
+                pass
+
+    def _write(self) -> None:
+        if self._path is None:
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._path.with_suffix(
+            f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(self._state))
+        tmp.replace(self._path)
+
+    def get_upload(self, repo: str,
+                   digest: str) -> Optional[Tuple[str, int]]:
+        """ The upload's location, and how much of it the registry had
+            acknowledged receiving.
+        """
+        with self._lock:
+            upload = self._state['uploads'].get(f"{repo}@{digest}")
+            if not isinstance(upload, dict):
+                return None
+            return upload['location'], upload['offset']
+
+    def set_upload(self, repo: str, digest: str, location: Optional[str],
+                   offset: int = 0) -> None:
+        with self._lock:
+            key = f"{repo}@{digest}"
+            if location is None:
+                self._state['uploads'].pop(key, None)
+            else:
+                self._state['uploads'][key] = {
+                    'location': location,
+                    'offset': offset
+                }
+            self._write()
+
+    def get_blob_repos(self, digest: str) -> List[str]:
+        with self._lock:
+            return list(self._state['blobs'].get(digest, []))
+
+    def add_blob_repo(self, digest: str, repo: str) -> None:
+        with self._lock:
+            repos = self._state['blobs'].setdefault(digest, [])
+            if repo in repos:
+                return
+            repos.append(repo)
+            self._write()
+
+
+class PushResult:
+
+    uploaded_bytes: int
+    uploaded: int
+    mounted: int
+    existing: int
+    resumed: int
+
+    def __init__(self):
+        self.uploaded_bytes = 0
+        self.uploaded = 0
+        self.mounted = 0
+        self.existing = 0
+        self.resumed = 0
+        self._lock = threading.Lock()
+
+    def add(self, what: str, nbytes: int = 0) -> None:
+        with self._lock:
+            setattr(self, what, getattr(self, what) + 1)
+            self.uploaded_bytes += nbytes
+
+
+class RegistryClient:
+    """ Pushes images to a registry, speaking the OCI distribution API.
+
+        Blobs the registry already has are not pushed again; those pushed
+        before to other repositories, e.g. by builds sharing a base image,
+        are mounted from there. The remaining blobs are uploaded in parallel,
+        each in chunks, and interrupted uploads are resumed.
+
+        Registries requiring authentication are logged into with the
+        credentials 'podman login' stored, if any.
+    """
+
+    CHUNK_SIZE: int = 16 * 1024 * 1024
+
+    _pool: ConnectionPool
+    _auth: 'RegistryAuth'
+    _http_fallback: bool
+    _state: UploadState
+    _jobs: int
+    _chunk_size: int
+
+    def __init__(self, url: str, secure: bool = True, jobs: int = 4,
+                 state_path: Optional[Path] = None,
+                 chunk_size: Optional[int] = None,
+                 timeout: float = 10.0):
+        parsed = urlparse(url if "://" in url else f"//{url}")
+        https = parsed.scheme in ["https", ""]
+        if parsed.netloc == "":
+            raise RegistryError(errno.EINVAL, f"invalid registry url '{url}'")
+        # as podman with '--tls-verify=false': https, without checking
+        # certificates, unless the registry doesn't speak tls at all.
+        self._http_fallback = not secure and parsed.scheme == ""
+        self._pool = ConnectionPool(parsed.netloc, https, verify=secure,
+                                    timeout=timeout, size=max(1, jobs))
+        self._auth = RegistryAuth(parsed.netloc, verify=secure,
+                                  timeout=timeout)
+        self._state = UploadState(state_path)
+        self._jobs = max(1, jobs)
+        self._chunk_size = chunk_size or self.CHUNK_SIZE
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def _send(self, method: str, path: str, body: Any = None,
+              headers: Optional[Dict[str, str]] = None
+              ) -> Tuple[int, Dict[str, str], bytes]:
+        """ Perform a request, retrying once on a stale pooled connection. """
+        attempt = 0
+        while True:
+            try:
+                with self._pool.get() as conn:
+                    conn.request(method, path, body=body,
+                                 headers=headers or {})
+                    resp = conn.getresponse()
+                    data = resp.read()
+                    hdrs = {k.lower(): v for k, v in resp.getheaders()}
+                break
+            except ssl.SSLError as e:
+                if not self._http_fallback or not self._pool.https:
+                    raise RegistryError(errno.EIO, f"{method} {path}: {e}")
+                self._pool.use_http()
+            except (OSError, HTTPException) as e:
+                attempt += 1
+                if attempt > 1:
+                    raise RegistryError(errno.EIO, f"{method} {path}: {e}")
+        return resp.status, hdrs, data
+
+    def _request(self, method: str, path: str, body: Any = None,
+                 headers: Optional[Dict[str, str]] = None
+                 ) -> Tuple[int, Dict[str, str], bytes]:
+        """ Perform a request, authenticating, and retrying, if asked to. """
+        hdrs = dict(headers or {})
+        if self._auth.authorization is not None:
+            hdrs['Authorization'] = self._auth.authorization
+        status, resp_hdrs, data = self._send(method, path, body, hdrs)
+        if status == 401 and \
+                self._auth.authenticate(resp_hdrs.get('www-authenticate')):
+            assert self._auth.authorization is not None
+            hdrs['Authorization'] = self._auth.authorization
+            status, resp_hdrs, data = self._send(method, path, body, hdrs)
+        if status == 401:
+            raise RegistryError(
+                errno.EACCES, "registry requires authentication; "
+                "see 'podman login'")
+        return status, resp_hdrs, data
+
+    def _get_location_path(self, location: str) -> str:
+        parsed = urlparse(location)
+        path = parsed.path
+        if parsed.query:
+            path += f"?{parsed.query}"
+        return path
+
+    def ping(self) -> bool:
+        try:
+            status, _, _ = self._send("GET", "/v2/")
+        except RegistryError:
+            return False
+        return status in [200, 401]
+
+    def has_blob(self, repo: str, digest: str) -> bool:
+        status, _, _ = self._request("HEAD", f"/v2/{repo}/blobs/{digest}")
+        return status == 200
+
+    def _start_upload(self, repo: str, digest: str,
+                      mount_from: Optional[str] = None) -> Optional[str]:
+        """ Start an upload session, returning its location; if the blob
+            could be mounted from 'mount_from' there is none.
+        """
+        path = f"/v2/{repo}/blobs/uploads/"
+        if mount_from is not None:
+            path += "?" + urlencode({'mount': digest, 'from': mount_from})
+        status, hdrs, data = self._request(
+            "POST", path, headers={'Content-Length': "0"})
+        if status == 201 and mount_from is not None:
+            return None
+        if status != 202 or 'location' not in hdrs:
+            raise RegistryError(
+                errno.EIO, f"unable to start upload for {digest}: {status}")
+        return self._get_location_path(hdrs['location'])
+
+    def _get_upload_offset(self, location: str,
+                           acked: int) -> Optional[int]:
+        """ How much of an upload the registry has; None if it is gone.
+
+            Registries report an empty upload as '0-0', as they would one
+            holding a single byte; it is taken for empty unless the registry
+            had acknowledged receiving some, i.e. 'acked'.
+        """
+        status, hdrs, _ = self._request("GET", location)
+        if status not in [202, 204]:
+            return None
+        rng = hdrs.get('range')
+        if rng is None:
+            return 0
+        end = int(rng.split('-', 1)[1])
+        if end == 0 and acked == 0:
+            return 0
+        return end + 1
+
+    def _upload(self, repo: str, digest: str, path: Path,
+                result: PushResult) -> None:
+        size = path.stat().st_size
+        location: Optional[str] = None
+        offset: Optional[int] = None
+        upload = self._state.get_upload(repo, digest)
+        if upload is not None:
+            location, acked = upload
+            offset = self._get_upload_offset(location, acked)
+            if offset is not None and offset > 0:
+                result.add('resumed')
+        if location is None or offset is None:
+            location = self._start_upload(repo, digest)
+            offset = 0
+        assert location is not None
+        self._state.set_upload(repo, digest, location, offset)
+
+        sent = 0
+        with path.open('rb') as fd:
+            fd.seek(offset)
+            while offset < size:
+                chunk = fd.read(self._chunk_size)
+                end = offset + len(chunk) - 1
+                status, hdrs, _ = self._request(
+                    "PATCH", location, body=chunk, headers={
+                        'Content-Type': "application/octet-stream",
+                        'Content-Length': str(len(chunk)),
+                        'Content-Range': f"{offset}-{end}"
+                    })
+                if status == 416:
+                    # out of sync, e.g. a retried chunk had been received;
+                    # carry on from wherever the registry is.
+                    current = self._get_upload_offset(location, offset)
+                    if current is None or current > size or \
+                            current == offset:
+                        # start over next time, rather than from here.
+                        self._state.set_upload(repo, digest, None)
+                        raise RegistryError(
+                            errno.EIO, f"upload of {digest} was lost")
+                    offset = current
+                    fd.seek(offset)
+                    continue
+                if status != 202:
+                    raise RegistryError(
+                        errno.EIO, f"upload of {digest} failed: {status}")
+                if 'location' in hdrs:
+                    location = self._get_location_path(hdrs['location'])
+                offset = end + 1
+                self._state.set_upload(repo, digest, location, offset)
+                sent += len(chunk)
+
+        sep = '&' if '?' in location else '?'
+        status, _, _ = self._request(
+            "PUT", f"{location}{sep}{urlencode({'digest': digest})}",
+            headers={'Content-Length': "0"})
+        if status != 201:
+            raise RegistryError(
+                errno.EIO, f"unable to complete upload of {digest}: {status}")
+        self._state.set_upload(repo, digest, None)
+        result.add('uploaded', sent)
+
+    def push_blob(self, repo: str, digest: str, path: Path,
+                  result: PushResult) -> None:
+        if self.has_blob(repo, digest):
+            result.add('existing')
+        else:
+            mounted = False
+            for other in self._state.get_blob_repos(digest):
+                if other == repo:
+                    continue
+                location = self._start_upload(repo, digest, mount_from=other)
+                if location is None:
+                    mounted = True
+                    break
+                # not mountable; drop the session the registry opened.
+                self._request("DELETE", location)
+            if mounted:
+                result.add('mounted')
+            else:
+                self._upload(repo, digest, path, result)
+        self._state.add_blob_repo(digest, repo)
+
+    def push_manifest(self, repo: str, ref: str, data: bytes,
+                      media_type: str) -> None:
+        status, _, body = self._request(
+            "PUT", f"/v2/{repo}/manifests/{ref}", body=data, headers={
+                'Content-Type': media_type,
+                'Content-Length': str(len(data))
+            })
+        if status not in [200, 201]:
+            raise RegistryError(
+                errno.EIO, f"unable to push manifest {repo}:{ref}: {status} "
+                f"{body.decode('utf-8', errors='replace').strip()}")
+
+    def push_image(self, layout: OCILayout, ref: str, repo: str,
+                   tags: List[str]) -> PushResult:
+        """ Push image 'ref' from 'layout' to 'repo', as 'tags'. """
+        data, media_type, _ = layout.get_manifest(ref)
+        manifest = json.loads(data)
+        blobs = [manifest['config']['digest']] + \
+            [layer['digest'] for layer in manifest['layers']]
+
+        result = PushResult()
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = [executor.submit(self.push_blob, repo, digest,
+                                       layout.get_blob_path(digest), result)
+                       for digest in dict.fromkeys(blobs)]
+            try:
+                for future in futures:
+                    future.result()
+            except RegistryError:
+                # no point in pushing the rest; resume them next time.
+                for future in futures:
+                    future.cancel()
+                raise
+
+        for tag in tags:
+            self.push_manifest(repo, tag, data, media_type)
+        return result
@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+#
+# NOTE: this module is run within the builder and base image containers,
+# where none of cab's dependencies are available; it must only rely on the
+# standard library.
+#
+import argparse
+import errno
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+class SpecError(Exception):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(f"{os.strerror(rc)}: {msg}")
+
+
+# bump whenever the parsed output changes, so stale cache entries are ignored.
+PARSER_VERSION = 1
+
+# packages we build ourselves, and thus must not be installed as requirements.
+OWN_PACKAGES = re.compile(r'ceph|rados|rgw|rbd')
+
+
+def get_version(srcdir: Path) -> Tuple[str, str, str]:
+    """ Obtain the version, rpm version and rpm release for sources at
+        'srcdir', from git.
+    """
+    proc = subprocess.run(
+        ["git", "describe", "--long", "--match", "v*"],
+        cwd=str(srcdir), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise SpecError(errno.EINVAL, proc.stderr.decode("utf-8").strip())
+    version = proc.stdout.decode("utf-8").strip()
+    if version.startswith('v'):
+        version = version[1:]
+    fields = version.split('-')
+    rpm_version = fields[0]
+    rpm_release = '-'.join(fields[1:]).replace('-', '.', 1)
+    return version, rpm_version, rpm_release
+
+
+def generate_builder_spec(spec_in: str, version: str,
+                          rpm_version: str, rpm_release: str) -> str:
+    """ Adjust ceph.spec.in for our purposes.
+
+        We are not using the spec file for its intended purpose, but for
+        (potentially) incremental builds, and definitely not using the
+        tarball.
+    """
+    spec = spec_in.replace("@PROJECT_VERSION@", rpm_version)
+    spec = spec.replace("@RPM_RELEASE@", rpm_release)
+    spec = spec.replace("@TARBALL_BASENAME@", f"ceph-{version}")
+    spec = spec.replace("mkdir build", "mkdir build || true")
+    spec = spec.replace("%fdupes %{buildroot}%{_prefix}", "")
+    spec = spec.replace("%{buildroot}", "/build/out")
+    return spec
+
+
+def _get_os_release() -> str:
+    path = Path("/etc/os-release")
+    if not path.exists():
+        return ""
+    fields: Dict[str, str] = {}
+    for line in path.read_text().splitlines():
+        if '=' in line:
+            k, v = line.split('=', 1)
+            fields[k] = v.strip('"')
+    return f"{fields.get('ID', '')}-{fields.get('VERSION_ID', '')}"
+
+
+def get_cache_key(builder_spec: str) -> str:
+    """ The parsed spec depends on the spec itself, which already has the
+        release macros applied, and on the distribution's rpm macros.
+    """
+    h = hashlib.sha256()
+    h.update(f"v{PARSER_VERSION}\n".encode("utf-8"))
+    h.update(f"{_get_os_release()}\n".encode("utf-8"))
+    h.update(builder_spec.encode("utf-8"))
+    return h.hexdigest()
+
+
+def expand_spec(builder_spec: str) -> List[str]:
+    """ Expand the spec's macros with rpmspec. """
+    with tempfile.NamedTemporaryFile(mode='w', suffix=".spec") as fd:
+        fd.write(builder_spec)
+        fd.flush()
+        proc = subprocess.run(["rpmspec", "--parse", fd.name],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise SpecError(errno.EINVAL, proc.stderr.decode("utf-8").strip())
+    return proc.stdout.decode("utf-8").splitlines()
+
+
+def _parse_attr(line: str) -> Optional[Dict[str, str]]:
+    # %attr(0750,ceph,ceph) %dir /var/lib/ceph
+    m = re.match(r'^%attr\(([^)]*)\)\s+(.*)$', line)
+    if not m:
+        return None
+    fields = [x.strip() for x in m.group(1).split(',')]
+    if len(fields) != 3:
+        return None
+    path = m.group(2).split()[-1]
+    return {'mode': fields[0], 'user': fields[1], 'group': fields[2],
+            'path': path}
+
+
+def parse_spec(lines: List[str]) -> Dict[str, Any]:
+    """ Extract, in one pass, what we need from the expanded spec:
+        the build and install sections, the %pre scriptlets, the %attr
+        entries, and the Requires and Recommends packages.
+    """
+    build: List[str] = []
+    install: List[str] = []
+    pre: List[str] = []
+    attrs: List[Dict[str, str]] = []
+    requires: Set[str] = set()
+    recommends: Set[str] = set()
+
+    section: Optional[str] = None
+    for line in lines:
+        if line.startswith('%'):
+            section = None
+            if re.match(r'^%build\b', line):
+                section = "build"
+            elif re.match(r'^%install\b', line):
+                section = "install"
+            elif re.match(r'^%pre', line) and \
+                    not re.match(r'^%(preun|prep)', line):
+                section = "pre"
+            elif line.startswith('%attr'):
+                attr = _parse_attr(line)
+                if attr is not None:
+                    attrs.append(attr)
+            continue
+
+        m = re.match(r'^(Requires|Recommends):\s+([-_a-zA-Z0-9]+)', line)
+        if m and not OWN_PACKAGES.search(m.group(2)):
+            (requires if m.group(1) == "Requires" else recommends).add(
+                m.group(2))
+
+        if section == "build":
+            build.append(line)
+        elif section == "install":
+            # we install ourselves, into our own destination.
+            if not re.match(r'.*make.*DESTDIR', line):
+                install.append(line)
+        elif section == "pre" and not line.startswith("exit"):
+            pre.append(line)
+
+    return {
+        'build': build,
+        'install': install,
+        'pre': pre,
+        'attrs': attrs,
+        'requires': sorted(requires),
+        'recommends': sorted(recommends)
+    }
+
+
+def get_parsed_spec(srcdir: Path,
+                    cache_dir: Optional[Path] = None
+                    ) -> Tuple[Dict[str, Any], bool]:
+    """ Obtain the parsed spec for sources at 'srcdir', from the cache if
+        possible. Returns the parsed spec and whether it was cached.
+    """
+    spec_in_path = srcdir.joinpath("ceph.spec.in")
+    if not spec_in_path.exists():
+        raise SpecError(errno.ENOENT, "not a ceph source root directory")
+
+    version, rpm_version, rpm_release = get_version(srcdir)
+    builder_spec = generate_builder_spec(
+        spec_in_path.read_text(), version, rpm_version, rpm_release)
+    key = get_cache_key(builder_spec)
+
+    cache_path: Optional[Path] = None
+    if cache_dir is not None:
+        cache_path = cache_dir.joinpath(f"{key}.json")
+        if cache_path.exists():
+            try:
+                return json.loads(cache_path.read_text()), True
+            except json.JSONDecodeError:
+                pass
+
+    parsed = parse_spec(expand_spec(builder_spec))
+    parsed['version'] = version
+    parsed['rpm_version'] = rpm_version
+    parsed['rpm_release'] = rpm_release
+    parsed['key'] = key
+
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(parsed))
+        tmp.replace(cache_path)
+    return parsed, False
+
+
+def get_post_install_script(parsed: Dict[str, Any],
+                            with_attrs: bool = True) -> str:
+    """ Script to run on the image, creating users and directories, and,
+        optionally, adjusting permissions. cab itself applies permissions
+        from 'attrs.json' instead, see 'builder/ownership.py'.
+    """
+    lines = [
+        "#!/bin/bash",
+        "",
+        'echo "run post-install requirements for image"',
+        ""
+    ]
+    lines.extend(parsed['pre'])
+    if with_attrs:
+        for attr in parsed['attrs']:
+            lines.append(f"chmod {attr['mode']} {attr['path']}")
+            if attr['user'] != '-' and attr['group'] != '-':
+                lines.append(
+                    f"chown {attr['user']}:{attr['group']} {attr['path']}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_outputs(parsed: Dict[str, Any], outdir: Path) -> None:
+    """ Write out the scripts and lists the entrypoint and image builders
+        consume.
+    """
+    outdir.mkdir(parents=True, exist_ok=True)
+    outdir.joinpath("build.sh").write_text('\n'.join(parsed['build']) + '\n')
+    outdir.joinpath("install.sh").write_text(
+        '\n'.join(parsed['install']) + '\n')
+    outdir.joinpath("post-install.sh").write_text(
+        get_post_install_script(parsed, with_attrs=False))
+    outdir.joinpath("attrs.json").write_text(json.dumps(parsed['attrs']))
+    outdir.joinpath("requirements.txt").write_text(
+        '\n'.join(parsed['requires'] + parsed['recommends']) + '\n')
+    outdir.joinpath("spec.json").write_text(json.dumps(parsed))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="parse ceph's spec file for cab")
+    parser.add_argument("srcdir", type=str, help="ceph source directory")
+    parser.add_argument("--cache-dir", type=str,
+                        help="where parsed specs are cached")
+    parser.add_argument("--output-dir", type=str, required=True,
+                        help="where to write the resulting scripts")
+    args = parser.parse_args()
+
+    cache_dir = Path(args.cache_dir) if args.cache_dir else None
+    try:
+        parsed, cached = get_parsed_spec(Path(args.srcdir), cache_dir)
+    except SpecError as e:
+        print(f"error: {str(e)}", file=sys.stderr)
+        return 1
+
+    print(f"ceph version: {parsed['version']}")
+    print(f" rpm version: {parsed['rpm_version']}")
+    print(f" rpm release: {parsed['rpm_release']}")
+    print(f"   spec hash: {parsed['key'][:12]}{' (cached)' if cached else ''}")
+    write_outputs(parsed, Path(args.output_dir))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import errno
+import json
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+from .utils import CABError
+
+
+class StateError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+class StateStore:
+    """ Global settings and build configurations, in a single sqlite
+        database, so that listing builds, or checking whether one exists, is
+        a single indexed query rather than reading a yaml file per build.
+
+        Builds are kept as their configuration's json, alongside the columns
+        they are looked up by. The database is in WAL mode, so readers neither
+        block on, nor are blocked by, a writer; e.g., scripts calling cab in a
+        loop while a build runs.
+
+        Configurations written by earlier versions, 'config.yaml' and
+        'builds/<name>.yaml', are imported when the database is created. They
+        are left in place, but no longer read afterwards.
+    """
+
+    SCHEMA_VERSION: int = 1
+    TIMEOUT_SECS: float = 30.0
+
+    _path: Path
+    _yaml_dir: Optional[Path]
+    _conn: Optional[sqlite3.Connection]
+
+    def __init__(self, path: Path, yaml_dir: Optional[Path] = None):
+        self._path = path
+        self._yaml_dir = yaml_dir
+        self._conn = None
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            # we handle transactions ourselves.
+            conn = sqlite3.connect(str(self._path), timeout=self.TIMEOUT_SECS,
+                                   isolation_level=None)
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.SCHEMA_VERSION:
+                self._create(conn, version)
+        except sqlite3.Error as e:
+            raise StateError(errno.EIO,
+                             f"unable to open state at {self._path}: {e}")
+        self._conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self, conn: Optional[sqlite3.Connection] = None
+                     ) -> Iterator[sqlite3.Connection]:
+        if conn is None:
+            conn = self._get_conn()
+        # take the write lock upfront, rather than failing to upgrade to it.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _create(self, conn: sqlite3.Connection, version: int) -> None:
+        if version > self.SCHEMA_VERSION:
+            raise StateError(errno.EPROTO,
+                             f"state at {self._path} is from a newer cab")
+        conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction(conn):
+            # someone else may have created it while we waited for the lock.
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == self.SCHEMA_VERSION:
+                return
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS builds (
+                    name TEXT PRIMARY KEY,
+                    vendor TEXT NOT NULL,
+                    release TEXT NOT NULL,
+                    sources_path TEXT NOT NULL,
+                    config TEXT NOT NULL
+                )""")
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS builds_by_sources
+                    ON builds (sources_path)""")
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS builds_by_release
+                    ON builds (vendor, release)""")
+            if version == 0 and self._yaml_dir is not None:
+                self._import_yaml(conn, self._yaml_dir)
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    @classmethod
+    def _get_sources_path(cls, sources: str) -> str:
+        return str(Path(sources).resolve())
+
+    def _put_build(self, conn: sqlite3.Connection,
+                   name: str, config: Dict[str, Any]) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO builds "
+            "(name, vendor, release, sources_path, config) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (name, config['vendor'], config['release'],
+             self._get_sources_path(config['sources']), json.dumps(config)))
+
+    def _import_yaml(self, conn: sqlite3.Connection, yaml_dir: Path) -> int:
+        # only needed once; don't pay for yaml on every run.
+        import yaml
+
+        n = 0
+        try:
+            config_path = yaml_dir.joinpath("config.yaml")
+            if config_path.exists():
+                config = yaml.safe_load(config_path.read_text())
+                if config is not None and 'global' in config:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO settings (key, value) "
+                        "VALUES ('global', ?)",
+                        (json.dumps(config['global']),))
+            builds_dir = yaml_dir.joinpath("builds")
+            if builds_dir.exists():
+                for path in sorted(builds_dir.glob("*.yaml")):
+                    config = yaml.safe_load(path.read_text())
+                    if config is None or 'name' not in config:
+                        continue
+                    self._put_build(conn, config['name'], config)
+                    n += 1
+        except (OSError, yaml.YAMLError, KeyError) as e:
+            raise StateError(errno.EINVAL,
+                             f"unable to import configuration: {e}")
+        return n
+
+    def import_yaml(self) -> int:
+        """ Import yaml configurations again, replacing the global settings
+            and builds of the same name. Returns how many builds.
+        """
+        if self._yaml_dir is None:
+            return 0
+        with self._transaction() as conn:
+            return self._import_yaml(conn, self._yaml_dir)
+
+    def get_settings(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._get_conn().execute(
+            "SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_settings(self, key: str, value: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)))
+
+    def has_build(self, name: str) -> bool:
+        row = self._get_conn().execute(
+            "SELECT 1 FROM builds WHERE name = ?", (name,)).fetchone()
+        return row is not None
+
+    def get_build(self, name: str) -> Optional[Dict[str, Any]]:
+        row = self._get_conn().execute(
+            "SELECT config FROM builds WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_build(self, name: str, config: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            self._put_build(conn, name, config)
+
+    def remove_build(self, name: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM builds WHERE name = ?", (name,))
+
+    def get_build_names(self) -> List[str]:
+        rows = self._get_conn().execute(
+            "SELECT name FROM builds ORDER BY name").fetchall()
+        return [row[0] for row in rows]
+
+    def get_builds_with_sources(self, sources: str) -> List[str]:
+        rows = self._get_conn().execute(
+            "SELECT name FROM builds WHERE sources_path = ? ORDER BY name",
+            (self._get_sources_path(sources),)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,292 @@
+import json
+import socket
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import datetime as dt
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from .utils import run_cmd, pwarn
+from .trace import Trace
+
+
+class BuildTimer:
+    """ Keeps track of how long each phase of a build takes.
+
+        Phases run on the host are timed with 'phase()'; phases run within the
+        builder container are reported by the entrypoint, through
+        'bin/cab-phase.sh', to a phase log we read back with
+        'read_phase_log()'.
+    """
+
+    # phases in the order they are expected to happen.
+    PHASES: List[str] = [
+        "image-checks",
+        "artifact-cache",
+        "frontend-cache",
+        "spec-generation",
+        "submodule-update",
+        "configure",
+        "compile",
+        "install",
+        "post-install",
+        "rsync",
+        "pycompile",
+        "raw-commit",
+        "image-post-install",
+        "final-commit",
+        "push"
+    ]
+
+    _start: float
+    _phases: List[Tuple[str, float, float]]
+
+    def __init__(self):
+        self._start = time.time()
+        self._phases = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.time()
+        try:
+            with Trace.phase(name):
+                yield
+        finally:
+            self.add(name, start, time.time())
+
+    def add(self, name: str, start: float, end: float) -> None:
+        self._phases.append((name, start, end))
+        Trace.add_phase(name, start, end)
+
+    def read_phase_log(self, path: Path) -> None:
+        """ Read phases from a phase log.
+
+            Each line is either 'start <phase> <epoch>' or
+            'end <phase> <epoch>'. Phases that never ended, because the build
+            failed, end at the time of the last recorded event.
+        """
+        if not path.exists():
+            return
+        started: Dict[str, float] = {}
+        last: float = 0.0
+        with path.open('r') as fd:
+            for line in fd:
+                fields = line.split()
+                if len(fields) != 3:
+                    continue
+                event, name, when_str = fields
+                try:
+                    when = float(when_str)
+                except ValueError:
+                    continue
+                last = max(last, when)
+                if event == "start":
+                    started[name] = when
+                elif event == "end" and name in started:
+                    self.add(name, started.pop(name), when)
+        for name, start in started.items():
+            self.add(name, start, max(last, start))
+
+    @property
+    def start(self) -> float:
+        return self._start
+
+    def get_phases(self) -> Dict[str, float]:
+        phases: Dict[str, float] = {}
+        for name, start, end in self._phases:
+            phases[name] = phases.get(name, 0.0) + (end - start)
+        return phases
+
+    def get_total(self) -> float:
+        return time.time() - self._start
+
+
+def get_source_revision(sources: str) -> Tuple[Optional[str], bool]:
+    """ Obtain HEAD's sha for the git tree at 'sources', and whether the
+        tree is dirty.
+    """
+    ret, stdout, _ = run_cmd(f"git -C {sources} rev-parse HEAD")
+    if ret != 0 or len(stdout) == 0:
+        return None, False
+    sha: str = stdout[0].strip()
+    ret, stdout, _ = run_cmd(
+        f"git -C {sources} status --porcelain --untracked-files=no")
+    dirty: bool = ret == 0 and len(stdout) > 0
+    return sha, dirty
+
+
+class BuildHistory:
+    """ Per-build history of build runs, one json entry per line. """
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._path.mkdir(parents=True, exist_ok=True)
+
+    def _get_build_path(self, buildname: str) -> Path:
+        return self._path.joinpath(f"{buildname}.jsonl")
+
+    def record(self, buildname: str, entry: Dict[str, Any]) -> None:
+        path = self._get_build_path(buildname)
+        with path.open('a') as fd:
+            fd.write(json.dumps(entry) + '\n')
+
+    def record_run(self,
+                   buildname: str,
+                   timer: BuildTimer,
+                   sources: Optional[str],
+                   flags: Dict[str, bool],
+                   success: bool
+                   ) -> Dict[str, Any]:
+        sha: Optional[str] = None
+        dirty: bool = False
+        if sources is not None:
+            sha, dirty = get_source_revision(sources)
+        entry: Dict[str, Any] = {
+            'start': dt.fromtimestamp(timer.start).isoformat(),
+            'host': socket.gethostname(),
+            'sha': sha,
+            'dirty': dirty,
+            'flags': flags,
+            'success': success,
+            'total': timer.get_total(),
+            'phases': timer.get_phases()
+        }
+        try:
+            self.record(buildname, entry)
+        except OSError as e:
+            pwarn(f"unable to record build history: {str(e)}")
+        return entry
+
+    def get_runs(self, buildname: str) -> List[Dict[str, Any]]:
+        path = self._get_build_path(buildname)
+        if not path.exists():
+            return []
+        runs: List[Dict[str, Any]] = []
+        with path.open('r') as fd:
+            for line in fd:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    runs.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return runs
+
+    def remove(self, buildname: str) -> None:
+        path = self._get_build_path(buildname)
+        if path.exists():
+            path.unlink()
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    assert len(values) > 0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+class PhaseStats:
+    """ Distribution of a phase's duration across runs.
+
+        Values are kept in the order their runs started, as given by
+        'starts', rather than the order they were recorded in; the last is
+        the most recent run's. It is considered a regression if it took
+        longer than the median of the previous runs by more than 'threshold'
+        (a ratio), and by at least 'min_delta' seconds, so that short phases
+        don't get flagged due to noise.
+    """
+
+    name: str
+    values: List[float]
+    starts: List[str]
+
+    def __init__(self, name: str, values: List[float],
+                 starts: Optional[List[str]] = None):
+        if starts is None:
+            starts = [""] * len(values)
+        assert len(starts) == len(values)
+        ordered = sorted(zip(starts, values), key=lambda x: x[0])
+        self.name = name
+        self.values = [v for _, v in ordered]
+        self.starts = [s for s, _ in ordered]
+
+    @property
+    def runs(self) -> int:
+        return len(self.values)
+
+    @property
+    def min(self) -> float:
+        return min(self.values)
+
+    @property
+    def max(self) -> float:
+        return max(self.values)
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.values)
+
+    @property
+    def p90(self) -> float:
+        return _percentile(self.values, 0.9)
+
+    @property
+    def last(self) -> float:
+        return self.values[-1]
+
+    def get_regression(self,
+                       threshold: float = 0.2,
+                       min_delta: float = 5.0
+                       ) -> Optional[float]:
+        if len(self.values) < 2:
+            return None
+        previous = statistics.median(self.values[:-1])
+        delta = self.last - previous
+        if delta < min_delta or previous <= 0:
+            return None
+        ratio = delta / previous
+        if ratio < threshold:
+            return None
+        return ratio
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'phase': self.name,
+            'runs': self.runs,
+            'min': self.min,
+            'median': self.median,
+            'p90': self.p90,
+            'max': self.max,
+            'last': self.last,
+            'regression': self.get_regression()
+        }
+
+
+def get_phase_stats(runs: List[Dict[str, Any]]) -> List[PhaseStats]:
+    values: Dict[str, List[float]] = {}
+    starts: Dict[str, List[str]] = {}
+    for run in runs:
+        start = run.get('start') or ""
+        phases = dict(run.get('phases', {}))
+        phases["total"] = run.get('total', 0.0)
+        for name, secs in phases.items():
+            values.setdefault(name, []).append(secs)
+            starts.setdefault(name, []).append(start)
+
+    order = BuildTimer.PHASES + ["total"]
+    names = sorted(values.keys(),
+                   key=lambda n: order.index(n) if n in order else len(order))
+    return [PhaseStats(name, values[name], starts[name]) for name in names]
+
+
+def fmt_secs(secs: float) -> str:
+    if secs < 60:
+        return f"{secs:.1f}s"
+    mins, secs = divmod(int(secs), 60)
+    if mins < 60:
+        return f"{mins}m{secs:02d}s"
+    hours, mins = divmod(mins, 60)
+    return f"{hours}h{mins:02d}m"
@@ -0,0 +1,136 @@
+import fnmatch
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from .utils import CABError, pwarn, run_cmd
+from .podman import Podman
+from .ownership import get_managed_files
+
+
+class SyncError(CABError):
+    def __init__(self, rc: int, msg: Any):
+        super().__init__(rc, msg)
+
+
+class ContainerSync:
+    """ Hot-patches a container, started from one of a build's images, with
+        what changed in the build's install tree since.
+
+        The container's root is mounted, and the install tree transferred
+        onto it as when creating the build's raw image, so it's rsync that
+        works out what changed; against what the container has, be it from
+        its image or from earlier syncs.
+
+        A container needs restarting if its daemon's binary, or any shared
+        library, changed, or anything else the daemon is known to load, as
+        listed in 'DAEMON_PATHS'.
+    """
+
+    SHARED_PATHS: List[str] = ["*.so", "*.so.*"]
+    DAEMON_PATHS: Dict[str, List[str]] = {
+        "ceph-mgr": ["usr/share/ceph/mgr/*"],
+    }
+
+    _install_path: Path
+    _excludes: List[str]
+    _container: Dict[str, Any]
+
+    def __init__(self, install_path: Path, excludes: List[str],
+                 container: Dict[str, Any]):
+        self._install_path = install_path
+        self._excludes = excludes
+        self._container = container
+
+    @property
+    def id(self) -> str:
+        return self._container['Id']
+
+    @property
+    def name(self) -> str:
+        return self._container.get('Name', self.id[:12])
+
+    def get_build(self) -> Optional[str]:
+        """ Name of the build the container's image is from, if any. """
+        labels = self._container.get('Config', {}).get('Labels') or {}
+        return labels.get("cab.build")
+
+    def get_command(self) -> List[str]:
+        config = self._container.get('Config', {})
+        cmd: List[str] = []
+        for what in ('Entrypoint', 'Cmd'):
+            value = config.get(what) or []
+            cmd.extend([value] if isinstance(value, str) else value)
+        return cmd
+
+    def sync(self, dry_run: bool = False) -> List[str]:
+        """ Files changed, relative to the container's root. """
+        mnt_path = Podman.mount_container(self.id)
+        try:
+            return self._transfer(mnt_path, dry_run)
+        finally:
+            ret, result = Podman.unmount_container(self.id)
+            if ret != 0:
+                pwarn(f"unable to unmount container {self.name}: "
+                      f"{' '.join(result)}")
+
+    def _transfer(self, mnt_path: Path, dry_run: bool) -> List[str]:
+        attrs: List[Dict[str, str]] = []
+        attrs_path = self._install_path.joinpath("post-install-attrs.json")
+        if attrs_path.exists():
+            attrs = json.loads(attrs_path.read_text())
+        managed_files = get_managed_files(attrs, self._install_path)
+
+        excludes = ' '.join([f'--exclude {x}' for x in self._excludes])
+        dry_run_str = "--dry-run" if dry_run else ""
+        changed: List[str] = []
+        with tempfile.TemporaryDirectory(prefix="cab-sync-") as tmpdir:
+            managed_list = Path(tmpdir).joinpath("managed")
+            managed_list.write_text(
+                ''.join([f"{f}\n" for f in managed_files]))
+            managed_excludes = Path(tmpdir).joinpath("excludes")
+            managed_excludes.write_text(
+                ''.join([f"/{f}\n" for f in managed_files]))
+
+            # as when creating the raw image, files whose permissions are set
+            # by the spec keep the container's metadata.
+            cmds = [
+                f"podman unshare rsync --update --recursive --links "
+                f"--perms --group --owner --times --out-format=%n "
+                f"{dry_run_str} {excludes} "
+                f"--exclude-from={managed_excludes} "
+                f"{str(self._install_path)}/ {str(mnt_path)}"
+            ]
+            if len(managed_files) > 0:
+                cmds.append(
+                    f"podman unshare rsync --update --links --times "
+                    f"--out-format=%n {dry_run_str} "
+                    f"--files-from={managed_list} "
+                    f"{str(self._install_path)}/ {str(mnt_path)}")
+            for cmd in cmds:
+                ret, stdout, stderr = run_cmd(cmd)
+                if ret != 0:
+                    raise SyncError(ret, stderr)
+                changed.extend([x for x in stdout
+                                if len(x) > 0 and not x.endswith('/')])
+        return sorted(set(changed))
+
+    def needs_restart(self, changed: List[str]) -> bool:
+        cmd = self.get_command()
+        if len(cmd) == 0:
+            return False
+        daemon = os.path.basename(cmd[0])
+        patterns = self.SHARED_PATHS + self.DAEMON_PATHS.get(daemon, [])
+        for path in changed:
+            if os.path.basename(path) == daemon and \
+                    os.path.dirname(path).endswith("bin"):
+                return True
+            if any([fnmatch.fnmatch(path, p) for p in patterns]):
+                return True
+        return False
+
+    def restart(self) -> None:
+        ret, result = Podman.restart_container(self.id)
+        if ret != 0:
+            raise SyncError(ret, result)
@@ -0,0 +1,215 @@
+import atexit
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+
+class TracedCommand:
+    """ A command being traced; its result is set once it finishes. """
+
+    argv: List[str]
+    phase: Optional[str]
+    start: float
+    returncode: Optional[int]
+    output_bytes: Optional[int]
+
+    def __init__(self, argv: Sequence[str], phase: Optional[str]):
+        self.argv = [str(a) for a in argv]
+        self.phase = phase
+        self.start = time.time()
+        self.returncode = None
+        self.output_bytes = None
+
+    def set_result(self, returncode: int,
+                   output_bytes: Optional[int] = None) -> None:
+        self.returncode = returncode
+        self.output_bytes = output_bytes
+
+
+class _TracedPopen(subprocess.Popen):
+    """ Recorded once waited for. """
+
+    _traced: Optional[TracedCommand] = None
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        ret = super().wait(timeout)
+        if self._traced is not None:
+            self._traced.set_result(ret)
+            Trace.finish(self._traced)
+            self._traced = None
+        return ret
+
+
+class Trace:
+    """ Opt-in trace of every external command cab runs, and of the build
+        phases they run in, written as Chrome trace event json on exit; it
+        can be loaded by Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+        Commands are complete ('X') events on a track per thread that ran
+        them, with their argv, exit code, bytes of captured output and the
+        phase they ran in as arguments. Phases are on a track of their own.
+        When tracing is disabled, 'run()' is just 'subprocess.run()'.
+    """
+
+    PHASES_TID: int = 0
+
+    _path: Optional[Path] = None
+    _base: float = 0.0
+    _events: List[Dict[str, Any]] = []
+    _phases: List[str] = []
+    _tids: Dict[int, int] = {}
+    _lock: threading.Lock = threading.Lock()
+
+    @classmethod
+    def enable(cls, path: Path) -> None:
+        if cls._path is not None:
+            return
+        cls._path = path
+        cls._base = time.time()
+        cls._events = []
+        cls._phases = []
+        cls._tids = {}
+        cls._add_metadata(cls.PHASES_TID, "phases")
+        atexit.register(cls._write_at_exit)
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return cls._path is not None
+
+    @classmethod
+    def _us(cls, when: float) -> int:
+        return int((when - cls._base) * 1000000)
+
+    @classmethod
+    def _add_metadata(cls, tid: int, name: str) -> None:
+        cls._events.append({
+            'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+            'tid': tid, 'args': {'name': name}
+        })
+
+    @classmethod
+    def _get_tid(cls) -> int:
+        # must be called with the lock held.
+        ident = threading.get_ident()
+        if ident not in cls._tids:
+            tid = len(cls._tids) + 1
+            cls._tids[ident] = tid
+            thread = threading.current_thread().name
+            cls._add_metadata(tid, f"commands ({thread})")
+        return cls._tids[ident]
+
+    @classmethod
+    def _add_event(cls, name: str, cat: str, start: float, end: float,
+                   args: Dict[str, Any], tid: Optional[int] = None) -> None:
+        with cls._lock:
+            if tid is None:
+                tid = cls._get_tid()
+            ts = cls._us(start)
+            cls._events.append({
+                'name': name, 'cat': cat, 'ph': 'X',
+                'ts': ts, 'dur': max(0, cls._us(end) - ts),
+                'pid': os.getpid(), 'tid': tid, 'args': args
+            })
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name: str) -> Iterator[None]:
+        """ Commands run within are attributed to phase 'name'. """
+        cls._phases.append(name)
+        try:
+            yield
+        finally:
+            cls._phases.pop()
+
+    @classmethod
+    def add_phase(cls, name: str, start: float, end: float) -> None:
+        if cls._path is None:
+            return
+        cls._add_event(name, "phase", start, end, {}, tid=cls.PHASES_TID)
+
+    @classmethod
+    def start(cls, argv: Sequence[str]) -> TracedCommand:
+        phase = cls._phases[-1] if len(cls._phases) > 0 else None
+        return TracedCommand(argv, phase)
+
+    @classmethod
+    def finish(cls, traced: TracedCommand) -> None:
+        if cls._path is None:
+            return
+        name = os.path.basename(traced.argv[0]) if traced.argv else "?"
+        cls._add_event(name, "command", traced.start, time.time(), {
+            'argv': traced.argv,
+            'returncode': traced.returncode,
+            'output_bytes': traced.output_bytes,
+            'phase': traced.phase
+        })
+
+    @classmethod
+    def run(cls, args: Sequence[str], **kwargs: Any
+            ) -> subprocess.CompletedProcess:
+        """ 'subprocess.run()', traced. """
+        if cls._path is None:
+            return subprocess.run(args, **kwargs)
+        traced = cls.start(args)
+        try:
+            proc = subprocess.run(args, **kwargs)
+            traced.set_result(proc.returncode,
+                              cls._get_size(proc.stdout, proc.stderr))
+        finally:
+            cls.finish(traced)
+        return proc
+
+    @classmethod
+    def popen(cls, args: Sequence[str], **kwargs: Any) -> subprocess.Popen:
+        """ 'subprocess.Popen()', traced until waited for; output is not
+            accounted for, being streamed by the caller.
+        """
+        if cls._path is None:
+            return subprocess.Popen(args, **kwargs)
+        traced = cls.start(args)
+        proc = _TracedPopen(args, **kwargs)
+        proc._traced = traced
+        return proc
+
+    @classmethod
+    def _get_size(cls, *outputs: Union[bytes, str, None]) -> Optional[int]:
+        sizes = [len(o) for o in outputs if isinstance(o, (bytes, str))]
+        # not captured, e.g. straight to the terminal.
+        return sum(sizes) if len(sizes) > 0 else None
+
+    @classmethod
+    def write(cls) -> None:
+        if cls._path is None:
+            return
+        with cls._lock:
+            events = list(cls._events)
+        doc = {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'argv': sys.argv,
+                'start': cls._base
+            }
+        }
+        cls._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cls._path.with_name(f".{cls._path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(doc))
+        tmp.replace(cls._path)
+
+    @classmethod
+    def _write_at_exit(cls) -> None:
+        if cls._path is None:
+            return
+        cls._add_event("cab " + " ".join(sys.argv[1:]), "cab", cls._base,
+                       time.time(), {}, tid=cls.PHASES_TID)
+        try:
+            cls.write()
+        except OSError as e:
+            print(f"unable to write trace to {cls._path}: {e}",
+                  file=sys.stderr)
@@ -6,6 +6,12 @@ import os
 import re
 from datetime import datetime as dt
 from typing import List, Any, Tuple
+from .trace import Trace
+
+
+# what build directories in the sources' root are named like; neither
+# sources, nor what the sources were built from.
+BUILD_DIR_NAMES: List[str] = ["build", "build.*"]
 
 
 def serror(what: str):
@@ -114,7 +120,7 @@ def run_cmd(
         out = sys.stdout   # type: ignore
         err = sys.stderr   # type: ignore
 
-    proc = subprocess.run(shlex.split(cmd), stdout=out, stderr=err)
+    proc = Trace.run(shlex.split(cmd), stdout=out, stderr=err)
 
     stdout = []
     stderr = []
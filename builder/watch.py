@@ -0,0 +1,267 @@
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from .utils import CABError, BUILD_DIR_NAMES
+
+
+class WatchError(CABError):
+    def __init__(self, rc: int, msg: str):
+        super().__init__(rc, msg)
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+
+class Inotify:
+    """ Linux's inotify, through libc; watches single directories. """
+
+    EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+    READ_SIZE: int = 64 * 1024
+
+    _libc: Optional[ctypes.CDLL] = None
+
+    _fd: int
+
+    def __init__(self):
+        libc = self._get_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise WatchError(ctypes.get_errno(), "unable to init inotify")
+        self._fd = fd
+
+    @classmethod
+    def _get_libc(cls) -> ctypes.CDLL:
+        if cls._libc is None:
+            name = ctypes.util.find_library("c") or "libc.so.6"
+            libc = ctypes.CDLL(name, use_errno=True)
+            if not hasattr(libc, "inotify_init1"):
+                raise WatchError(errno.ENOTSUP, "inotify is not available")
+            libc.inotify_add_watch.argtypes = \
+                [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            cls._libc = libc
+        return cls._libc
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._get_libc().inotify_add_watch(
+            self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            rc = ctypes.get_errno()
+            raise OSError(rc, os.strerror(rc), path)
+        return wd
+
+    def read(self, timeout: Optional[float] = None
+             ) -> List[Tuple[int, int, str]]:
+        """ Events as (wd, mask, name), waiting up to 'timeout' for any. """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        try:
+            data = os.read(self._fd, self.READ_SIZE)
+        except BlockingIOError:
+            return []
+        events: List[Tuple[int, int, str]] = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, namelen = \
+                self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + namelen].rstrip(b'\0')
+            offset += namelen
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class SourceWatcher:
+    """ Watches a source tree for changes, from a thread of its own.
+
+        Changes are only reported once they settle, i.e., once nothing else
+        changed for 'debounce' seconds, so that a burst of changes, like a
+        'git checkout' or an editor saving through a temporary file, is
+        reported once. 'changed' is set when changes are ready to be taken
+        with 'wait()', and can be handed to a build to be cancelled by.
+
+        Entries named like 'IGNORE_NAMES', anywhere in the tree, or like
+        'ROOT_IGNORE_NAMES', at its root, 'GENERATED_PATHS' and paths in
+        'ignore_paths' are ignored; i.e., git's internals, build directories
+        and what the build is known to write into the sources. So are
+        editors' temporary files. Other outputs a build may write into the
+        sources are taken for changes, cancelling the build.
+    """
+
+    MASK: int = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_DELETE_SELF | IN_ATTRIB | IN_ONLYDIR
+    IGNORE_NAMES: List[str] = [
+        ".git", "__pycache__", "node_modules", "*.pyc",
+        "*~", ".*.sw?", "4913", "*.tmp"
+    ]
+    ROOT_IGNORE_NAMES: List[str] = BUILD_DIR_NAMES
+    # written into the sources by the build, relative to the tree's root;
+    # e.g., by the dashboard frontend's npm build.
+    GENERATED_PATHS: List[str] = [
+        "src/pybind/mgr/dashboard/frontend/dist",
+        "src/pybind/mgr/dashboard/frontend/.angular",
+        "src/pybind/mgr/dashboard/frontend/src/environments/environment.ts",
+        "src/pybind/mgr/dashboard/frontend/src/environments/"
+        "environment.prod.ts"
+    ]
+
+    _root: Path
+    _ignore_names: List[str]
+    _ignore_paths: Set[str]
+    _debounce: float
+    _inotify: Optional[Inotify]
+    _dirs: Dict[int, str]
+    _unsettled: Set[str]
+    _pending: Set[str]
+    _last_change: float
+    _lock: threading.Lock
+    _thread: Optional[threading.Thread]
+    _error: Optional[WatchError]
+    changed: threading.Event
+
+    def __init__(self, root: Path, debounce: float = 0.5,
+                 ignore_paths: Optional[List[Path]] = None):
+        self._root = root.resolve()
+        self._debounce = debounce
+        self._ignore_names = list(self.IGNORE_NAMES)
+        self._ignore_paths = set(
+            [str(self._root.joinpath(p)) for p in self.GENERATED_PATHS])
+        for path in ignore_paths or []:
+            self._ignore_paths.add(str(path.resolve()))
+        self._inotify = None
+        self._dirs = {}
+        self._unsettled = set()
+        self._pending = set()
+        self._last_change = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._error = None
+        self.changed = threading.Event()
+
+    @property
+    def num_dirs(self) -> int:
+        return len(self._dirs)
+
+    def _is_ignored(self, path: str, name: str) -> bool:
+        if path in self._ignore_paths:
+            return True
+        patterns = self._ignore_names
+        if os.path.dirname(path) == str(self._root):
+            patterns = patterns + self.ROOT_IGNORE_NAMES
+        return any([fnmatch.fnmatch(name, p) for p in patterns])
+
+    def _add_tree(self, top: str) -> None:
+        assert self._inotify is not None
+        for path, dirs, _ in os.walk(top):
+            try:
+                wd = self._inotify.add_watch(path, self.MASK)
+            except (FileNotFoundError, NotADirectoryError):
+                # gone before we got to it.
+                dirs.clear()
+                continue
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise WatchError(e.errno, "out of inotify watches; see "
+                                              "'fs.inotify.max_user_watches'")
+                raise WatchError(e.errno or errno.EIO,
+                                 f"unable to watch {path}")
+            self._dirs[wd] = path
+            dirs[:] = [d for d in dirs
+                       if not self._is_ignored(os.path.join(path, d), d)]
+
+    def start(self) -> None:
+        """ Watch the tree; may take a while on large trees. """
+        self._inotify = Inotify()
+        self._add_tree(str(self._root))
+        self._thread = threading.Thread(target=self._run,
+                                        name="watch", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        assert self._inotify is not None
+        try:
+            while True:
+                timeout: Optional[float] = None
+                if len(self._unsettled) > 0:
+                    timeout = max(0.0, self._last_change +
+                                  self._debounce - time.monotonic())
+                for wd, mask, name in self._inotify.read(timeout):
+                    self._handle(wd, mask, name)
+                self._settle()
+        except WatchError as e:
+            self._error = e
+            self.changed.set()
+
+    def _handle(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            # we lost track of what changed; just say something did.
+            self._add_change(str(self._root))
+            return
+        if mask & IN_IGNORED:
+            self._dirs.pop(wd, None)
+            return
+        parent = self._dirs.get(wd)
+        if parent is None:
+            return
+        if mask & IN_DELETE_SELF:
+            self._add_change(parent)
+            return
+        path = os.path.join(parent, name)
+        if self._is_ignored(path, name):
+            return
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._add_tree(path)
+        self._add_change(path)
+
+    def _add_change(self, path: str) -> None:
+        self._unsettled.add(path)
+        self._last_change = time.monotonic()
+
+    def _settle(self) -> None:
+        if len(self._unsettled) == 0:
+            return
+        if time.monotonic() - self._last_change < self._debounce:
+            return
+        with self._lock:
+            self._pending.update(self._unsettled)
+            self._unsettled.clear()
+            self.changed.set()
+
+    def wait(self, timeout: Optional[float] = None) -> List[Path]:
+        """ Settled changes, relative to the tree's root, waiting up to
+            'timeout' for any.
+        """
+        if not self.changed.wait(timeout):
+            return []
+        if self._error is not None:
+            raise self._error
+        with self._lock:
+            pending = sorted(self._pending)
+            self._pending.clear()
+            self.changed.clear()
+        return [Path(p).relative_to(self._root) for p in pending]
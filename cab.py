@@ -2,30 +2,50 @@
 import click
 import errno
 import sys
-import subprocess
 import shlex
 import re
 import os
+import json
+import time
 from pathlib import Path
-from typing import Tuple, List, Optional
-from http.client import HTTPConnection
+from typing import TYPE_CHECKING, Any, Dict, Tuple, List, Optional
 
 from builder.config import Config
-from builder.build import Build
+from builder.build import Build, BuildCancelledError, BuildError, \
+    ContainerBuildError
+from builder.buildah import Buildah, BuildahError
 from builder.utils import print_table, \
     serror, sokay, swarn, sinfo, \
-    pinfo, pokay, perror, pwarn
+    pinfo, pokay, perror, pwarn, sizeof_fmt, print_tree, CABError
 from builder.images import Images, ImageChecker
-from builder.container_image import ContainerImage
+from builder.container_image import ContainerImage, ContainerImageName
+from builder.stats import BuildTimer, BuildHistory, get_phase_stats, fmt_secs
+from builder.profile import BuildProfile, ProfileDiff, ProfileStore
+from builder.ccache import CCacheRemoteStorage, CCacheError, \
+    CCacheBundle, CCacheBundleError
+from builder.mirror import MirrorCache, GitMirror
+from builder.compression import ImageCompression, ImageCompressionError
+from builder.gc import GCError, GCResult, RetentionPolicy
+from builder.state import StateError
+from builder.trace import Trace
+from builder.buildlog import BuildLog, BuildLogStore, print_first_error
+
+if TYPE_CHECKING:
+    from builder.push import PushEntry
 
 
 config = Config()
 
 
 @click.group()
-def cli():
+@click.option('--trace', 'trace_path', type=click.Path(dir_okay=False),
+              envvar='CAB_TRACE', metavar='PATH',
+              help="Write a trace of the external commands run, and of the "
+                   "build's phases, to PATH (Chrome trace / Perfetto json).")
+def cli(trace_path: Optional[str]):
     """Build containers from existing source trees, incrementally."""
-    pass
+    if trace_path:
+        Trace.enable(Path(trace_path).absolute())
 
 
 def _prompt_directory(prompt_text: str, must_exist=True) -> Path:
@@ -66,14 +86,18 @@ def _prompt_ccache_size() -> str:
 
 
 def _is_alive_registry_url(url: str) -> bool:
+    from builder.registry import RegistryClient, RegistryError
+
     pinfo(f"Trying to reach registry at {url}...")
     try:
-        conn = HTTPConnection(url, timeout=30)
-        conn.request("GET", "/v2/")
-    except Exception as e:
+        client = RegistryClient(url, secure=False, timeout=30)
+    except RegistryError as e:
         perror(f"error: {str(e)}")
         return False
-    return True
+    try:
+        return client.ping()
+    finally:
+        client.close()
 
 
 def _prompt_registry() -> Tuple[Optional[str], Optional[bool]]:
@@ -196,7 +220,9 @@ def check_create_images(
     if ImageChecker.check_has_images(vendor, release):
         return True
 
-    if ImageChecker.check_create_images(vendor, release, sourcepath, binpath):
+    spec_cache: Path = config.get_spec_cache_dir()
+    if ImageChecker.check_create_images(vendor, release, sourcepath, binpath,
+                                        spec_cache):
         return True
 
     return False
@@ -220,9 +246,25 @@ def check_create_images(
               help="git branch to clone from.")
 @click.option('--build-base-image', default=False, is_flag=True,
               help="build the base image if it does not exist.")
+@click.option('--build-dir', type=click.Path(file_okay=False,
+                                             resolve_path=True),
+              help="keep build objects here, instead of in SOURCEDIR.")
+@click.option('--build-dir-tmpfs', type=click.STRING, metavar="SIZE",
+              help="keep build objects on a tmpfs of SIZE (e.g., 32G).")
+@click.option('--persist-build-dir', default=False, is_flag=True,
+              help="persist the tmpfs build dir to --build-dir after builds.")
+@click.option('--compression', type=click.STRING, metavar="FORMAT",
+              help="push images with gzip, zstd or zstd:chunked layers.")
+@click.option('--compression-level', type=click.INT,
+              help="compression level for pushed images.")
 def create(buildname: str, vendor: str, release: str, sourcedir: str,
            with_debug: bool, with_tests: bool, build_base_image: bool,
-           clone_from_repo: str = None, clone_from_branch: str = None):
+           clone_from_repo: str = None, clone_from_branch: str = None,
+           build_dir: Optional[str] = None,
+           build_dir_tmpfs: Optional[str] = None,
+           persist_build_dir: bool = False,
+           compression: Optional[str] = None,
+           compression_level: Optional[int] = None):
     """Create a new build; does not build.
 
     BUILDNAME is the name for the build.\n
@@ -234,6 +276,28 @@ def create(buildname: str, vendor: str, release: str, sourcedir: str,
         perror(f"build '{buildname}' already exists.")
         sys.exit(errno.EEXIST)
 
+    if build_dir_tmpfs is not None and \
+            not re.match(r'^[0-9]+[kKmMgG]?$', build_dir_tmpfs):
+        perror(f"error: invalid tmpfs size '{build_dir_tmpfs}'")
+        sys.exit(errno.EINVAL)
+    if persist_build_dir and \
+            (build_dir is None or build_dir_tmpfs is None):
+        perror("error: --persist-build-dir requires --build-dir and "
+               "--build-dir-tmpfs")
+        sys.exit(errno.EINVAL)
+
+    image_compression: Optional[ImageCompression] = None
+    if compression is not None:
+        try:
+            image_compression = \
+                ImageCompression(compression, compression_level)
+        except ImageCompressionError as e:
+            print(str(e))
+            sys.exit(errno.EINVAL)
+    elif compression_level is not None:
+        perror("error: --compression-level requires --compression")
+        sys.exit(errno.EINVAL)
+
     # check whether a build image for <vendor>:<release> exists
 
     do_build_image: bool = False
@@ -255,13 +319,26 @@ def create(buildname: str, vendor: str, release: str, sourcedir: str,
                 sys.exit(errno.EINVAL)
             extra_opts += f"-b {clone_from_branch}"
 
+        # borrow objects from our mirror, if we keep one, instead of fetching
+        # the whole history again.
+        mirrors = MirrorCache(config.get_mirrors_dir())
+        if clone_from_repo in config.get_mirror_repos():
+            pinfo(f"=> updating mirror for {clone_from_repo}")
+            _, failed = mirrors.sync([clone_from_repo])
+            for url, reason in failed.items():
+                pwarn(f"=> unable to update mirror for {url}: {reason}")
+        mirror: Optional[GitMirror] = mirrors.find_mirror(clone_from_repo)
+        if mirror is not None:
+            pinfo(f"=> cloning with objects from mirror at {mirror.path}")
+            extra_opts += f" --reference-if-able {mirror.path}"
+
         if sourcepath.exists():
             perror(f"error: SOURCEDIR exists at {sourcepath}.")
             perror("can't clone to an existing directory")
             sys.exit(errno.EEXIST)
 
         cmd = f"git clone {extra_opts} {clone_from_repo} {sourcedir}"
-        proc = subprocess.run(shlex.split(cmd))
+        proc = Trace.run(shlex.split(cmd))
         if proc.returncode != 0:
             perror("error: unable to clone repository")
             sys.exit(proc.returncode)
@@ -286,8 +363,20 @@ def create(buildname: str, vendor: str, release: str, sourcedir: str,
             perror("=> unable to create images; abort.")
             sys.exit(errno.ENOTRECOVERABLE)
 
+    # builds sharing these sources are variants of each other, and must not
+    # share a build directory.
+    variants: List[str] = Build.get_variants_of(config, sourcedir)
+    if len(variants) > 0:
+        pinfo(f"=> variant of {', '.join(variants)}, sharing sources")
+        if build_dir is None and build_dir_tmpfs is None:
+            build_dir = Build.get_variant_build_dir(sourcedir, buildname)
+
     build = Build.create(config, buildname, vendor, release, sourcedir,
-                         with_debug=with_debug, with_tests=with_tests)
+                         with_debug=with_debug, with_tests=with_tests,
+                         build_dir=build_dir,
+                         build_dir_tmpfs=build_dir_tmpfs,
+                         build_dir_persist=persist_build_dir,
+                         image_compression=image_compression)
     build.print()
     pokay(f"created build '{buildname}'")
 
@@ -295,13 +384,27 @@ def create(buildname: str, vendor: str, release: str, sourcedir: str,
 @click.command()
 @click.argument('buildname', type=click.STRING)
 @click.option('--with-fresh-build', default=False, is_flag=True,
-              help="cleans the source repository before building")
+              help="cleans the source repository before building, and "
+                   "doesn't reuse what other builds built")
 @click.option('--nuke-install', default=False, is_flag=True,
               help="destroys the install directory before building")
+@click.option('--ccache-remote-read-only', default=False, is_flag=True,
+              help="don't write to the ccache remote storage on this build")
+@click.option('--wait-push', default=False, is_flag=True,
+              help="wait for the image to be pushed to the registry")
+@click.option('-q', '--quiet', default=False, is_flag=True,
+              help="only show the build's phases and progress, not its "
+                   "output; see 'cab logs'")
+@click.option('--no-image', default=False, is_flag=True,
+              help="only build, and install, the binaries; see 'cab sync'")
 def build(
     buildname: str,
     nuke_install: bool,
-    with_fresh_build: bool
+    with_fresh_build: bool,
+    ccache_remote_read_only: bool,
+    wait_push: bool,
+    quiet: bool,
+    no_image: bool
 ):
     """
     Starts a new build.
@@ -332,11 +435,25 @@ def build(
         if not sure:
             sys.exit(1)
 
+    timer: BuildTimer = BuildTimer()
     build: Build = Build(config, buildname)
+    _check_build_images(build, timer)
+
+    Build.build(config, buildname, nuke_install=nuke_install,
+                with_fresh_build=with_fresh_build,
+                ccache_remote_read_only=ccache_remote_read_only,
+                timer=timer, wait_push=wait_push, quiet=quiet,
+                with_image=not no_image)
+
+
+def _check_build_images(build: Build, timer: BuildTimer):
     assert build._vendor
     assert build._release
     assert build._sources
-    if not ImageChecker.check_has_images(build._vendor, build._release):
+    with timer.phase("image-checks"):
+        has_images: bool = \
+            ImageChecker.check_has_images(build._vendor, build._release)
+    if not has_images:
         # create build images.
         pwarn("=> missing build images; creating...")
         vendor: str = build._vendor
@@ -346,8 +463,162 @@ def build(
             perror("=> error creating images for build")
             sys.exit(errno.ENOTRECOVERABLE)
 
-    Build.build(config, buildname, nuke_install=nuke_install,
-                with_fresh_build=with_fresh_build)
+
+def _fmt_changes(changes: List[Path], max_shown: int = 3) -> str:
+    shown = ", ".join([str(p) for p in changes[:max_shown]])
+    if len(changes) > max_shown:
+        shown += f", and {len(changes) - max_shown} more"
+    return shown
+
+
+@click.command()
+@click.argument('buildname', type=click.STRING)
+@click.option('--debounce', type=click.FLOAT, default=0.5, metavar="SECS",
+              help="build once the sources stop changing for SECS.")
+@click.option('--no-initial-build', default=False, is_flag=True,
+              help="don't build until the sources change.")
+@click.option('-q', '--quiet', default=False, is_flag=True,
+              help="only show the builds' phases and progress, not their "
+                   "output; see 'cab logs'")
+def watch(buildname: str, debounce: float, no_initial_build: bool,
+          quiet: bool):
+    """Rebuild whenever the sources change.
+
+    Watches the sources of BUILDNAME, ignoring build directories and git's
+    internals, and builds it, and its image, whenever they change. A build
+    made stale by newer changes is cancelled, and started anew.
+
+    Runs until interrupted.
+    """
+    from builder.watch import SourceWatcher, WatchError
+
+    if not config.build_exists(buildname):
+        perror(f"error: build '{buildname}' does not exist.")
+        sys.exit(errno.ENOENT)
+
+    build: Build = Build(config, buildname)
+    _check_build_images(build, BuildTimer())
+    sources: Optional[str] = build.get_sources_dir()
+    assert sources
+
+    ignore: List[Path] = []
+    build_dir: Optional[Path] = build.get_build_dir_path()
+    if build_dir is not None:
+        ignore.append(build_dir)
+    watcher = SourceWatcher(Path(sources), debounce=debounce,
+                            ignore_paths=ignore)
+    try:
+        watcher.start()
+    except WatchError as e:
+        print(str(e))
+        sys.exit(errno.EINVAL)
+    pinfo(f"=> watching {watcher.num_dirs} directories at {sources}")
+
+    if not no_initial_build:
+        watcher.changed.set()
+    try:
+        while True:
+            if not watcher.changed.is_set():
+                pinfo("=> waiting for changes")
+            try:
+                changes: List[Path] = watcher.wait()
+            except WatchError as e:
+                print(str(e))
+                sys.exit(errno.EIO)
+            if len(changes) > 0:
+                pinfo(f"=> changed: {_fmt_changes(changes)}")
+
+            timer: BuildTimer = BuildTimer()
+            try:
+                Build.build(config, buildname, timer=timer, quiet=quiet,
+                            cancel=watcher.changed)
+                pokay(f"=> built in {fmt_secs(timer.get_total())}")
+            except BuildCancelledError:
+                pwarn("=> sources changed meanwhile; building again")
+            except (BuildError, ContainerBuildError, CABError) as e:
+                perror(f"=> build failed: {str(e)}")
+    except KeyboardInterrupt:
+        pinfo("=> stopped watching")
+
+
+@click.command(name="sync")
+@click.argument('buildname', type=click.STRING)
+@click.option('-c', '--container', 'containers', multiple=True,
+              required=True, metavar="ID|KEY=VALUE",
+              help="container to sync, by id or name, or those with a "
+                   "label KEY=VALUE; may be repeated.")
+@click.option('--restart', default=False, is_flag=True,
+              help="restart containers whose daemon is affected.")
+@click.option('-n', '--dry-run', default=False, is_flag=True,
+              help="only show what would be copied.")
+def sync(buildname: str, containers: Tuple[str], restart: bool,
+         dry_run: bool):
+    """Copy a build's changed binaries into running containers.
+
+    Hot-patches containers started from BUILDNAME's images with what changed
+    in its install tree since, e.g. after 'cab build --no-image', without
+    creating a new image.
+    """
+    from builder.podman import Podman, PodmanError
+    from builder.sync import ContainerSync, SyncError
+
+    if not config.build_exists(buildname):
+        perror(f"error: build '{buildname}' does not exist.")
+        sys.exit(errno.ENOENT)
+
+    build: Build = Build(config, buildname)
+    install_path: Path = build.get_install_path()
+    if not install_path.exists():
+        perror(f"build '{buildname}' has not been built.")
+        sys.exit(errno.ENOENT)
+
+    targets: List[ContainerSync] = []
+    try:
+        for spec in containers:
+            found = Podman.find_containers(spec)
+            if len(found) == 0:
+                perror(f"no containers match '{spec}'")
+                sys.exit(errno.ENOENT)
+            targets.extend([ContainerSync(install_path,
+                                          Build.IMAGE_EXCLUDES, c)
+                            for c in found])
+    except PodmanError as e:
+        print(str(e))
+        sys.exit(errno.ENOENT)
+
+    failed = False
+    for target in targets:
+        if target.get_build() != buildname:
+            perror(f"=> {target.name}: not started from an image of "
+                   f"build '{buildname}'")
+            failed = True
+            continue
+        start = time.time()
+        try:
+            changed: List[str] = target.sync(dry_run=dry_run)
+        except (PodmanError, SyncError) as e:
+            perror(f"=> {target.name}: {str(e)}")
+            failed = True
+            continue
+        what = "would copy" if dry_run else "copied"
+        pinfo(f"=> {target.name}: {what} {len(changed)} files in "
+              f"{fmt_secs(time.time() - start)}")
+        if dry_run:
+            for path in changed:
+                print(f"   {path}")
+        if len(changed) == 0 or dry_run or not target.needs_restart(changed):
+            continue
+        if not restart:
+            pwarn(f"=> {target.name}: needs restarting; see '--restart'")
+            continue
+        try:
+            target.restart()
+            pokay(f"=> {target.name}: restarted")
+        except SyncError as e:
+            perror(f"=> {target.name}: unable to restart: {str(e)}")
+            failed = True
+    if failed:
+        sys.exit(errno.EIO)
 
 
 @click.command()
@@ -388,6 +659,250 @@ def destroy(buildname: str):
         pinfo(f"destroyed build '{buildname}'")
 
 
+def _get_retention_policy(build: Optional[Build],
+                          keep_last: Optional[int],
+                          keep_younger_than: Optional[str],
+                          auto: Optional[bool] = None) -> RetentionPolicy:
+    current: RetentionPolicy = build.get_retention_policy() \
+        if build is not None else config.get_retention_policy()
+    if keep_last is None:
+        keep_last = current.keep_last
+    if keep_younger_than is None:
+        keep_younger_than = current.keep_younger_than
+    elif keep_younger_than == "none":
+        keep_younger_than = None
+    if auto is None:
+        auto = current.auto
+    try:
+        return RetentionPolicy(keep_last, keep_younger_than, auto)
+    except GCError as e:
+        print(str(e))
+        sys.exit(errno.EINVAL)
+
+
+def _gc_containers(dry_run: bool):
+    try:
+        stale: List[Tuple[str, str]] = Buildah.get_stale_containers()
+    except BuildahError as e:
+        print(str(e))
+        sys.exit(errno.EIO)
+    if len(stale) == 0:
+        pinfo("no stale working containers.")
+        return
+    verb = "would remove" if dry_run else "removing"
+    for wc, name in stale:
+        pwarn(f"  - {verb} {name} ({wc[:12]})")
+    if dry_run:
+        return
+    ret, err = Buildah.remove_containers([wc for wc, _ in stale])
+    if ret != 0:
+        perror(f"error removing working containers: {' '.join(err)}")
+        sys.exit(errno.EIO)
+    pokay(f"removed {len(stale)} working containers.")
+
+
+@click.command()
+@click.argument('buildnames', nargs=-1, type=click.STRING)
+@click.option('-n', '--keep-last', type=click.INT,
+              help="keep this many of the most recent runs' images.")
+@click.option('--keep-younger-than', type=click.STRING, metavar="AGE",
+              help="keep images younger than AGE (e.g., 12h, 7d, 2w).")
+@click.option('--dry-run', default=False, is_flag=True,
+              help="only show what would be removed.")
+@click.option('--containers', default=False, is_flag=True,
+              help="remove working containers left behind instead.")
+def gc(buildnames: Tuple[str], keep_last: Optional[int],
+       keep_younger_than: Optional[str], dry_run: bool, containers: bool):
+    """Remove old build images.
+
+    Keeps, for each of BUILDNAMES (default: all builds), the images of the
+    runs its retention policy asks for, and always the latest images.
+    Options override the configured policy (see 'cab gc-policy').
+
+    With '--containers', removes instead the working containers left behind
+    by cab processes no longer running, which keep their images from being
+    removed.
+    """
+    if containers:
+        _gc_containers(dry_run)
+        return
+
+    names: List[str] = list(buildnames) if len(buildnames) > 0 \
+        else sorted(config.get_builds())
+    failed = False
+    for name in names:
+        if not config.build_exists(name):
+            perror(f"error: build '{name}' does not exist.")
+            sys.exit(errno.ENOENT)
+        build: Build = Build(config, name)
+        policy = _get_retention_policy(build, keep_last, keep_younger_than)
+        result: GCResult = build.collect_images(policy, dry_run=dry_run)
+        pinfo(f"=> {name}: {policy}")
+        verb = "would remove" if dry_run else "removed"
+        for image_name in result.removed_names:
+            pwarn(f"  - {verb} {image_name}")
+        for err in result.errors:
+            perror(f"  - {err}")
+        failed = failed or len(result.errors) > 0
+        pinfo(f"  {verb} {len(result.expired)} runs, kept "
+              f"{len(result.kept)}, {result.removed_dangling} leftovers "
+              f"removed")
+    if failed:
+        sys.exit(errno.EIO)
+
+
+@click.command(name="gc-policy")
+@click.argument('buildname', type=click.STRING, required=False)
+@click.option('-n', '--keep-last', type=click.INT,
+              help="keep this many of the most recent runs' images.")
+@click.option('--keep-younger-than', type=click.STRING, metavar="AGE",
+              help="keep images younger than AGE (e.g., 12h, 7d, 2w); "
+              "'none' to unset.")
+@click.option('--auto/--no-auto', default=None,
+              help="collect images after each build.")
+@click.option('--clear', default=False, is_flag=True,
+              help="drop the policy, falling back to the default one.")
+def gc_policy(buildname: Optional[str], keep_last: Optional[int],
+              keep_younger_than: Optional[str], auto: Optional[bool],
+              clear: bool):
+    """Configure which build images 'cab gc' keeps.
+
+    Sets the policy of BUILDNAME, or, without it, the one for all builds not
+    having their own. Without options, shows the current policy.
+    """
+    build: Optional[Build] = None
+    if buildname is not None:
+        if not config.build_exists(buildname):
+            perror(f"error: build '{buildname}' does not exist.")
+            sys.exit(errno.ENOENT)
+        build = Build(config, buildname)
+
+    if clear:
+        if build is not None:
+            build.set_retention_policy(None)
+        else:
+            config.set_retention_policy(None)
+            config.commit()
+        pokay("retention policy cleared.")
+        return
+
+    if keep_last is None and keep_younger_than is None and auto is None:
+        policy = build.get_retention_policy() if build is not None \
+            else config.get_retention_policy()
+        pinfo(f"retention: {policy}")
+        return
+
+    policy = _get_retention_policy(build, keep_last, keep_younger_than, auto)
+    if build is not None:
+        build.set_retention_policy(policy)
+    else:
+        config.set_retention_policy(policy)
+        config.commit()
+    pokay(f"retention set to: {policy}")
+
+
+def _fmt_image_usage(usage: Optional[Tuple[int, int, int]]) -> str:
+    if usage is None:
+        return "n/a"
+    nimages, unique, shared = usage
+    return f"{nimages} images, {sizeof_fmt(unique)} unique, " \
+           f"{sizeof_fmt(shared)} shared"
+
+
+@click.command(name="du")
+@click.argument('buildname', type=click.STRING, required=False)
+@click.option('-j', '--jobs', type=click.INT, default=8,
+              help="directories to scan in parallel.")
+@click.option('--no-cache', default=False, is_flag=True,
+              help="scan every directory, ignoring cached sizes.")
+@click.option('--json', 'as_json', default=False, is_flag=True,
+              help="output as json.")
+def disk_usage(buildname: Optional[str], jobs: int, no_cache: bool,
+               as_json: bool):
+    """Show disk usage of builds.
+
+    For BUILDNAME, or all builds, grouped by vendor/release, shows the size
+    of install trees, the bytes of images only they use and of those shared
+    with other images, and the size of the vendor/release's ccache.
+    """
+    from builder.du import DiskUsageError, ImageStorage, SizeIndex
+
+    names: List[str] = sorted(config.get_builds())
+    if buildname is not None:
+        if not config.build_exists(buildname):
+            perror(f"error: build '{buildname}' does not exist.")
+            sys.exit(errno.ENOENT)
+        names = [buildname]
+
+    index = SizeIndex(
+        None if no_cache else config.get_data_dir().joinpath("du-index.json"))
+    storage: Optional[ImageStorage] = None
+    try:
+        storage = ImageStorage.load()
+    except (DiskUsageError, FileNotFoundError) as e:
+        if not as_json:
+            pwarn(f"unable to account for images: {str(e)}")
+
+    groups: Dict[Tuple[str, str], List[Build]] = {}
+    for name in names:
+        build: Build = Build(config, name)
+        assert build._vendor and build._release
+        groups.setdefault((build._vendor, build._release), []).append(build)
+
+    report: Dict[str, Any] = {}
+    for (vendor, release), builds in sorted(groups.items()):
+        entry: Dict[str, Any] = {'ccache': None, 'images': None,
+                                 'builds': {}}
+        ccache_dir = config.get_ccache_dir()
+        if ccache_dir is not None:
+            entry['ccache'] = index.get_usage(
+                ccache_dir.joinpath(f"{vendor}/{release}"), jobs)[0]
+        if storage is not None:
+            def is_base(n: ContainerImageName) -> bool:
+                return n.repository in ["cab/base", "cab/builder"] and \
+                    n.name == vendor and n.tag == release
+            entry['images'] = storage.get_usage(is_base)
+        for build in builds:
+            install_bytes, install_files = \
+                index.get_usage(build.get_install_path(), jobs)
+            images = None
+            if storage is not None:
+                def is_build(n: ContainerImageName,
+                             name: str = build._name) -> bool:
+                    return n.repository == "cab-builds" and n.name == name
+                images = storage.get_usage(is_build)
+            entry['builds'][build._name] = {
+                'install': install_bytes,
+                'install_files': install_files,
+                'images': images
+            }
+        report[f"{vendor}/{release}"] = entry
+    index.commit()
+
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+
+    tree: List[Any] = []
+    for vendor_release, entry in report.items():
+        children: List[Any] = [
+            ('ccache', sizeof_fmt(entry['ccache'])
+             if entry['ccache'] is not None else "n/a"),
+            ('base and builder images', _fmt_image_usage(entry['images']))
+        ]
+        for name, usage in entry['builds'].items():
+            children.append((name, '', [
+                ('install', f"{sizeof_fmt(usage['install'])} "
+                            f"({usage['install_files']} files)"),
+                ('images', _fmt_image_usage(usage['images']))
+            ]))
+        tree.append((vendor_release, '', children))
+    print_tree(tree)
+    if not no_cache:
+        pinfo(f"=> {index.hits} directories unchanged, "
+              f"{index.misses} scanned")
+
+
 @click.command(name="list")
 @click.option('-v', '--verbose', default=False, is_flag=True)
 def list_builds(verbose: bool):
@@ -426,6 +941,334 @@ def build_info(buildname: str):
         img.print()
 
 
+@click.command(name="logs")
+@click.argument('buildname', type=click.STRING)
+@click.option('-r', '--run', type=click.STRING,
+              help="show the log of RUN, as listed by '--list'; default: "
+                   "the latest")
+@click.option('-l', '--list', 'list_runs', default=False, is_flag=True,
+              help="list the build's logged runs.")
+@click.option('-f', '--follow', default=False, is_flag=True,
+              help="keep showing the output of a build still running.")
+@click.option('-e', '--error', default=False, is_flag=True,
+              help="only show the first compiler, or linker, error.")
+def logs(buildname: str, run: Optional[str], list_runs: bool, follow: bool,
+         error: bool):
+    """Show the output of a build's runs.
+
+    BUILDNAME is the name of the build to show the output of; its latest run
+    is shown, unless otherwise specified.
+    """
+    store = BuildLogStore(config.get_logs_dir())
+    if list_runs:
+        runs = store.get_runs(buildname)
+        if len(runs) == 0:
+            pinfo(f"no logs for build '{buildname}'")
+            return
+        for entry in runs:
+            state = sinfo("running") if entry.is_live() else ""
+            size = sizeof_fmt(entry.path.stat().st_size)
+            print(f"{entry.run}  {size:>9}  {state}")
+        return
+
+    log: Optional[BuildLog] = store.get_run(buildname, run)
+    if log is None:
+        perror(f"error: no logs for build '{buildname}'"
+               f"{f' run {run}' if run is not None else ''}")
+        sys.exit(errno.ENOENT)
+    if error:
+        if not print_first_error(log):
+            pinfo("no errors found.")
+        return
+    try:
+        for data in log.read(follow=follow):
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # e.g., piped through 'head'.
+        sys.stderr.close()
+
+
+@click.command(name="import-yaml")
+def import_yaml():
+    """Import yaml configuration files again.
+
+    Configuration used to be kept in 'config.yaml', and 'builds/*.yaml', and
+    is imported once into the state store. This imports them again, replacing
+    the global configuration and builds of the same names.
+    """
+    try:
+        n = config.import_yaml()
+    except StateError as e:
+        print(str(e))
+        sys.exit(errno.EINVAL)
+    pokay(f"imported configuration and {n} builds into "
+          f"{config.get_config_path()}")
+
+
+@click.command()
+@click.argument('buildname', type=click.STRING)
+@click.option('-n', '--last', type=click.INT, default=20,
+              help="only consider the last N runs (default: 20).")
+@click.option('--all', 'all_runs', default=False, is_flag=True,
+              help="also consider failed runs.")
+@click.option('--json', 'as_json', default=False, is_flag=True,
+              help="output json.")
+def stats(buildname: str, last: int, all_runs: bool, as_json: bool):
+    """Show per-phase build timings.
+
+    Shows the distribution of each phase's duration over the build's past
+    runs, flagging phases for which the last run regressed.
+
+    BUILDNAME is the name of the build to show timings for.
+    """
+    history = BuildHistory(config.get_history_dir())
+    # as recorded, i.e. as runs finished; the last is the one started last.
+    runs = sorted(history.get_runs(buildname),
+                  key=lambda r: r.get('start') or "")
+    if not all_runs:
+        runs = [r for r in runs if r.get('success', False)]
+    runs = runs[-last:] if last > 0 else runs
+    if len(runs) == 0:
+        perror(f"no recorded runs for build '{buildname}'")
+        sys.exit(errno.ENOENT)
+
+    phases = get_phase_stats(runs)
+    if as_json:
+        print(json.dumps({
+            'build': buildname,
+            'runs': runs,
+            'phases': [p.to_dict() for p in phases]
+        }, indent=2))
+        return
+
+    lastrun = runs[-1]
+    print_table([
+        ("runs", len(runs)),
+        ("last run", lastrun['start']),
+        ("host", lastrun['host']),
+        ("sha", "{}{}".format(
+            (lastrun['sha'] or "unknown")[:12],
+            " (dirty)" if lastrun['dirty'] else ""))
+    ], color="cyan")
+    print()
+
+    fmt = "{:<20} {:>5} {:>9} {:>9} {:>9} {:>9} {:>9}  {}"
+    print(sinfo(fmt.format("phase", "runs", "min", "median",
+                           "p90", "max", "last", "")))
+    for p in phases:
+        regression = p.get_regression()
+        note = "" if regression is None else \
+            swarn(f"+{regression*100:.0f}% vs median")
+        print(fmt.format(p.name, p.runs, fmt_secs(p.min), fmt_secs(p.median),
+                         fmt_secs(p.p90), fmt_secs(p.max), fmt_secs(p.last),
+                         note))
+
+
+def _print_profile(profile: BuildProfile, top: int):
+    crit_len, crit_path = profile.get_critical_path()
+    print_table([
+        ("created", profile.created),
+        ("tool", profile.tool),
+        ("targets", len(profile.entries)),
+        ("wall time", fmt_secs(profile.get_wall_time() / 1000)),
+        ("cpu time", fmt_secs(profile.get_total_time() / 1000)),
+        ("critical path", fmt_secs(crit_len / 1000)),
+        ("parallelism", "{:.1f} of {} jobs ({:.0f}%)".format(
+            profile.get_parallelism(), profile.jobs,
+            profile.get_utilization() * 100))
+    ], color="cyan")
+
+    for kind in ["compile", "link"]:
+        print()
+        pinfo(f"slowest {kind}s:")
+        for e in profile.get_slowest(kind, top):
+            print("  {:>9}  {}".format(fmt_secs(e.duration / 1000), e.target))
+
+    print()
+    pinfo("compile time by directory:")
+    for d, ms, n in profile.get_by_directory(top):
+        print("  {:>9}  {:>5}  {}".format(fmt_secs(ms / 1000), n, d))
+
+    print()
+    pinfo("critical path (est.):")
+    for e in crit_path[-top:]:
+        print("  {:>9}  {}".format(fmt_secs(e.duration / 1000), e.target))
+
+
+def _print_profile_diff(diff: ProfileDiff, top: int):
+    print_table([
+        ("old", diff.old.created),
+        ("new", diff.new.created),
+        ("wall time", "{} -> {}".format(
+            fmt_secs(diff.old.get_wall_time() / 1000),
+            fmt_secs(diff.new.get_wall_time() / 1000))),
+        ("targets", "{} -> {}".format(
+            len(diff.old.entries), len(diff.new.entries)))
+    ], color="cyan")
+    changes = diff.get_changes()
+    print()
+    pinfo("largest increases:")
+    for target, old, new in changes[:top]:
+        if new <= old:
+            break
+        print("  {:>9} -> {:>9}  {}".format(
+            fmt_secs(old / 1000), fmt_secs(new / 1000), target))
+    print()
+    pinfo("largest decreases:")
+    for target, old, new in reversed(changes[-top:]):
+        if new >= old:
+            break
+        print("  {:>9} -> {:>9}  {}".format(
+            fmt_secs(old / 1000), fmt_secs(new / 1000), target))
+
+
+@click.command()
+@click.argument('buildname', type=click.STRING)
+@click.option('-n', '--top', type=click.INT, default=10,
+              help="number of entries to show per section (default: 10).")
+@click.option('--run', type=click.INT, default=-1,
+              help="profile index, negative from the latest (default: -1).")
+@click.option('--diff', 'diff_with', type=click.INT,
+              help="compare against profile index, e.g. -2.")
+@click.option('--json', 'as_json', default=False, is_flag=True,
+              help="output json.")
+def profile(buildname: str, top: int, run: int, diff_with: Optional[int],
+            as_json: bool):
+    """Show per-target compile and link timings.
+
+    Shows the slowest compiles and links of a build run, compile time per
+    directory, the estimated critical path and how well the build made use of
+    the available jobs. Optionally, compares two runs.
+
+    BUILDNAME is the name of the build to show the profile for.
+    """
+    store = ProfileStore(config.get_profiles_dir())
+    paths = store.get_profiles(buildname)
+    if len(paths) == 0:
+        perror(f"no profiles for build '{buildname}'")
+        sys.exit(errno.ENOENT)
+
+    try:
+        prof: BuildProfile = store.load(paths[run])
+        other: Optional[BuildProfile] = None
+        if diff_with is not None:
+            other = store.load(paths[diff_with])
+    except IndexError:
+        perror(f"no such profile; build has {len(paths)} profiles.")
+        sys.exit(errno.EINVAL)
+
+    if other is not None:
+        diff = ProfileDiff(other, prof)
+        if as_json:
+            print(json.dumps([
+                {'target': t, 'old': o, 'new': n}
+                for t, o, n in diff.get_changes()], indent=2))
+        else:
+            _print_profile_diff(diff, top)
+        return
+
+    if as_json:
+        print(json.dumps(prof.to_dict(), indent=2))
+    else:
+        _print_profile(prof, top)
+
+
+def _fmt_probe_run(run: Dict[str, Any]) -> str:
+    if 'error' in run:
+        return f"{'error':>9} {'':>9} {'':>9}"
+    return "{:>9} {:>9} {:>9}".format(
+        f"{run['wall_secs'] * 1000:.0f}ms",
+        sizeof_fmt(run['maxrss_kb'] * 1024),
+        int(run['major_faults']))
+
+
+@click.command(name="bench-image")
+@click.argument('buildname', type=click.STRING)
+@click.argument('tag', type=click.STRING, required=False, default="latest")
+@click.option('-n', '--runs', type=click.IntRange(1, 100), default=3,
+              help="warm runs of each probe (default: 3).")
+@click.option('-l', '--list', 'list_results', default=False, is_flag=True,
+              help="list the results kept for the build's images.")
+@click.option('--json', 'as_json', default=False, is_flag=True,
+              help="output json.")
+def bench_image(buildname: str, tag: str, runs: int, list_results: bool,
+                as_json: bool):
+    """Measure how long daemons and tools take to start in an image.
+
+    Runs 'ceph --version', 'ceph-osd --version', an import of every mgr
+    module and 'cephadm --help' in fresh containers of BUILDNAME's image TAG
+    (default: latest), once and then warm, recording wall time, peak RSS and
+    pages read from disk (major faults). The first run isn't a cold one, as
+    the image is likely in the host's page cache already. Results are kept
+    per image, and warm runs compared with those of the previous image
+    benchmarked.
+    """
+    from builder.imagebench import ImageBench, ImageBenchError, \
+        ImageBenchStore
+    from builder.probe import PROBES
+
+    store = ImageBenchStore(config.get_image_bench_dir())
+    if list_results:
+        results = store.get_results(buildname)
+        if as_json:
+            print(json.dumps(results, indent=2))
+            return
+        if len(results) == 0:
+            pinfo(f"no image benchmarks for build '{buildname}'")
+            return
+        names = list(PROBES.keys())
+        fmt = "{:<18} {:>9}" + " {:>20}" * len(names)
+        print(sinfo(fmt.format("image", "size", *names)))
+        for r in results:
+            warm = ["{:.0f}ms".format(
+                r['probes'][n]['warm'].get('wall_secs', 0) * 1000)
+                if n in r['probes'] else "-" for n in names]
+            print(fmt.format(r['tag'] or r['image'][:12],
+                             sizeof_fmt(r['size']), *warm))
+        return
+
+    image: Optional[ContainerImage] = Images.find_build_image(buildname, tag)
+    if image is None:
+        perror(f"no image '{tag}' for build '{buildname}'")
+        sys.exit(errno.ENOENT)
+
+    if not as_json:
+        pinfo(f"=> benchmarking {buildname}:{tag} ({image.short_hashid})")
+    try:
+        result = ImageBench(image, runs=runs).run()
+    except ImageBenchError as e:
+        print(str(e))
+        sys.exit(errno.EIO)
+    store.store(buildname, result)
+    previous = store.get_previous(buildname, result['tag']) \
+        if result['tag'] is not None else None
+    if as_json:
+        print(json.dumps({'result': result, 'previous': previous}, indent=2))
+        return
+
+    if previous is not None:
+        pinfo(f"=> compared with {previous['tag']}")
+    fmt = "{:<20} {:>9} {:>9} {:>9}   {:>9} {:>9} {:>9}  {}"
+    print(sinfo(fmt.format("probe", "first", "rss", "faults",
+                           "warm", "rss", "faults", "")))
+    for name, probe in result['probes'].items():
+        note = ""
+        if 'error' not in probe['first'] and \
+                probe['first'].get('returncode', 0) != 0:
+            note = swarn(f"exit {probe['first']['returncode']}")
+        if previous is not None and name in previous['probes']:
+            regression = ImageBench.get_regression(
+                probe['warm'], previous['probes'][name]['warm'])
+            if regression is not None:
+                note = swarn(f"+{regression * 100:.0f}% warm")
+        print("{:<20} {}   {}  {}".format(
+            name, _fmt_probe_run(probe['first']),
+            _fmt_probe_run(probe['warm']), note))
+
+
 @click.command()
 @click.argument('buildname', type=click.STRING)
 def shell(buildname: str):
@@ -442,13 +1285,420 @@ def shell(buildname: str):
         sys.exit(errno.EINVAL)
 
 
+@click.group(name="ccache")
+def ccache_group():
+    """Manage compilation caches."""
+    pass
+
+
+@ccache_group.command(name="remote")
+@click.option('--url', nargs=1, type=click.STRING,
+              help="remote storage url (file://, http://, redis://).")
+@click.option('--read-only/--read-write', default=None,
+              help="whether this host only reads from the remote storage.")
+@click.option('--clear', default=False, is_flag=True,
+              help="stop using a remote storage.")
+def ccache_remote(url: Optional[str], read_only: Optional[bool], clear: bool):
+    """Configure the ccache remote storage.
+
+    Builds on this host will share compilation results through the remote
+    storage, in addition to the local ccache. Without options, shows the
+    current configuration.
+    """
+    if not config.has_ccache():
+        perror("error: ccache is not configured; run 'cab init'.")
+        sys.exit(errno.EINVAL)
+
+    if clear:
+        config.set_ccache_remote(None)
+        config.commit()
+        pokay("ccache remote storage cleared.")
+        return
+
+    remote: Optional[CCacheRemoteStorage] = config.get_ccache_remote()
+    if url is None and read_only is None:
+        if remote is None:
+            pinfo("no ccache remote storage configured.")
+            return
+        print_table([
+            ("url", remote.url),
+            ("role", remote.role)
+        ], color="cyan")
+        return
+
+    if url is None:
+        if remote is None:
+            perror("error: must specify a remote storage url.")
+            sys.exit(errno.EINVAL)
+        url = remote.url
+    if read_only is None:
+        read_only = remote.read_only if remote is not None else False
+
+    try:
+        config.set_ccache_remote(url, read_only)
+    except CCacheError as e:
+        print(str(e))
+        sys.exit(errno.EINVAL)
+    config.commit()
+    pokay("ccache remote storage configured.")
+
+
+def _parse_vendor_release(vendor_release: str) -> Tuple[str, str]:
+    match = re.match(r'^([-._\w]+)/([-._\w]+)$', vendor_release)
+    if not match:
+        perror("error: expected <vendor>/<release>.")
+        sys.exit(errno.EINVAL)
+    return match.group(1), match.group(2)
+
+
+def _get_builder_fingerprint(vendor: str, release: str) -> str:
+    img: Optional[ContainerImage] = Images.find_builder_image(vendor, release)
+    if not img:
+        perror(f"error: no builder image for {vendor}/{release}.")
+        sys.exit(errno.ENOENT)
+    return img.hashid
+
+
+@ccache_group.command(name="export")
+@click.argument('vendor_release', metavar='VENDOR/RELEASE', type=click.STRING)
+@click.option('-o', '--output', type=click.Path(dir_okay=False),
+              help="bundle path (default: <vendor>-<release>.tar.zst).")
+@click.option('--recent', type=click.INT,
+              help="only export the N most recently used entries.")
+@click.option('--max-age', type=click.INT,
+              help="only export entries used in the last N days.")
+@click.option('--level', type=click.IntRange(1, 19), default=3,
+              help="zstd compression level.")
+def ccache_export(vendor_release: str, output: Optional[str],
+                  recent: Optional[int], max_age: Optional[int], level: int):
+    """Export a vendor/release ccache into a bundle.
+
+    The bundle is tagged with the vendor/release builder image, and can only
+    be imported on hosts with the same builder image.
+
+    VENDOR/RELEASE is the ccache to export.
+    """
+    if not config.has_ccache():
+        perror("error: ccache is not configured.")
+        sys.exit(errno.EINVAL)
+
+    vendor, release = _parse_vendor_release(vendor_release)
+    ccache_path: Path = config.get_ccache_dir().joinpath(vendor, release)
+    if not ccache_path.exists():
+        perror(f"error: no ccache for {vendor}/{release}.")
+        sys.exit(errno.ENOENT)
+
+    fingerprint: str = _get_builder_fingerprint(vendor, release)
+    bundle_path: Path = Path(output or f"{vendor}-{release}.tar.zst")
+    pinfo(f"=> exporting ccache for {vendor}/{release} to {bundle_path}")
+    try:
+        manifest = CCacheBundle.export(ccache_path, bundle_path.absolute(),
+                                       vendor, release, fingerprint,
+                                       recent=recent, max_age_days=max_age,
+                                       level=level)
+    except CCacheBundleError as e:
+        print(str(e))
+        sys.exit(errno.ENOTRECOVERABLE)
+
+    print_table([
+        ("entries", manifest['num_entries']),
+        ("total", sizeof_fmt(manifest['total_bytes'])),
+        ("unique", sizeof_fmt(manifest['unique_bytes'])),
+        ("bundle", sizeof_fmt(bundle_path.stat().st_size)),
+        ("fingerprint", fingerprint[:12])
+    ], color="cyan")
+    pokay(f"exported ccache to {bundle_path}")
+
+
+@ccache_group.command(name="import")
+@click.argument('bundle', type=click.Path(exists=True, dir_okay=False))
+@click.option('--overwrite', default=False, is_flag=True,
+              help="overwrite existing ccache entries.")
+@click.option('-j', '--jobs', type=click.INT,
+              help="number of parallel writers.")
+def ccache_import(bundle: str, overwrite: bool, jobs: Optional[int]):
+    """Import a ccache bundle.
+
+    The bundle is imported into its vendor/release ccache, provided this
+    host's builder image for that vendor/release matches the bundle's.
+
+    BUNDLE is the path to a bundle created with 'cab ccache export'.
+    """
+    if not config.has_ccache():
+        perror("error: ccache is not configured.")
+        sys.exit(errno.EINVAL)
+
+    bundle_path: Path = Path(bundle)
+    try:
+        manifest = CCacheBundle.read_manifest(bundle_path)
+        vendor: str = manifest['vendor']
+        release: str = manifest['release']
+        fingerprint: str = _get_builder_fingerprint(vendor, release)
+        ccache_path: Path = config.get_ccache_dir().joinpath(vendor, release)
+        pinfo(f"=> importing {manifest['num_entries']} entries "
+              f"into ccache for {vendor}/{release}")
+        imported, skipped = \
+            CCacheBundle.import_bundle(bundle_path, ccache_path, fingerprint,
+                                       overwrite=overwrite, jobs=jobs)
+    except CCacheBundleError as e:
+        print(str(e))
+        sys.exit(errno.EINVAL)
+
+    pokay(f"imported {imported} entries ({skipped} existing skipped)")
+
+
+@click.group(name="registry")
+def registry_group():
+    """Manage the registry images are pushed to."""
+    pass
+
+
+@registry_group.command(name="compression")
+@click.option('--format', 'fmt', type=click.STRING,
+              help="gzip, zstd or zstd:chunked.")
+@click.option('--level', type=click.INT, help="compression level.")
+@click.option('--clear', default=False, is_flag=True,
+              help="push with podman's default compression.")
+def registry_compression(fmt: Optional[str], level: Optional[int],
+                         clear: bool):
+    """Configure how pushed image layers are compressed.
+
+    zstd:chunked layers allow consumers to pull only the files they need.
+    Builds may override this on creation. Without options, shows the
+    current configuration.
+    """
+    if not config.has_registry():
+        perror("error: no registry configured; run 'cab init'.")
+        sys.exit(errno.EINVAL)
+
+    if clear:
+        config.set_registry_compression(None)
+        config.commit()
+        pokay("registry compression cleared.")
+        return
+
+    current: Optional[ImageCompression] = config.get_registry_compression()
+    if fmt is None and level is None:
+        pinfo(f"compression: {current if current is not None else 'default'}")
+        return
+
+    if fmt is None:
+        if current is None:
+            perror("error: must specify a compression format.")
+            sys.exit(errno.EINVAL)
+        fmt = current.format
+    try:
+        config.set_registry_compression(ImageCompression(fmt, level))
+    except ImageCompressionError as e:
+        print(str(e))
+        sys.exit(errno.EINVAL)
+    config.commit()
+    pokay(f"registry compression set to {config.get_registry_compression()}")
+
+
+@registry_group.command(name="push-jobs")
+@click.argument('jobs', type=click.IntRange(1, 16), required=False)
+def registry_push_jobs(jobs: Optional[int]):
+    """Set how many images are pushed at a time.
+
+    Without JOBS, shows the current setting.
+    """
+    if jobs is None:
+        pinfo(f"concurrent pushes: {config.get_registry_push_jobs()}")
+        return
+    config.set_registry_push_jobs(jobs)
+    config.commit()
+    pokay(f"concurrent pushes set to {jobs}")
+
+
+@click.group(name="push")
+def push_group():
+    """Manage queued image pushes.
+
+    Built images are pushed to the registry in the background, by a worker
+    retrying failed pushes with increasing delays.
+    """
+    pass
+
+
+def _get_push_detail(entry: 'PushEntry') -> str:
+    now = time.time()
+    if entry.state == "done" and entry.finished is not None:
+        return f"{fmt_secs(now - entry.finished)} ago, " \
+               f"{sizeof_fmt(entry.uploaded_bytes)} uploaded"
+    detail = ""
+    if entry.state == "pending" and entry.next_attempt > now:
+        detail = f"retrying in {fmt_secs(entry.next_attempt - now)}"
+    elif entry.state == "pending":
+        detail = f"queued {fmt_secs(now - entry.queued)} ago"
+    if entry.error is not None:
+        detail += f"{', ' if detail else ''}{entry.attempts} attempts, " \
+                  f"last: {entry.error}"
+    return detail
+
+
+@push_group.command(name="status")
+def push_status():
+    """Show queued, running, and finished pushes."""
+    from builder.push import PushEntry, PushQueue
+
+    queue = PushQueue(config.get_push_dir())
+    entries: List[PushEntry] = queue.get_entries()
+    pid: Optional[int] = queue.get_worker_pid()
+    if pid is not None:
+        pinfo(f"worker running (pid {pid}), log at {queue.get_log_path()}")
+    else:
+        pinfo("worker not running")
+    if len(entries) == 0:
+        pinfo("no pushes queued.")
+        return
+    colors = {'done': sokay, 'failed': serror, 'pushing': sinfo}
+    for entry in entries:
+        state = colors.get(entry.state, swarn)(f"{entry.state:<8}")
+        print(f"{state} {entry.build:<20} {entry.image}")
+        detail = _get_push_detail(entry)
+        if len(detail) > 0:
+            print(f"{'':<8} {detail}")
+
+
+@push_group.command(name="retry")
+@click.argument('buildname', type=click.STRING, required=False)
+def push_retry(buildname: Optional[str]):
+    """Retry failed pushes, of BUILDNAME or all."""
+    from builder.push import PushQueue
+
+    queue = PushQueue(config.get_push_dir())
+    n = queue.retry(buildname)
+    if n == 0:
+        pinfo("no failed pushes.")
+        return
+    queue.start_worker(config.get_registry_push_jobs())
+    pokay(f"retrying {n} pushes.")
+
+
+@push_group.command(name="run")
+def push_run():
+    """Process the push queue in the foreground."""
+    from builder.push import PushQueue, PushWorker
+
+    queue = PushQueue(config.get_push_dir())
+    worker = PushWorker(queue, config.get_registry_push_jobs())
+    if not worker.run():
+        perror("error: a push worker is already running.")
+        sys.exit(errno.EBUSY)
+    pokay("push queue processed.")
+
+
+@click.group(name="mirror")
+def mirror_group():
+    """Manage local git mirrors.
+
+    Mirrored repositories, and their submodules, are kept as bare mirrors
+    under cab's data directory. Clones for new builds borrow their objects,
+    and builds fetch submodules from them.
+    """
+    pass
+
+
+@mirror_group.command(name="add")
+@click.argument('url', type=click.STRING)
+@click.option('--no-sync', default=False, is_flag=True,
+              help="don't create the mirror now.")
+def mirror_add(url: str, no_sync: bool):
+    """Mirror a repository.
+
+    URL is the repository to mirror, along with its submodules.
+    """
+    config.add_mirror_repo(url)
+    config.commit()
+    if not no_sync:
+        _sync_mirrors([url], 4)
+    pokay(f"mirroring {url}")
+
+
+@mirror_group.command(name="remove")
+@click.argument('url', type=click.STRING)
+def mirror_remove(url: str):
+    """Stop mirroring a repository.
+
+    The mirror itself is kept, as existing clones may rely on its objects.
+
+    URL is the mirrored repository.
+    """
+    if url not in config.get_mirror_repos():
+        perror(f"error: {url} is not mirrored.")
+        sys.exit(errno.ENOENT)
+    config.remove_mirror_repo(url)
+    config.commit()
+    pokay(f"no longer mirroring {url}")
+
+
+@mirror_group.command(name="list")
+def mirror_list():
+    """List mirrors."""
+    mirrors = MirrorCache(config.get_mirrors_dir())
+    index: Dict[str, str] = mirrors.get_index()
+    repos: List[str] = config.get_mirror_repos()
+    if len(repos) == 0 and len(index) == 0:
+        pinfo("no mirrors.")
+        return
+    print_table([(url, "mirrored" if url in index else "not synced")
+                 for url in repos], color="cyan")
+    num_submodules = len([u for u in index.keys() if u not in repos])
+    pinfo(f"=> {num_submodules} submodule mirrors at {mirrors.path}")
+
+
+def _sync_mirrors(urls: List[str], jobs: int):
+    mirrors = MirrorCache(config.get_mirrors_dir())
+    pinfo(f"=> syncing mirrors for {len(urls)} repositories, "
+          f"and their submodules")
+    synced, failed = mirrors.sync(urls, jobs=jobs)
+    for url, reason in failed.items():
+        perror(f"=> unable to sync {url}: {reason}")
+    pinfo(f"=> synced {len(synced)} mirrors")
+    if len(failed) > 0:
+        sys.exit(errno.EIO)
+
+
+@mirror_group.command(name="sync")
+@click.argument('urls', nargs=-1, type=click.STRING)
+@click.option('-j', '--jobs', type=click.INT, default=4,
+              help="number of mirrors synced in parallel.")
+def mirror_sync(urls: Tuple[str], jobs: int):
+    """Refresh mirrors.
+
+    URLS are the mirrored repositories to refresh (default: all).
+    """
+    repos: List[str] = list(urls) if len(urls) > 0 \
+        else config.get_mirror_repos()
+    if len(repos) == 0:
+        pinfo("no mirrored repositories.")
+        return
+    _sync_mirrors(repos, jobs)
+    pokay("mirrors synced.")
+
+
 cli.add_command(init)
 cli.add_command(create)
 cli.add_command(build)
+cli.add_command(watch)
+cli.add_command(sync)
 cli.add_command(destroy)
+cli.add_command(gc)
+cli.add_command(gc_policy)
+cli.add_command(disk_usage)
 cli.add_command(list_builds)
 cli.add_command(build_info)
+cli.add_command(logs)
+cli.add_command(import_yaml)
 cli.add_command(shell)
+cli.add_command(stats)
+cli.add_command(profile)
+cli.add_command(bench_image)
+cli.add_command(ccache_group)
+cli.add_command(mirror_group)
+cli.add_command(registry_group)
+cli.add_command(push_group)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+#
+# Minimal http storage server for ccache's remote storage 'http' backend.
+#
+# Meant as a local stand-in for a proper shared storage (e.g., nginx with
+# WebDAV, or a redis server), so one can try out and test sharing compilation
+# results between builds without setting up infrastructure.
+#
+# usage: ccache-storage-server.py <directory> [--port PORT] [--read-only]
+#
+# and then, e.g.,
+#
+#   cab ccache remote --url http://<host>:<port>/ --read-write
+#
+import argparse
+import sys
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+
+class CCacheStorageHandler(BaseHTTPRequestHandler):
+
+    root: Path
+    read_only: bool = False
+
+    def _get_path(self) -> Path:
+        # ccache keys are hex strings, possibly split in subdirectories;
+        # never allow escaping the storage root.
+        key = self.path.split('?', 1)[0].strip('/')
+        path = self.root.joinpath(key).resolve()
+        if self.root not in path.parents:
+            raise ValueError(self.path)
+        return path
+
+    def _reply(self, code: int, length: int = 0):
+        self.send_response(code)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        try:
+            path = self._get_path()
+        except ValueError:
+            self._reply(400)
+            return
+        if not path.is_file():
+            self._reply(404)
+            return
+        self._reply(200, path.stat().st_size)
+
+    def do_GET(self):
+        try:
+            path = self._get_path()
+        except ValueError:
+            self._reply(400)
+            return
+        if not path.is_file():
+            self._reply(404)
+            return
+        data = path.read_bytes()
+        self._reply(200, len(data))
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        if self.read_only:
+            self._reply(403)
+            return
+        try:
+            path = self._get_path()
+        except ValueError:
+            self._reply(400)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+        self._reply(201)
+
+    def do_DELETE(self):
+        if self.read_only:
+            self._reply(403)
+            return
+        try:
+            path = self._get_path()
+        except ValueError:
+            self._reply(400)
+            return
+        if not path.is_file():
+            self._reply(404)
+            return
+        path.unlink()
+        self._reply(200)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="local http storage for ccache's remote storage")
+    parser.add_argument("directory", type=str)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--read-only", action="store_true", default=False)
+    args = parser.parse_args()
+
+    root = Path(args.directory).resolve()
+    root.mkdir(parents=True, exist_ok=True)
+    CCacheStorageHandler.root = root
+    CCacheStorageHandler.read_only = args.read_only
+
+    server = ThreadingHTTPServer(("", args.port), CCacheStorageHandler)
+    print(f"serving ccache storage from {root} on port {args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+#
+# Minimal registry, speaking enough of the OCI distribution API for cab to push
+# images to it: blob checks, cross-repository mounts, chunked uploads and
+# their status, and manifests.
+#
+# Meant as a local stand-in for a proper registry, so one can try out and test
+# pushing without setting up infrastructure. There is no authentication, and
+# no garbage collection.
+#
+# usage: registry-server.py <directory> [--port PORT] [--fail-after BYTES]
+#
+# With '--fail-after', the connection of the upload crossing that many
+# received bytes is dropped, once, so resuming uploads can be exercised.
+#
+# and then, e.g.,
+#
+#   cab init  (with registry url localhost:<port>, not secure)
+#
+import argparse
+import hashlib
+import json
+import re
+import sys
+import threading
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+NAME = r'(?P<name>[a-z0-9]+(?:[._/-][a-z0-9]+)*)'
+DIGEST = r'(?P<digest>sha256:[a-f0-9]{64})'
+BLOB_RE = re.compile(rf'^/v2/{NAME}/blobs/{DIGEST}$')
+UPLOADS_RE = re.compile(rf'^/v2/{NAME}/blobs/uploads/$')
+UPLOAD_RE = re.compile(rf'^/v2/{NAME}/blobs/uploads/(?P<uuid>[a-f0-9-]+)$')
+REF = r'(?P<ref>[\w][\w.-]{0,127}|sha256:[a-f0-9]{64})'
+MANIFEST_RE = re.compile(rf'^/v2/{NAME}/manifests/{REF}$')
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    root: Path
+    fail_after: Optional[int] = None
+    received: int = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code: int, body: bytes = b'',
+               headers: Optional[Dict[str, str]] = None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD" and len(body) > 0:
+            self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length > 0 else b''
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.root.joinpath("blobs", digest.replace(':', '/'))
+
+    def _link_path(self, name: str, digest: str) -> Path:
+        return self.root.joinpath("repos", name, "_layers", digest)
+
+    def _has_blob(self, name: str, digest: str) -> bool:
+        return self._link_path(name, digest).exists() and \
+            self._blob_path(digest).exists()
+
+    def _link(self, name: str, digest: str):
+        path = self._link_path(name, digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+
+    def _upload_path(self, upload: str) -> Path:
+        return self.root.joinpath("uploads", upload)
+
+    def _upload_headers(self, name: str, upload: str) -> Dict[str, str]:
+        size = self._upload_path(upload).stat().st_size
+        headers = {
+            "Location": f"/v2/{name}/blobs/uploads/{upload}",
+            "Docker-Upload-UUID": upload
+        }
+        # as the reference registry does, an empty upload is '0-0' too.
+        headers["Range"] = f"0-{max(size - 1, 0)}"
+        return headers
+
+    def _split(self) -> Tuple[str, Dict[str, list]]:
+        parsed = urlparse(self.path)
+        return parsed.path, parse_qs(parsed.query)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path, _ = self._split()
+        if path == "/v2/":
+            self._reply(200, b'{}', {"Content-Type": "application/json"})
+            return
+        m = BLOB_RE.match(path)
+        if m:
+            if not self._has_blob(m['name'], m['digest']):
+                self._reply(404)
+                return
+            data = self._blob_path(m['digest']).read_bytes()
+            self._reply(200, data, {"Docker-Content-Digest": m['digest']})
+            return
+        m = UPLOAD_RE.match(path)
+        if m:
+            if not self._upload_path(m['uuid']).exists():
+                self._reply(404)
+                return
+            self._reply(204, headers=self._upload_headers(m['name'],
+                                                          m['uuid']))
+            return
+        m = MANIFEST_RE.match(path)
+        if m:
+            ref = m['ref']
+            repo = self.root.joinpath("repos", m['name'], "_manifests")
+            if not ref.startswith("sha256:"):
+                tag = repo.joinpath("tags", ref)
+                if not tag.exists():
+                    self._reply(404)
+                    return
+                ref = tag.read_text()
+            manifest = repo.joinpath("revisions", ref)
+            if not manifest.exists():
+                self._reply(404)
+                return
+            meta = json.loads(manifest.read_text())
+            self._reply(200, self._blob_path(ref).read_bytes(), {
+                "Content-Type": meta['mediaType'],
+                "Docker-Content-Digest": ref
+            })
+            return
+        self._reply(404)
+
+    def do_POST(self):
+        path, query = self._split()
+        self._read_body()
+        m = UPLOADS_RE.match(path)
+        if not m:
+            self._reply(404)
+            return
+        name = m['name']
+        mount = query.get('mount', [None])[0]
+        src = query.get('from', [None])[0]
+        if mount is not None and src is not None and \
+                self._has_blob(src, mount):
+            self._link(name, mount)
+            self._reply(201, headers={
+                "Location": f"/v2/{name}/blobs/{mount}",
+                "Docker-Content-Digest": mount
+            })
+            return
+        upload = str(uuid.uuid4())
+        upload_path = self._upload_path(upload)
+        upload_path.parent.mkdir(parents=True, exist_ok=True)
+        upload_path.touch()
+        self._reply(202, headers=self._upload_headers(name, upload))
+
+    def do_PATCH(self):
+        path, _ = self._split()
+        m = UPLOAD_RE.match(path)
+        if not m or not self._upload_path(m['uuid']).exists():
+            self._read_body()
+            self._reply(404)
+            return
+        upload_path = self._upload_path(m['uuid'])
+        data = self._read_body()
+
+        with self.lock:
+            RegistryHandler.received += len(data)
+            if self.fail_after is not None and \
+                    RegistryHandler.received > self.fail_after:
+                RegistryHandler.fail_after = None
+                # drop the connection, as if interrupted.
+                self.close_connection = True
+                return
+
+        size = upload_path.stat().st_size
+        rng = self.headers.get("Content-Range")
+        if rng is not None:
+            start = int(rng.split('-', 1)[0])
+            if start != size:
+                self._reply(416, headers=self._upload_headers(m['name'],
+                                                              m['uuid']))
+                return
+        with upload_path.open('ab') as fd:
+            fd.write(data)
+        self._reply(202, headers=self._upload_headers(m['name'], m['uuid']))
+
+    def do_PUT(self):
+        path, query = self._split()
+        m = UPLOAD_RE.match(path)
+        if m:
+            upload_path = self._upload_path(m['uuid'])
+            data = self._read_body()
+            digest = query.get('digest', [None])[0]
+            if not upload_path.exists() or digest is None:
+                self._reply(404)
+                return
+            with upload_path.open('ab') as fd:
+                fd.write(data)
+            h = hashlib.sha256()
+            with upload_path.open('rb') as fd:
+                for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+                    h.update(chunk)
+            if f"sha256:{h.hexdigest()}" != digest:
+                upload_path.unlink()
+                self._reply(400, b'{"errors":[{"code":"DIGEST_INVALID"}]}')
+                return
+            blob_path = self._blob_path(digest)
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            upload_path.replace(blob_path)
+            self._link(m['name'], digest)
+            self._reply(201, headers={
+                "Location": f"/v2/{m['name']}/blobs/{digest}",
+                "Docker-Content-Digest": digest
+            })
+            return
+
+        m = MANIFEST_RE.match(path)
+        if m:
+            data = self._read_body()
+            manifest = json.loads(data)
+            blobs = [manifest['config']['digest']] + \
+                [x['digest'] for x in manifest.get('layers', [])]
+            for digest in blobs:
+                if not self._has_blob(m['name'], digest):
+                    self._reply(400, b'{"errors":[{"code":"BLOB_UNKNOWN"}]}')
+                    return
+            digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+            blob_path = self._blob_path(digest)
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            blob_path.write_bytes(data)
+            repo = self.root.joinpath("repos", m['name'], "_manifests")
+            revision = repo.joinpath("revisions", digest)
+            revision.parent.mkdir(parents=True, exist_ok=True)
+            revision.write_text(json.dumps({
+                'mediaType': self.headers.get(
+                    "Content-Type",
+                    "application/vnd.oci.image.manifest.v1+json")
+            }))
+            if not m['ref'].startswith("sha256:"):
+                tag = repo.joinpath("tags", m['ref'])
+                tag.parent.mkdir(parents=True, exist_ok=True)
+                tag.write_text(digest)
+            self._reply(201, headers={
+                "Location": f"/v2/{m['name']}/manifests/{digest}",
+                "Docker-Content-Digest": digest
+            })
+            return
+        self._read_body()
+        self._reply(404)
+
+    def do_DELETE(self):
+        path, _ = self._split()
+        m = UPLOAD_RE.match(path)
+        if not m or not self._upload_path(m['uuid']).exists():
+            self._reply(404)
+            return
+        self._upload_path(m['uuid']).unlink()
+        self._reply(204)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="local stand-in for an OCI registry")
+    parser.add_argument("directory", type=str)
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--fail-after", type=int,
+                        help="drop an upload once this many bytes arrived")
+    args = parser.parse_args()
+
+    root = Path(args.directory).resolve()
+    root.mkdir(parents=True, exist_ok=True)
+    RegistryHandler.root = root
+    RegistryHandler.fail_after = args.fail_after
+
+    server = ThreadingHTTPServer(("", args.port), RegistryHandler)
+    print(f"serving registry from {root} on port {args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -111,6 +111,7 @@ EOF
   podman run -it \
     --userns=keep-id \
     -v ${bin}:/build/bin \
+    -v ${root_dir}/builder:/build/cab:ro \
     -v ${src}:/build/src \
     -v ${out}:/build/out \
     ${volume_extra_args} \